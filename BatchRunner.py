@@ -0,0 +1,216 @@
+'''
+Parallel batch runner for network backfills.
+
+Every (file, station model) pair is independent, so the work is fanned out
+to a pool of worker processes. Each worker loads the models once, when it
+starts, and keeps them for every task it runs.
+
+The files are prepared in the parent process, once for the union of the
+inputs of all the models (see EnsembleRunner.import_inputs). Their input
+matrix is stored in a multiprocessing.shared_memory block and the workers
+write their predictions in a second one, so the feature arrays are never
+pickled: a task only carries the names of the blocks and the columns.
+While the workers predict one file, the parent prepares the next one.
+
+The threads of the backends of each worker are limited to their share of
+the cores (ThreadControls), so the pool does not oversubscribe the CPU.
+With as many workers as cores it runs one thread per process.
+
+The result is a report with the statAnalysis metrics of every file and
+model, plus the predictions when they are requested.
+
+Usage:
+    python BatchRunner.py data/*.csv [--workers 4]
+'''
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+import ModelRegistry as registry
+import ThreadControls as threads
+import EnsembleRunner as ensemble
+
+# columns of the report, in order
+REPORT_COLUMNS = ['file', 'station', 'rows', 'rmse', 'rrmse', 'mbe', 'r2', 'nse', 'seconds']
+
+
+class SharedArray():
+    """
+    A NumPy array backed by a multiprocessing.shared_memory block.
+
+    The parent creates it (create=True) and unlinks it once every worker is
+    done, the workers attach to it by name.
+    """
+    def __init__(self, name=None, shape=None, dtype=np.float64, create=False):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    @property
+    def spec(self):
+        """
+        What a worker needs to attach to the block.
+        """
+        return self.shm.name, self.shape, self.dtype.str
+
+    def close(self):
+        self.array = None
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
+
+
+def _preload(stations, n_threads):
+    '''
+    Initializer of the workers: it sets the threads of the backends and
+    loads the models once per process.
+    '''
+    threads.configure(n_threads)
+    registry.set_cache_size(max(len(stations), registry.MAX_CACHED_MODELS))
+    for station in stations:
+        registry.get_model(station)
+
+def _predict_task(station, inputs_spec, output_spec, column, position):
+    '''
+    It predicts rs with a model over the shared input matrix of a file and
+    writes the result in its column of the shared output matrix.
+
+    The last column of the input matrix is the measured rs.
+
+    Output:
+        * (station, rows, rmse, rrmse, mbe, r2, nse, seconds)
+    '''
+    start = time.perf_counter()
+    inputs = SharedArray(*inputs_spec)
+    output = SharedArray(*output_spec)
+    try:
+        y_pred = ensemble.predict_rows(station, inputs.array, position)
+        output.array[:, column] = y_pred
+
+        # metrics through the station class, over the rows with rs and prediction
+        rs = inputs.array[:, -1]
+        valid = ~(np.isnan(rs) | np.isnan(y_pred))
+        metrics = (np.nan,) * 5
+        if valid.sum() > 1:
+            mlModel = registry.get_class(station)()
+            mlModel.y_test, mlModel.y_pred = rs[valid], y_pred[valid]
+            metrics = mlModel.statAnalysis()
+    finally:
+        inputs.close()
+        output.close()
+    return (station, int(valid.sum())) + tuple(metrics) + (time.perf_counter() - start,)
+
+
+def run_batch(fileLocations, fileType, stations=None, workers=None, years=None, station_ids=None,
+              keep_predictions=False, n_threads=None):
+    '''
+    It predicts rs with several station models over several files in parallel.
+
+    Input:
+        * fileLocations -> list of files, e.g. ['data/2019.csv', 'data/2020.csv']
+
+        * fileType -> string with csv, txt, excel, parquet, feather or arrow
+
+        * stations -> list of station models. By default every model
+        available in models/.
+
+        * workers -> number of worker processes, by default os.cpu_count()
+
+        * n_threads -> threads of the backends in each worker, by default
+        os.cpu_count() // workers
+
+        * years, station_ids -> optional lists of years/station ids to keep
+
+        * keep_predictions -> also return the predictions of every file
+
+    Output:
+        * dfReport -> pandas Dataframe with a row per file and model: rows
+        with rs and prediction, rmse, rrmse, mbe, r2, nse and seconds
+
+        * predictions -> only with keep_predictions, dict with the
+        predictions Dataframe of each file (as EnsembleRunner.run_ensemble)
+    '''
+    if stations is None:
+        stations = registry.available_stations()
+    workers = workers or os.cpu_count()
+    n_threads = n_threads or threads.threads_per_worker(workers)
+
+    report, predictions, pending = [], {}, []
+
+    def collect(fileLocation, dfData, shared, futures):
+        try:
+            for future in futures:
+                report.append((fileLocation,) + future.result())
+            if keep_predictions:
+                dfPredictions = dfData[[c for c in ensemble.ID_COLUMNS if c in dfData]].copy()
+                dfPredictions['rs'] = shared[0].array[:, -1].copy()
+                for column, station in enumerate(stations):
+                    dfPredictions['rs_' + station] = shared[1].array[:, column].copy()
+                predictions[fileLocation] = dfPredictions
+        finally:
+            for array in shared:
+                array.unlink()
+
+    with ProcessPoolExecutor(workers, initializer=_preload, initargs=(stations, n_threads)) as pool:
+        try:
+            for fileLocation in fileLocations:
+                dfData, inputs, position = ensemble.import_inputs(
+                    fileLocation, fileType, stations, years, station_ids)
+                shared = (SharedArray(shape=(len(inputs), inputs.shape[1] + 1), create=True),
+                          SharedArray(shape=(len(inputs), len(stations)), create=True))
+                shared[0].array[:, :-1] = inputs
+                shared[0].array[:, -1] = dfData['rs'] if 'rs' in dfData else np.nan
+                del inputs
+                futures = [pool.submit(_predict_task, station, shared[0].spec, shared[1].spec,
+                                       column, position)
+                           for column, station in enumerate(stations)]
+                pending.append((fileLocation, dfData, shared, futures))
+
+                # the previous file is collected while this one is predicted
+                if len(pending) > 1:
+                    collect(*pending.pop(0))
+            while pending:
+                collect(*pending.pop(0))
+        finally:
+            # on error, the blocks of the files not collected are released
+            for _, _, _, futures in pending:
+                for future in futures:
+                    future.cancel()
+            pool.shutdown(wait=True)
+            for _, _, shared, _ in pending:
+                for array in shared:
+                    array.unlink()
+
+    dfReport = pd.DataFrame(report, columns=REPORT_COLUMNS)
+    if keep_predictions:
+        return dfReport, predictions
+    return dfReport
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('files', nargs='+', help='files or glob patterns')
+    parser.add_argument('--type', default='csv', help='csv, txt, excel, parquet, feather or arrow')
+    parser.add_argument('--stations', nargs='+', help='station models, by default all')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--threads', type=int, help='threads per worker')
+    parser.add_argument('--report', help='csv file to store the report')
+    args = parser.parse_args()
+
+    fileLocations = sorted(f for pattern in args.files for f in glob.glob(pattern))
+    start = time.perf_counter()
+    dfReport = run_batch(fileLocations, args.type, args.stations, args.workers, n_threads=args.threads)
+    elapsed = time.perf_counter() - start
+
+    print(dfReport.to_string(index=False))
+    print('%d files, %d rows predicted in %.2f s' % (len(fileLocations), dfReport['rows'].sum(), elapsed))
+    if args.report:
+        dfReport.to_csv(args.report, index=False)
@@ -0,0 +1,203 @@
+'''
+Command-line batch scorer for every station model.
+
+It streams every input file through each model, chunk by chunk:
+import -> standardize -> predict -> metrics, with the methods of the
+station classes. The predictions of each chunk are written as soon as
+they are computed, so memory is bounded by the chunk size and not by the
+file size. Several files (and models) are scored at the same time in a
+thread pool: the reading, the writing and the NumPy models release the
+GIL most of the time.
+
+At the end it prints the metrics of every file and model over all their
+chunks, and the rows per second of each model.
+
+Usage:
+    python BatchScorer.py "data/*.csv" --models cor06 gra03 --output predictions/ --output-type parquet
+
+    inputs        one or more files or glob patterns
+    --models      station models, by default every model available in models/
+    --type        format of the inputs, by default from their extension
+    --output      folder for the predictions, <file>_<model>.<output-type>
+                  in the subfolders of the inputs under their common
+                  folder. Without it only the metrics are computed.
+    --output-type parquet (default), feather, arrow, csv or txt
+    --chunksize   rows read at a time
+    --dtype       float64 (default) or float32, see the float32 mode in README.md
+    --workers     files and models scored at the same time
+    --report      csv file to store the report
+'''
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import StatsFunctions as stats
+import ModelRegistry as registry
+import DatasetFunctions as dataset
+
+# file extension -> fileType
+EXTENSIONS = {
+    '.csv': 'csv',
+    '.txt': 'txt',
+    '.parquet': 'parquet',
+    '.pq': 'parquet',
+    '.feather': 'feather',
+    '.arrow': 'arrow',
+}
+
+REPORT_COLUMNS = ['file', 'model', 'rows', 'seconds', 'rows_per_s', 'rmse', 'rrmse', 'mbe', 'r2', 'nse']
+
+
+def expand_inputs(patterns):
+    '''
+    It returns the files matched by the patterns, sorted and without repetitions.
+    '''
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise FileNotFoundError('no file matches %s' % pattern)
+        files.extend(match for match in matches if match not in files)
+    return files
+
+def file_type(fileLocation, fileType=None):
+    if fileType is not None:
+        return fileType
+    extension = os.path.splitext(fileLocation)[1].lower()
+    if extension not in EXTENSIONS:
+        raise ValueError('unknown extension %s, give the type of the inputs' % extension)
+    return EXTENSIONS[extension]
+
+def input_root(fileLocations):
+    '''
+    It returns the deepest folder common to every input file.
+    '''
+    return os.path.commonpath([os.path.dirname(os.path.abspath(f)) for f in fileLocations])
+
+def output_location(folder, fileLocation, station, outputType, root=None):
+    '''
+    It returns the file of the predictions of a model for an input. The
+    subfolders of the input under root are kept, so inputs with the same
+    name in different folders (data/*/asheville.csv) do not share it.
+    '''
+    if root is None:
+        root = os.path.dirname(os.path.abspath(fileLocation))
+    name = os.path.splitext(os.path.relpath(os.path.abspath(fileLocation), root))[0]
+    return os.path.join(folder, '%s_%s.%s' % (name, station, outputType))
+
+
+def score_file(fileLocation, station, fileType=None, output=None, outputType='parquet', chunksize=100000,
+               dtype=np.float64, root=None):
+    '''
+    It streams a file through a station model.
+
+    Input:
+        * fileLocation -> "data/dataSet.csv"
+
+        * station -> station code of the model
+
+        * fileType -> csv, txt, parquet, feather or arrow, by default from
+        the extension
+
+        * output -> folder to write the predictions to, None to skip them
+
+        * outputType, chunksize -> see the module docstring
+
+        * dtype -> dtype the station class works in, np.float64 or np.float32
+
+        * root -> folder the output names are relative to, by default the
+        folder of the input
+
+    Output:
+        * result -> dict with file, model, rows, seconds, rows_per_s and
+        the metrics of StatsFunctions (nan without rows)
+    '''
+    start = time.perf_counter()
+    mlModel = registry.get_class(station)(dtype=dtype)
+    accumulator = stats.MetricsAccumulator()
+    writer = None
+    if output is not None:
+        outputLocation = output_location(output, fileLocation, station, outputType, root)
+        os.makedirs(os.path.dirname(outputLocation), exist_ok=True)
+        writer = dataset.ChunkWriter(outputLocation, outputType)
+
+    try:
+        for _ in mlModel.import_dataset_chunks(fileLocation, file_type(fileLocation, fileType), chunksize):
+            mlModel.getStandardDataTest()
+            mlModel.predictValues()
+            accumulator.update(mlModel.y_test, mlModel.y_pred)
+            if writer is not None:
+                dfOutput = mlModel.dfData.reset_index(drop=True)
+                dfOutput['rs_pred'] = np.ravel(mlModel.y_pred)
+                writer.write(dfOutput)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    seconds = time.perf_counter() - start
+    result = {'file': fileLocation, 'model': station, 'rows': accumulator.n, 'seconds': seconds,
+              'rows_per_s': accumulator.n / seconds}
+    metrics = accumulator.result() if accumulator.n > 1 else {}
+    for metric in REPORT_COLUMNS[5:]:
+        result[metric] = metrics.get(metric, np.nan)
+    return result
+
+def score_files(fileLocations, stations=None, fileType=None, output=None, outputType='parquet',
+                chunksize=100000, workers=None, dtype=np.float64):
+    '''
+    It scores every file with every model, several at the same time.
+
+    Output:
+        * dfReport -> pandas Dataframe with a row per file and model
+        (REPORT_COLUMNS)
+    '''
+    if stations is None:
+        stations = registry.available_stations()
+    root = input_root(fileLocations) if fileLocations else None
+    # the models are loaded once, before the threads share them
+    for station in stations:
+        registry.get_model(station)
+
+    tasks = [(fileLocation, station) for fileLocation in fileLocations for station in stations]
+    with ThreadPoolExecutor(workers or min(len(tasks), os.cpu_count()) or 1) as pool:
+        results = list(pool.map(lambda task: score_file(task[0], task[1], fileType, output, outputType,
+                                                        chunksize, dtype, root), tasks))
+    return pd.DataFrame(results, columns=REPORT_COLUMNS)
+
+def model_throughput(dfReport):
+    '''
+    It returns the rows and rows per second of each model over all the files.
+    '''
+    dfModels = dfReport.groupby('model', sort=False)[['rows', 'seconds']].sum()
+    dfModels['rows_per_s'] = dfModels['rows'] / dfModels['seconds']
+    return dfModels
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('inputs', nargs='+', help='files or glob patterns')
+    parser.add_argument('--models', nargs='+', help='station models, by default all')
+    parser.add_argument('--type', help='csv, txt, parquet, feather or arrow, by default from the extension')
+    parser.add_argument('--output', help='folder for the predictions')
+    parser.add_argument('--output-type', default='parquet', help='parquet, feather, arrow, csv or txt')
+    parser.add_argument('--chunksize', type=int, default=100000)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--dtype', default='float64', choices=['float64', 'float32'])
+    parser.add_argument('--report', help='csv file to store the report')
+    args = parser.parse_args()
+
+    fileLocations = expand_inputs(args.inputs)
+    start = time.perf_counter()
+    dfReport = score_files(fileLocations, args.models, args.type, args.output, args.output_type,
+                           args.chunksize, args.workers, args.dtype)
+    elapsed = time.perf_counter() - start
+
+    print(dfReport.to_string(index=False))
+    print()
+    print(model_throughput(dfReport).to_string())
+    print('%d files, %d rows in %.2f s' % (len(fileLocations), dfReport['rows'].sum(), elapsed))
+    if args.report:
+        dfReport.to_csv(args.report, index=False)
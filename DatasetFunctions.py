@@ -0,0 +1,432 @@
+'''
+Import and preparation of the datasets shared by the station models.
+
+Besides csv/txt and excel, the datasets can be stored in columnar files,
+parquet or arrow IPC (feather). These are read through pyarrow.dataset,
+so only the columns needed by the model are read and the station/year
+filters are pushed down to the reader instead of filtering afterwards.
+'''
+import numpy as np
+import pandas as pd
+import LazyImports as lazy
+import FeatureEngineering as features
+
+# convert rs from W/m2 to MJ/m2day-1
+RS_FACTOR = 0.0864
+
+# columns computed from others, and the columns they need. ra is read if
+# the file has it, otherwise it is computed from latitude and doy
+DERIVED_COLUMNS = {
+    'deltat': ['tx', 'tn'],
+    'ra': ['ra', 'latitude', 'doy'],
+}
+
+# columns needed to shift a column to the previous/next day (<column>_prev,
+# <column>_next) when the file does not have it
+LAG_COLUMNS = ['station', 'year', 'month', 'day']
+LAG_SUFFIXES = ('_prev', '_next')
+
+# compact dtypes of the identification/calendar columns. They are floats
+# because they may have missing values; float32 holds these integers
+# exactly. The coordinates are kept in float64, ra is looked up by latitude
+CALENDAR_DTYPES = {
+    'station': np.float32,
+    'latitude': np.float64,
+    'longitude': np.float64,
+    'year': np.float32,
+    'month': np.float32,
+    'day': np.float32,
+    'doy': np.float32,
+}
+
+# columnar fileType -> pyarrow.dataset format
+COLUMNAR_FORMATS = {
+    'parquet': 'parquet',
+    'feather': 'ipc',
+    'arrow': 'ipc',
+}
+
+FILE_TYPES = ['csv', 'txt', 'excel'] + list(COLUMNAR_FORMATS)
+
+
+def date_keys(dfData):
+    '''
+    It returns the date of every row as an integer yyyymmdd, comparable
+    with the dates of since.
+    '''
+    return (dfData['year'].to_numpy(np.int64) * 10000 + dfData['month'].to_numpy(np.int64) * 100
+            + dfData['day'].to_numpy(np.int64))
+
+def _columnar_filter(stations=None, years=None, since=None):
+    '''
+    It builds the pyarrow expression selecting the stations, years and the
+    days of each station from its since date on.
+    '''
+    ds = lazy.import_backend('pyarrow.dataset')
+    expressions = []
+    if stations is not None:
+        expressions.append(ds.field('station').isin(list(stations)))
+    if years is not None:
+        expressions.append(ds.field('year').isin(list(years)))
+    if since:
+        # compared field by field, so the row group statistics can skip old data
+        since_expression = ~ds.field('station').isin(list(since))
+        for station, (year, month, day) in since.items():
+            year_field, month_field = ds.field('year'), ds.field('month')
+            since_expression |= (ds.field('station') == station) & (
+                (year_field > year) | ((year_field == year) & (
+                    (month_field > month) | ((month_field == month) & (ds.field('day') >= day)))))
+        expressions.append(since_expression)
+
+    expression = None
+    for other in expressions:
+        expression = other if expression is None else expression & other
+    return expression
+
+def _columnar_dataset(fileLocation, fileType, columns):
+    '''
+    It opens a columnar file and returns it with the requested columns
+    that it actually contains (None means every column).
+    '''
+    ds = lazy.import_backend('pyarrow.dataset')
+    data = ds.dataset(fileLocation, format=COLUMNAR_FORMATS[fileType])
+    if columns is not None:
+        columns = [column for column in dict.fromkeys(columns) if column in data.schema.names]
+    return data, columns
+
+def select_rows(dfData, stations=None, years=None, since=None):
+    '''
+    It keeps the rows of the stations and years given (None keeps all) and,
+    with since, the days of each station from its since date on.
+    '''
+    if stations is not None:
+        dfData = dfData[dfData['station'].isin(list(stations))]
+    if years is not None:
+        dfData = dfData[dfData['year'].isin(list(years))]
+    if since:
+        first = {station: year * 10000 + month * 100 + day for station, (year, month, day) in since.items()}
+        first = dfData['station'].map(first).to_numpy(dtype=np.float64)
+        dfData = dfData[~(date_keys(dfData) < first)]
+    return dfData
+
+def read_file(fileLocation, fileType, columns=None, stations=None, years=None, since=None, dtypes=None):
+    '''
+    It reads a dataset into a pandas Dataframe.
+
+    Input:
+        * fileLocation -> "data/dataSet.csv"
+
+        * fileType -> string with csv, txt, excel, parquet, feather or arrow
+
+        * columns -> list of columns to read, None reads every column.
+        Columns not in the file are ignored.
+
+        * stations, years -> lists of station ids/years to keep, None keeps
+        all. For the columnar files the filter is pushed down to the reader.
+
+        * since -> dict with the first date (year, month, day) to keep of
+        each station id, the rest of the stations are kept whole. It is
+        pushed down to the reader too.
+
+        * dtypes -> dict with the dtype of some columns, csv/txt files are
+        parsed straight into them. Columns not in the file are ignored.
+    '''
+    if fileType in COLUMNAR_FORMATS:
+        data, columns = _columnar_dataset(fileLocation, fileType, columns)
+        table = data.to_table(columns=columns, filter=_columnar_filter(stations, years, since))
+        return _astype(table.to_pandas(), dtypes)
+
+    if fileType == 'csv' or fileType == 'txt':
+        usecols = None if columns is None else lambda column: column in columns
+        dfData = pd.read_csv(fileLocation, usecols=usecols, dtype=dtypes)
+    elif fileType == 'excel':
+        dfData = _astype(pd.read_excel(fileLocation), dtypes)
+    else:
+        raise ValueError('this fileType does not exit, use %s instead' % ', '.join(FILE_TYPES))
+
+    if stations is not None or years is not None or since:
+        dfData = select_rows(dfData, stations, years, since).reset_index(drop=True)
+    return dfData
+
+def _astype(dfData, dtypes):
+    if not dtypes:
+        return dfData
+    return dfData.astype({column: dtype for column, dtype in dtypes.items() if column in dfData})
+
+def write_file(dfData, fileLocation, fileType):
+    '''
+    It writes a pandas Dataframe, without its index.
+
+    Input:
+        * fileType -> string with csv, txt, excel, parquet, feather or arrow
+    '''
+    if fileType == 'parquet':
+        dfData.to_parquet(fileLocation, index=False)
+    elif fileType in ('feather', 'arrow'):
+        dfData.reset_index(drop=True).to_feather(fileLocation)
+    elif fileType == 'csv' or fileType == 'txt':
+        dfData.to_csv(fileLocation, index=False)
+    elif fileType == 'excel':
+        dfData.to_excel(fileLocation, index=False)
+    else:
+        raise ValueError('this fileType does not exit, use %s instead' % ', '.join(FILE_TYPES))
+
+
+class ChunkWriter():
+    """
+    It writes a dataset chunk by chunk, so it never has to be whole in
+    memory. Every chunk must have the same columns and dtypes.
+
+    Inputs:
+        fileLocation: "data/predictions.parquet"
+        fileType: string with csv, txt, parquet, feather or arrow (excel
+            files cannot be written in chunks)
+    """
+    def __init__(self, fileLocation, fileType):
+        if fileType not in FILE_TYPES:
+            raise ValueError('this fileType does not exit, use %s instead' % ', '.join(FILE_TYPES))
+        if fileType == 'excel':
+            raise ValueError('excel files cannot be written in chunks')
+        self.fileLocation = fileLocation
+        self.fileType = fileType
+        self.rows = 0
+        self._writer = None
+
+    def write(self, dfChunk):
+        dfChunk = dfChunk.reset_index(drop=True)
+        if self.fileType in ('csv', 'txt'):
+            dfChunk.to_csv(self.fileLocation, index=False, mode='a' if self.rows else 'w',
+                           header=not self.rows)
+        else:
+            pa = lazy.import_backend('pyarrow')
+            table = pa.Table.from_pandas(dfChunk, preserve_index=False)
+            if self._writer is None:
+                if self.fileType == 'parquet':
+                    self._writer = lazy.import_backend('pyarrow.parquet').ParquetWriter(
+                        self.fileLocation, table.schema)
+                else:
+                    self._writer = pa.ipc.new_file(self.fileLocation, table.schema)
+            self._writer.write_table(table)
+        self.rows += len(dfChunk)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def add_ra(dfData):
+    '''
+    It fills the ra column (or its nan values) with the FAO-56 Ra computed
+    from latitude and doy, in place.
+    '''
+    if 'latitude' not in dfData or 'doy' not in dfData:
+        return dfData
+    if 'ra' not in dfData:
+        dfData['ra'] = features.lookup_extraterrestrial_radiation(dfData['latitude'], dfData['doy'])
+    else:
+        missing = dfData['ra'].isna().to_numpy()
+        if missing.any():
+            dfData.loc[missing, 'ra'] = features.lookup_extraterrestrial_radiation(
+                dfData['latitude'][missing], dfData['doy'][missing])
+    return dfData
+
+def is_lag_parameter(parameter):
+    return parameter.endswith(LAG_SUFFIXES)
+
+def add_lag_columns(dfData, parameters):
+    '''
+    It builds the previous/next day parameters (tx_prev, tn_prev, tn_next,
+    ...) missing in the dataset, grouped by station and aware of calendar
+    gaps (see FeatureEngineering.add_lag_features).
+    '''
+    missing = [p for p in parameters if is_lag_parameter(p) and p not in dfData and p[:-5] in dfData]
+    if not missing or not all(column in dfData for column in ['year', 'month', 'day']):
+        return dfData
+    return features.add_lag_features(
+        dfData,
+        prev_columns=[p[:-5] for p in missing if p.endswith('_prev')],
+        next_columns=[p[:-5] for p in missing if p.endswith('_next')])
+
+def add_derived_columns(dfData, parameters=()):
+    '''
+    It defines deltat, fills ra when missing, converts rs from W/m2 to
+    MJ/m2day-1 and builds the previous/next day parameters missing, in place.
+    '''
+    if 'tx' in dfData and 'tn' in dfData:
+        dfData["deltat"] = dfData['tx'] - dfData['tn']
+    add_ra(dfData)
+    if 'rs' in dfData:
+        dfData["rs"] = dfData['rs'] * RS_FACTOR
+    return add_lag_columns(dfData, parameters)
+
+def filter_parameters(dfData, parameters):
+    '''
+    It keeps the parameters, in that order, and filters the rows with nan
+    values in them (nan values in other columns do not drop the row).
+    '''
+    dfData = dfData.filter(parameters).dropna()
+    return dfData.reset_index(drop=True)
+
+def import_dataset(fileLocation, fileType, parameters, stations=None, years=None, dtype=None):
+    '''
+    It imports a dataset and leaves it ready for a station model: deltat
+    defined, ra and the previous/next day parameters built when missing,
+    rs in MJ/m2day-1, only the parameters and rows with nan values in them
+    filtered. Several stations can be in the same dataset.
+
+    With dtype=np.float32 the measured columns are parsed (or cast, for the
+    columnar files) straight to float32 and the parameters are returned in
+    float32, with half the memory of the float64 pandas defaults.
+
+    Input:
+        * fileLocation -> "data/dataSet.csv"
+
+        * fileType -> string with csv, txt, excel, parquet, feather or arrow
+
+        * parameters -> list with the input configuration of the model
+        (being rs the predicted value)
+
+        * stations, years -> lists of station ids/years to keep, None keeps all
+
+        * dtype -> dtype of the parameters, None keeps the pandas defaults
+
+    Output:
+        * dfData -> pandas Dataframe with the parameters as columns
+    '''
+    # columnar files are projected on the columns the model needs
+    columns = source_columns(parameters) if fileType in COLUMNAR_FORMATS else None
+    dtypes = None
+    if dtype is not None:
+        dtypes = {column: CALENDAR_DTYPES.get(column, dtype) for column in source_columns(parameters)}
+    dfData = read_file(fileLocation, fileType, columns, stations, years, dtypes=dtypes)
+    dfData = add_derived_columns(dfData, parameters)
+    dfData = filter_parameters(dfData, parameters)
+    return dfData if dtype is None else dfData.astype(dtype)
+
+def export_predictions(dfData, y_pred, fileLocation, fileType):
+    '''
+    It writes the inputs of the model and the predicted rs (rs_pred).
+    '''
+    dfOutput = dfData.reset_index(drop=True)
+    dfOutput['rs_pred'] = np.ravel(y_pred)
+    write_file(dfOutput, fileLocation, fileType)
+
+def source_columns(parameters):
+    '''
+    It returns the columns to read from the file to build the parameters,
+    replacing the derived columns by the ones they are computed from.
+    '''
+    columns = []
+    for parameter in parameters:
+        if is_lag_parameter(parameter):
+            sources = [parameter, parameter[:-5]] + LAG_COLUMNS
+        else:
+            sources = DERIVED_COLUMNS.get(parameter, [parameter])
+        for column in sources:
+            if column not in columns:
+                columns.append(column)
+    return columns
+
+def _read_chunks(fileLocation, fileType, columns, chunksize, dtypes, stations, years):
+    '''
+    It yields the raw chunks of a csv/txt or columnar file.
+    '''
+    if fileType in COLUMNAR_FORMATS:
+        data, columns = _columnar_dataset(fileLocation, fileType, columns)
+        batches = data.to_batches(columns=columns, filter=_columnar_filter(stations, years),
+                                  batch_size=chunksize)
+        dtypes = {column: dtypes[column] for column in columns}
+        for batch in batches:
+            yield batch.to_pandas().astype(dtypes)
+        return
+
+    if fileType not in ('csv', 'txt'):
+        raise ValueError('excel files cannot be imported in chunks')
+
+    if stations is not None and 'station' not in columns:
+        columns = columns + ['station']
+    if years is not None and 'year' not in columns:
+        columns = columns + ['year']
+    reader = pd.read_csv(fileLocation, usecols=lambda column: column in columns, dtype=dtypes,
+                         chunksize=chunksize)
+    with reader:
+        for dfChunk in reader:
+            yield select_rows(dfChunk, stations, years)
+
+def _prepare_chunk(dfChunk, parameters, first_row, last_row, dtype):
+    '''
+    It prepares a chunk and keeps the rows numbered from first_row to
+    last_row, the rest are only there as previous/next day of those.
+    '''
+    dfChunk = add_derived_columns(dfChunk, parameters)
+    row = dfChunk['_row'].to_numpy()
+    dfChunk = dfChunk[(row >= first_row) & (row <= last_row)]
+    # the columns computed from others (ra) may come in float64
+    return filter_parameters(dfChunk, parameters).astype(dtype)
+
+def import_dataset_chunks(fileLocation, fileType, parameters, chunksize=100000, dtype=np.float64,
+                          stations=None, years=None):
+    '''
+    It imports a dataset in chunks of rows. Only the columns needed by the
+    parameters are parsed, with explicit dtypes, and every chunk gets the
+    same preparation as import_dataset, so memory is bounded by the chunk
+    size instead of the file size.
+
+    When the previous/next day parameters have to be built, the last two
+    rows of each chunk are carried over to the next one, so the days at
+    the chunk boundaries get them too. This needs the rows of each station
+    together and sorted by date, as in the USCRN files.
+
+    Input:
+        * fileLocation -> "data/dataSet.csv"
+
+        * fileType -> string with csv, txt, parquet, feather or arrow
+        (excel cannot be read in chunks)
+
+        * parameters -> list with the input configuration of the model
+
+        * chunksize -> number of rows read at a time
+
+        * dtype -> dtype of the numeric columns, float64 by default as in
+        import_dataset. The data are given with one or two decimals, so
+        np.float32 is exact enough and takes half the memory.
+
+        * stations, years -> lists of station ids/years to keep, None keeps all
+
+    Output:
+        * generator of pandas Dataframes with the parameters as columns
+    '''
+    columns = source_columns(parameters)
+    dtypes = {column: CALENDAR_DTYPES.get(column, dtype) for column in columns}
+    lags = any(is_lag_parameter(parameter) for parameter in parameters)
+
+    carry = None
+    n_rows = 0
+    next_row = 0
+    for dfChunk in _read_chunks(fileLocation, fileType, columns, chunksize, dtypes, stations, years):
+        dfChunk['_row'] = np.arange(n_rows, n_rows + len(dfChunk))
+        n_rows += len(dfChunk)
+        if carry is not None:
+            dfChunk = pd.concat([carry, dfChunk], ignore_index=True)
+
+        # the last row waits for its next day, the one before is its previous day
+        last_row = n_rows - 2 if lags else n_rows - 1
+        if lags:
+            carry = dfChunk.iloc[-2:].copy()
+
+        dfChunk = _prepare_chunk(dfChunk, parameters, next_row, last_row, dtype)
+        next_row = last_row + 1
+        if len(dfChunk):
+            yield dfChunk
+
+    if carry is not None and next_row < n_rows:
+        dfChunk = _prepare_chunk(carry, parameters, next_row, n_rows - 1, dtype)
+        if len(dfChunk):
+            yield dfChunk
@@ -0,0 +1,145 @@
+'''
+Run several station models over the same dataset in a single pass.
+
+The dataset is read and prepared once for the union of the inputs of all
+the models, and turned into a single float matrix. Each model then takes
+its columns (and the rows where they are all available) from that matrix,
+standardizes them in place and predicts through its station class. The
+result is a wide table with one prediction column per model.
+
+Usage:
+    python EnsembleRunner.py
+'''
+import numpy as np
+import pandas as pd
+import StatsFunctions as stats
+import ModelRegistry as registry
+import DatasetFunctions as dataset
+
+# columns identifying each row, copied to the output when they exist
+ID_COLUMNS = ['station', 'latitude', 'longitude', 'year', 'month', 'day', 'doy']
+
+
+def union_parameters(stations):
+    '''
+    It returns the inputs needed by any of the stations, in order of
+    appearance, followed by rs.
+    '''
+    inputs = []
+    for station in stations:
+        for parameter in registry.get_parameters(station)[:-1]:
+            if parameter not in inputs:
+                inputs.append(parameter)
+    return inputs + ['rs']
+
+def import_inputs(fileLocation, fileType, stations, years=None, station_ids=None, extra_columns=(),
+                  since=None):
+    '''
+    It imports and prepares the dataset once for the union of the inputs of
+    the stations (since as in DatasetFunctions.read_file).
+
+    Output:
+        * dfData -> the prepared pandas Dataframe
+
+        * inputs -> float matrix with the union of the inputs, the only
+        full copy of them, shared by every model
+
+        * position -> dict with the column of each input in the matrix
+    '''
+    parameters = union_parameters(stations)
+    columns = dataset.source_columns(parameters) + ID_COLUMNS + list(extra_columns)
+    dfData = dataset.read_file(fileLocation, fileType, columns, station_ids, years, since)
+    dfData = dataset.add_derived_columns(dfData, parameters).reset_index(drop=True)
+
+    inputs = dfData.reindex(columns=parameters[:-1]).to_numpy(dtype=np.float64)
+    position = {parameter: i for i, parameter in enumerate(parameters[:-1])}
+    return dfData, inputs, position
+
+def predict_rows(station, inputs, position, rows=None):
+    '''
+    It predicts rs with a station class over some rows of the inputs matrix.
+
+    Input:
+        * station -> station code of the model
+
+        * inputs, position -> as returned by import_inputs
+
+        * rows -> array with the rows to predict, by default all of them
+
+    Output:
+        * y_pred -> array with a value per row, nan where any input of the
+        model is missing
+    '''
+    mlModel = registry.get_class(station)()
+    columns = [position[parameter] for parameter in mlModel.parameters[:-1]]
+    if rows is None:
+        rows = np.arange(len(inputs))
+
+    # one gather of the rows/columns of this model, standardized in place
+    mean, std = registry.get_scaler(station)
+    mlModel.x_test = inputs[np.ix_(rows, columns)]
+    valid = ~np.isnan(mlModel.x_test).any(axis=1)
+    if not valid.all():
+        mlModel.x_test = mlModel.x_test[valid]
+    mlModel.x_test -= mean
+    mlModel.x_test /= std
+
+    y_pred = np.full(len(rows), np.nan)
+    if valid.any():
+        y_pred[valid] = np.ravel(mlModel.predictValues())
+    return y_pred
+
+def run_ensemble(fileLocation, fileType, stations=None, years=None, station_ids=None):
+    '''
+    It predicts rs with several station models importing the dataset once.
+
+    Input:
+        * fileLocation -> "data/dataSet.csv"
+
+        * fileType -> string with csv, txt, excel, parquet, feather or arrow
+
+        * stations -> list of station models (e.g. ['cor06', 'mag01']). By
+        default every model available in models/.
+
+        * years, station_ids -> optional lists of years/station ids of the
+        dataset to keep
+
+    Output:
+        * dfPredictions -> pandas Dataframe with the id columns, rs and a
+        rs_<station> column per model. A model gets nan in the rows where
+        any of its inputs is missing.
+    '''
+    if stations is None:
+        stations = registry.available_stations()
+    dfData, inputs, position = import_inputs(fileLocation, fileType, stations, years, station_ids)
+
+    dfPredictions = dfData[[c for c in ID_COLUMNS if c in dfData]].copy()
+    dfPredictions['rs'] = dfData['rs'].to_numpy() if 'rs' in dfData else np.nan
+    for station in stations:
+        dfPredictions['rs_' + station] = predict_rows(station, inputs, position)
+    return dfPredictions
+
+def ensemble_metrics(dfPredictions):
+    '''
+    It calculates the metrics of every model of the ensemble against the
+    measured rs, over the rows where both are available.
+
+    Output:
+        * dfMetrics -> pandas Dataframe with a row per model and the
+        metrics of StatsFunctions.compute_all_metrics as columns
+    '''
+    rs = dfPredictions['rs'].to_numpy(dtype=np.float64)
+    metrics = {}
+    for column in dfPredictions.columns:
+        if column.startswith('rs_'):
+            y_pred = dfPredictions[column].to_numpy(dtype=np.float64)
+            valid = ~(np.isnan(rs) | np.isnan(y_pred))
+            if valid.any():
+                metrics[column[3:]] = stats.compute_all_metrics(rs[valid], y_pred[valid])
+    return pd.DataFrame.from_dict(metrics, orient='index')
+
+
+if __name__ == '__main__':
+    dfPredictions = run_ensemble("data/ncei-asheville-example.csv", 'csv')
+    print(dfPredictions)
+    print(ensemble_metrics(dfPredictions))
@@ -0,0 +1,279 @@
+'''
+Daily features of the models built from the raw USCRN files.
+
+All data from the stations can be downloaded from:
+ftp://ftp.ncei.noaa.gov/pub/data/uscrn/products/
+
+The hourly (hourly02) and subhourly (subhourly01) products are whitespace
+separated fixed-width text files without header. This module reads them
+and turns them into the daily table used by the models (the same columns
+as data/ncei-asheville-example.csv plus tn_next and precipitation).
+Everything is done with grouped pandas/NumPy operations over the whole
+network at once, there is no loop over days or stations.
+
+Example:
+    dfDaily = build_daily_dataset(glob.glob("CRNH0203-2018-*.txt"))
+'''
+import functools
+import numpy as np
+import pandas as pd
+
+HOURLY_COLUMNS = [
+    'WBANNO', 'UTC_DATE', 'UTC_TIME', 'LST_DATE', 'LST_TIME', 'CRX_VN', 'LONGITUDE', 'LATITUDE',
+    'T_CALC', 'T_HR_AVG', 'T_MAX', 'T_MIN', 'P_CALC', 'SOLARAD', 'SOLARAD_FLAG', 'SOLARAD_MAX',
+    'SOLARAD_MAX_FLAG', 'SOLARAD_MIN', 'SOLARAD_MIN_FLAG', 'SUR_TEMP_TYPE', 'SUR_TEMP',
+    'SUR_TEMP_FLAG', 'SUR_TEMP_MAX', 'SUR_TEMP_MAX_FLAG', 'SUR_TEMP_MIN', 'SUR_TEMP_MIN_FLAG',
+    'RH_HR_AVG', 'RH_HR_AVG_FLAG', 'SOIL_MOISTURE_5', 'SOIL_MOISTURE_10', 'SOIL_MOISTURE_20',
+    'SOIL_MOISTURE_50', 'SOIL_MOISTURE_100', 'SOIL_TEMP_5', 'SOIL_TEMP_10', 'SOIL_TEMP_20',
+    'SOIL_TEMP_50', 'SOIL_TEMP_100',
+]
+
+SUBHOURLY_COLUMNS = [
+    'WBANNO', 'UTC_DATE', 'UTC_TIME', 'LST_DATE', 'LST_TIME', 'CRX_VN', 'LONGITUDE', 'LATITUDE',
+    'AIR_TEMPERATURE', 'PRECIPITATION', 'SOLAR_RADIATION', 'SR_FLAG', 'SURFACE_TEMPERATURE',
+    'ST_TYPE', 'ST_FLAG', 'RELATIVE_HUMIDITY', 'RH_FLAG', 'SOIL_MOISTURE_5', 'SOIL_TEMPERATURE_5',
+    'WETNESS', 'WET_FLAG', 'WIND_1_5', 'WIND_FLAG',
+]
+
+# product -> (file columns, columns read -> internal names, records per day)
+PRODUCTS = {
+    'hourly': (HOURLY_COLUMNS, {
+        'WBANNO': 'station', 'LST_DATE': 'date', 'LST_TIME': 'time', 'LONGITUDE': 'longitude',
+        'LATITUDE': 'latitude', 'T_HR_AVG': 'temp', 'T_MAX': 'temp_max', 'T_MIN': 'temp_min',
+        'P_CALC': 'precipitation', 'SOLARAD': 'rs',
+    }, 24),
+    'subhourly': (SUBHOURLY_COLUMNS, {
+        'WBANNO': 'station', 'LST_DATE': 'date', 'LST_TIME': 'time', 'LONGITUDE': 'longitude',
+        'LATITUDE': 'latitude', 'AIR_TEMPERATURE': 'temp', 'PRECIPITATION': 'precipitation',
+        'SOLAR_RADIATION': 'rs',
+    }, 288),
+}
+
+# missing values used by USCRN
+MISSING_VALUES = [-9999.0, -99.0]
+
+# solar constant, MJ m-2 min-1 (FAO-56)
+SOLAR_CONSTANT = 0.0820
+
+# columns of the daily table, as in data/ncei-asheville-example.csv plus
+# tn_next and the daily precipitation (mm), used to get the aridity index
+DAILY_COLUMNS = [
+    'station', 'latitude', 'longitude', 'year', 'month', 'day', 'doy', 'tx', 'tn', 'rs',
+    'energyt', 'hormin_tx', 'hormin_tn', 'ra', 'tx_prev', 'tn_prev', 'hormin_tx_prev',
+    'hormin_tn_prev', 'energyt_prev', 'tn_next', 'precipitation',
+]
+
+
+def extraterrestrial_radiation(latitude, doy):
+    '''
+    It calculates the daily extraterrestrial radiation (Ra) with the FAO-56
+    equations, vectorized over latitude and day of the year.
+
+    Input:
+        * latitude -> float or array with the latitude in degrees
+
+        * doy -> int or array with the day of the year (1-366)
+
+    Output:
+        * ra -> array with Ra in MJ/m2day-1
+    '''
+    phi = np.radians(np.asarray(latitude, dtype=np.float64))
+    angle = 2 * np.pi * np.asarray(doy, dtype=np.float64) / 365
+    # inverse relative distance Earth-Sun and solar declination
+    dr = 1 + 0.033 * np.cos(angle)
+    delta = 0.409 * np.sin(angle - 1.39)
+    # sunset hour angle, clipped for the polar day/night
+    omega = np.arccos(np.clip(-np.tan(phi) * np.tan(delta), -1, 1))
+    return 24 * 60 / np.pi * SOLAR_CONSTANT * dr * (
+        omega * np.sin(phi) * np.sin(delta) + np.cos(phi) * np.cos(delta) * np.sin(omega))
+
+@functools.lru_cache(maxsize=4096)
+def ra_table(latitude):
+    '''
+    It returns the Ra of every day of the year at a latitude, as a
+    read-only array indexed by doy (position 0 is not used). Ra only
+    depends on latitude and doy, so the table is computed once per
+    latitude and cached.
+    '''
+    table = extraterrestrial_radiation(latitude, np.arange(367))
+    table[0] = np.nan
+    table.flags.writeable = False
+    return table
+
+def lookup_extraterrestrial_radiation(latitude, doy):
+    '''
+    Same as extraterrestrial_radiation, but looking up the cached table of
+    each unique latitude, so a multi-year job does a table lookup per row
+    instead of the trigonometry.
+
+    Input:
+        * latitude -> float or array with the latitude in degrees
+
+        * doy -> int or array with the day of the year (1-366)
+
+    Output:
+        * ra -> array with Ra in MJ/m2day-1, nan where the latitude is not
+        finite or the doy is nan or out of 1-366
+    '''
+    latitude, doy = np.broadcast_arrays(np.asarray(latitude, dtype=np.float64),
+                                        np.asarray(doy, dtype=np.float64))
+    # factorize gives nan the position -1, which would index the last table
+    position, latitudes = pd.factorize(np.where(np.isfinite(latitude), latitude, np.nan).ravel())
+    position = position.reshape(latitude.shape)
+    with np.errstate(invalid='ignore'):
+        valid = (position >= 0) & (doy >= 1) & (doy <= 366) & (doy == np.floor(doy))
+    ra = np.full(latitude.shape, np.nan)
+    if valid.any():
+        tables = np.stack([ra_table(float(value)) for value in latitudes])
+        ra[valid] = tables[position[valid], doy[valid].astype(np.int64)]
+    return ra
+
+def add_lag_features(dfData, prev_columns=(), next_columns=()):
+    '''
+    It adds the value of the previous day (<column>_prev) and of the next
+    day (<column>_next) of each station. The values are shifted once over
+    the whole table sorted by station and date; a value is only used if it
+    belongs to the same station and to the consecutive calendar day, so
+    gaps in the records give nan instead of a wrong day. The rows keep
+    their original order.
+
+    Input:
+        * dfData -> pandas Dataframe with year, month and day columns, and
+        station when there are several stations
+
+        * prev_columns, next_columns -> lists of columns to shift
+
+    Output:
+        * dfData -> the Dataframe with the new columns, added in place
+    '''
+    days = pd.to_datetime(dfData[['year', 'month', 'day']]).to_numpy().astype('datetime64[D]').astype(np.int64)
+    if 'station' in dfData:
+        station = dfData['station'].to_numpy()
+        order = np.lexsort([days, station])
+        station = station[order]
+        same_station = station[1:] == station[:-1]
+    else:
+        order = np.argsort(days, kind='stable')
+        same_station = True
+    # consecutive[i] tells whether the sorted row i+1 is the day after row i
+    consecutive = same_station & (np.diff(days[order]) == 1)
+
+    for column in prev_columns:
+        values = dfData[column].to_numpy(dtype=np.float64)[order]
+        shifted = np.full(len(values), np.nan)
+        shifted[1:] = np.where(consecutive, values[:-1], np.nan)
+        dfData[column + '_prev'] = _unsort(shifted, order)
+    for column in next_columns:
+        values = dfData[column].to_numpy(dtype=np.float64)[order]
+        shifted = np.full(len(values), np.nan)
+        shifted[:-1] = np.where(consecutive, values[1:], np.nan)
+        dfData[column + '_next'] = _unsort(shifted, order)
+    return dfData
+
+def _unsort(values, order):
+    '''
+    It puts back in the original row order values computed on rows sorted by order.
+    '''
+    result = np.empty_like(values)
+    result[order] = values
+    return result
+
+def read_uscrn(fileLocation, product='hourly'):
+    '''
+    It reads a raw USCRN file, keeping only the columns used by the
+    features (with internal names) and replacing missing values by nan.
+
+    Input:
+        * fileLocation -> "CRNH0203-2018-NC_Asheville_8_SSW.txt"
+
+        * product -> string with hourly or subhourly
+    '''
+    names, columns, _ = PRODUCTS[product]
+    dtypes = {column: np.float64 for column in columns}
+    dtypes.update({'WBANNO': np.int32, 'LST_DATE': np.int32, 'LST_TIME': np.int16})
+    dfRaw = pd.read_csv(fileLocation, sep=r'\s+', header=None, names=names, usecols=list(columns),
+                        dtype=dtypes, na_values=MISSING_VALUES)
+    return dfRaw.rename(columns=columns)
+
+def daily_features(dfRaw, product='hourly', min_coverage=0.75):
+    '''
+    It aggregates the raw records of one or several stations into daily
+    features, grouping by station and local standard date:
+        * tx, tn -> maximum and minimum temperature
+        * hormin_tx, hormin_tn -> local hour (hh + mm/60) of tx and tn
+        * energyt -> sum of the hourly temperatures (mean temperature x 24)
+        * rs -> mean solar radiation in W/m2, as in the example dataset
+        * precipitation -> total precipitation in mm, nan when every
+        record of the day is missing
+        * ra -> extraterrestrial radiation
+    plus the previous day values and tn_next, computed per station.
+
+    Input:
+        * dfRaw -> pandas Dataframe returned by read_uscrn
+
+        * product -> string with hourly or subhourly
+
+        * min_coverage -> fraction of valid records required in a day,
+        days below it get nan features
+
+    Output:
+        * dfDaily -> pandas Dataframe with DAILY_COLUMNS
+    '''
+    _, _, records_per_day = PRODUCTS[product]
+    dfRaw = dfRaw.reset_index(drop=True)
+    if 'temp_max' not in dfRaw:
+        dfRaw['temp_max'] = dfRaw['temp']
+        dfRaw['temp_min'] = dfRaw['temp']
+    dfRaw['hour'] = dfRaw['time'] // 100 + (dfRaw['time'] % 100) / 60
+
+    keys = ['station', 'date']
+    grouped = dfRaw.groupby(keys, sort=True)
+    dfDaily = grouped.agg(
+        latitude=('latitude', 'first'), longitude=('longitude', 'first'),
+        tx=('temp_max', 'max'), tn=('temp_min', 'min'), temp=('temp', 'mean'),
+        records=('temp', 'count'), rs=('rs', 'mean'))
+    # nan, not 0 mm, when every record of the day is missing
+    dfDaily['precipitation'] = grouped['precipitation'].sum(min_count=1)
+
+    # hour of the extremes, from the row holding each one
+    hour = dfRaw['hour'].to_numpy()
+    for column, feature, function in [('temp_max', 'hormin_tx', 'idxmax'), ('temp_min', 'hormin_tn', 'idxmin')]:
+        valid = dfRaw[keys + [column]].dropna()
+        index = getattr(valid.groupby(keys, sort=True)[column], function)()
+        dfDaily[feature] = pd.Series(hour[index.to_numpy()], index=index.index)
+
+    dfDaily['energyt'] = dfDaily['temp'] * 24
+    incomplete = dfDaily['records'] < min_coverage * records_per_day
+    dfDaily.loc[incomplete, ['tx', 'tn', 'energyt', 'hormin_tx', 'hormin_tn', 'rs', 'precipitation']] = np.nan
+    dfDaily = dfDaily.reset_index()
+
+    date = dfDaily['date'].to_numpy()
+    dfDaily['year'] = date // 10000
+    dfDaily['month'] = date // 100 % 100
+    dfDaily['day'] = date % 100
+    dfDaily['doy'] = pd.to_datetime(dfDaily[['year', 'month', 'day']]).dt.dayofyear
+    dfDaily['ra'] = lookup_extraterrestrial_radiation(dfDaily['latitude'], dfDaily['doy'])
+
+    dfDaily = add_lag_features(
+        dfDaily, prev_columns=['tx', 'tn', 'hormin_tx', 'hormin_tn', 'energyt'], next_columns=['tn'])
+    return dfDaily[DAILY_COLUMNS]
+
+def build_daily_dataset(fileLocations, product='hourly', min_coverage=0.75):
+    '''
+    It reads several raw USCRN files (years and/or stations) and builds the
+    daily table of all of them in a single grouped pass.
+
+    Input:
+        * fileLocations -> list of paths of the raw files
+
+        * product -> string with hourly or subhourly
+
+    Output:
+        * dfDaily -> pandas Dataframe with DAILY_COLUMNS, sorted by station
+        and date
+    '''
+    if isinstance(fileLocations, str):
+        fileLocations = [fileLocations]
+    dfRaw = pd.concat([read_uscrn(fileLocation, product) for fileLocation in fileLocations],
+                      ignore_index=True)
+    return daily_features(dfRaw, product, min_coverage)
@@ -0,0 +1,195 @@
+'''
+Incremental daily scoring.
+
+The production feed adds one day per station every day, so re-reading and
+re-predicting the whole history each time is wasted work. The results
+store keeps, for every model and station id, a watermark: the last day
+scored. A run only reads the days from the watermark on (pushed down to
+the reader for parquet/feather/arrow files), predicts the days after it
+and appends their predictions to the store as a new part file, so the
+daily cost grows with the new rows and not with the history.
+
+The day of the watermark itself is read again as the previous day of the
+first new one (tx_prev, tn_prev, ...). A day whose next day has not
+arrived yet has no tn_next, so it is not scored and the watermark stays
+before it; it is scored in the run that brings its next day.
+
+The predictions are appended before the watermarks are moved. If a run
+is interrupted in between, the next one scores the same days again and
+read_results keeps the last prediction of each model, station and day.
+
+Usage:
+    python IncrementalRunner.py data/feed.parquet results/ [--type parquet]
+'''
+import argparse
+import glob
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+import ModelRegistry as registry
+import DatasetFunctions as dataset
+import EnsembleRunner as ensemble
+
+# columns of the results
+RESULT_COLUMNS = ['model', 'station', 'year', 'month', 'day', 'rs', 'rs_pred']
+
+
+def _date(key):
+    key = int(key)
+    return key // 10000, key // 100 % 100, key % 100
+
+
+def since_dates(watermarks, stations):
+    '''
+    It returns {station id: (year, month, day)} with the first day to read
+    of each station id: the earliest watermark of the models, which is read
+    again as the previous day of the first new one. A station id is read
+    whole (it is left out) when any of the models has no watermark for it.
+    '''
+    station_ids = set()
+    for station in stations:
+        station_ids.update(watermarks.get(station, {}))
+    since = {}
+    for station_id in station_ids:
+        dates = [watermarks.get(station, {}).get(station_id) for station in stations]
+        if all(date is not None for date in dates):
+            since[station_id] = min(dates)
+    return since
+
+
+class ResultsStore():
+    """
+    Folder with the predictions appended by every run (one parquet file
+    per run) and the watermark of each model and station id.
+
+    Inputs:
+        folder: folder of the store, created if it does not exist
+    """
+    WATERMARKS = 'watermarks.json'
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def watermarks(self):
+        '''
+        It returns {model: {station id: (year, month, day)}} with the last
+        day scored.
+        '''
+        filename = os.path.join(self.folder, self.WATERMARKS)
+        if not os.path.exists(filename):
+            return {}
+        with open(filename) as file:
+            data = json.load(file)
+        return {model: {int(station): tuple(date) for station, date in stations.items()}
+                for model, stations in data.items()}
+
+    def set_watermarks(self, watermarks):
+        '''
+        It writes the watermarks, replacing the file at once.
+        '''
+        filename = os.path.join(self.folder, self.WATERMARKS)
+        data = {model: {str(station): list(date) for station, date in stations.items()}
+                for model, stations in watermarks.items()}
+        with open(filename + '.tmp', 'w') as file:
+            json.dump(data, file, indent=1, sort_keys=True)
+        os.replace(filename + '.tmp', filename)
+
+    def append(self, dfResults):
+        '''
+        It writes the predictions of a run as a new part file.
+        '''
+        filename = os.path.join(self.folder, 'part-%d.parquet' % time.time_ns())
+        dataset.write_file(dfResults, filename, 'parquet')
+        return filename
+
+    def read_results(self):
+        '''
+        It reads every prediction of the store, the last one of each model,
+        station and day when a day was scored twice.
+        '''
+        filenames = sorted(glob.glob(os.path.join(self.folder, 'part-*.parquet')))
+        if not filenames:
+            return pd.DataFrame(columns=RESULT_COLUMNS)
+        dfResults = pd.concat([dataset.read_file(f, 'parquet') for f in filenames], ignore_index=True)
+        dfResults = dfResults.drop_duplicates(['model', 'station', 'year', 'month', 'day'], keep='last')
+        return dfResults.reset_index(drop=True)
+
+
+def run_incremental(fileLocation, fileType, store, stations=None, station_ids=None):
+    '''
+    It predicts rs for the days after the watermark of each model and
+    station id, appends them to the store and moves the watermarks.
+
+    Input:
+        * fileLocation -> "data/feed.parquet", with the whole history or
+        only the latest days (from the watermark day on)
+
+        * fileType -> string with csv, txt, excel, parquet, feather or arrow
+
+        * store -> ResultsStore or folder of the store
+
+        * stations -> list of station models. By default every model
+        available in models/.
+
+        * station_ids -> optional list of station ids of the dataset to keep
+
+    Output:
+        * dfResults -> pandas Dataframe with the predictions appended
+        (model, station, year, month, day, rs, rs_pred)
+    '''
+    if not isinstance(store, ResultsStore):
+        store = ResultsStore(store)
+    if stations is None:
+        stations = registry.available_stations()
+    watermarks = store.watermarks()
+
+    since = since_dates(watermarks, stations)
+    dfData, inputs, position = ensemble.import_inputs(fileLocation, fileType, stations,
+                                                      station_ids=station_ids, since=since)
+    days = dataset.date_keys(dfData)
+    station_id = dfData['station'].to_numpy()
+
+    results = []
+    for station in stations:
+        # only the days after the watermark of this model
+        last = {s: year * 10000 + month * 100 + day
+                for s, (year, month, day) in watermarks.get(station, {}).items()}
+        last = pd.Series(station_id).map(last).to_numpy(dtype=np.float64)
+        rows = np.flatnonzero(~(days <= last))
+        y_pred = ensemble.predict_rows(station, inputs, position, rows)
+        scored = ~np.isnan(y_pred)
+        if not scored.any():
+            continue
+
+        dfModel = dfData.iloc[rows[scored]][['station', 'year', 'month', 'day']].copy()
+        dfModel.insert(0, 'model', station)
+        dfModel['rs'] = dfData['rs'].to_numpy()[rows[scored]] if 'rs' in dfData else np.nan
+        dfModel['rs_pred'] = y_pred[scored]
+        results.append(dfModel)
+
+        # last day scored of each station id
+        latest = pd.Series(days[rows[scored]]).groupby(station_id[rows[scored]]).max()
+        watermarks.setdefault(station, {}).update({int(s): _date(key) for s, key in latest.items()})
+
+    if not results:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    dfResults = pd.concat(results, ignore_index=True)
+    store.append(dfResults)
+    store.set_watermarks(watermarks)
+    return dfResults
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('file', help='dataset with the new days')
+    parser.add_argument('store', help='folder of the results store')
+    parser.add_argument('--type', default='csv', help='csv, txt, excel, parquet, feather or arrow')
+    parser.add_argument('--stations', nargs='+', help='station models, by default all')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    dfResults = run_incremental(args.file, args.type, args.store, args.stations)
+    print('%d predictions appended in %.2f s' % (len(dfResults), time.perf_counter() - start))
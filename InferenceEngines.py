@@ -0,0 +1,568 @@
+'''
+Inference engines written with NumPy only.
+
+The MLP models are small dense networks, so running them through
+keras.Model.predict costs far more than the maths itself and needs the
+whole TensorFlow runtime. The weights are exported once from the .h5
+files to .npz files stored next to them in models/, and NumpyMLP runs the
+forward pass with a few matrix products.
+
+The XGBoost model is run from its booster with inplace_predict on float32
+C-contiguous arrays, so no DMatrix is built for each call. For the lowest
+latency on a few rows, its trees can also be compiled to flat NumPy
+arrays (NumpyTrees), evaluated level by level for all the trees at once
+and stored in a .npz file too.
+
+The RBF SVR model is run with NumpySVR from its support vectors, dual
+coefficients and gamma, exported once from the pickled scikit-learn model.
+The kernel is evaluated in blocks of rows with float32 matrix products.
+The ELM model is run with NumpyELM from the hidden neurons and output
+weights of its hpelm file, so hpelm is not needed either.
+
+To export the MLP, SVR, ELM (and XGBoost) models:
+    python InferenceEngines.py
+'''
+import json
+import numpy as np
+import LazyImports as lazy
+
+ACTIVATIONS = {
+    'linear': lambda h: h,
+    'relu': lambda h: np.maximum(h, 0, out=h),
+    'sigmoid': lambda h: np.divide(1, 1 + np.exp(-h, out=h), out=h),
+    'tanh': lambda h: np.tanh(h, out=h),
+    'softplus': lambda h: np.logaddexp(0, h, out=h),
+    'elu': lambda h: np.where(h > 0, h, np.expm1(np.minimum(h, 0))),
+}
+
+
+class NumpyMLP():
+    """
+    Forward pass of a Keras Sequential model made of Dense layers.
+
+    As Keras does, it computes in float32 unless another dtype is given.
+    predict returns a (rows, units) array, the same shape as keras predict.
+    """
+    def __init__(self, kernels, biases, activations, dtype=np.float32):
+        if not len(kernels) == len(biases) == len(activations):
+            raise ValueError('there must be a kernel, a bias and an activation per layer')
+        for activation in activations:
+            if activation not in ACTIVATIONS:
+                raise ValueError('activation %r is not supported, use one of %s'
+                                 % (activation, sorted(ACTIVATIONS)))
+
+        self.dtype = np.dtype(dtype)
+        self.kernels = [np.ascontiguousarray(k, dtype=self.dtype) for k in kernels]
+        self.biases = [np.ascontiguousarray(b, dtype=self.dtype) for b in biases]
+        self.activations = list(activations)
+
+    @classmethod
+    def load(cls, filename, dtype=np.float32):
+        """
+        It loads the weights exported by export_keras_mlp.
+        """
+        with np.load(filename, allow_pickle=False) as data:
+            activations = [str(a) for a in data['activations']]
+            kernels = [data['kernel_%d' % i] for i in range(len(activations))]
+            biases = [data['bias_%d' % i] for i in range(len(activations))]
+        return cls(kernels, biases, activations, dtype=dtype)
+
+    def save(self, filename):
+        arrays = {'activations': np.array(self.activations)}
+        for i, (kernel, bias) in enumerate(zip(self.kernels, self.biases)):
+            arrays['kernel_%d' % i] = kernel
+            arrays['bias_%d' % i] = bias
+        np.savez(filename, **arrays)
+
+    @property
+    def n_inputs(self):
+        return self.kernels[0].shape[0]
+
+    def fold_scaler(self, mean, std):
+        """
+        It returns a new model with the standardization (x - mean) / std
+        folded into the first layer, so it takes the raw inputs:
+            W' = W / std[:, None]
+            b' = b - (mean / std) @ W
+        """
+        mean = np.asarray(mean, dtype=np.float64)
+        std = np.asarray(std, dtype=np.float64)
+        kernel = self.kernels[0].astype(np.float64)
+
+        kernels = [kernel / std[:, None]] + self.kernels[1:]
+        biases = [self.biases[0] - (mean / std) @ kernel] + self.biases[1:]
+        return NumpyMLP(kernels, biases, self.activations, dtype=self.dtype)
+
+    def predict(self, x):
+        """
+        It runs the forward pass over a (rows, inputs) array.
+        """
+        h = np.asarray(x, dtype=self.dtype)
+        if h.ndim == 1:
+            h = h.reshape(1, -1)
+        for kernel, bias, activation in zip(self.kernels, self.biases, self.activations):
+            h = h @ kernel
+            h += bias
+            h = ACTIVATIONS[activation](h)
+        return h
+
+
+class ScaledModel():
+    """
+    It standardizes the raw inputs right before calling the model, for the
+    models where the scaler cannot be folded into the weights.
+    """
+    def __init__(self, model, mean, std):
+        self.model = model
+        self.mean = mean
+        self.std = std
+
+    def predict(self, x):
+        x = np.array(x, dtype=np.float64)
+        x -= self.mean
+        x /= self.std
+        return self.model.predict(x)
+
+
+class NumpySVR():
+    """
+    Prediction of an RBF (or linear) kernel SVR:
+        y = sum_i dual_i * exp(-gamma * |x - sv_i|^2) + intercept
+
+    The squared distances are computed as |x|^2 + |sv|^2 - 2 x @ sv.T, with
+    the norms of the support vectors computed once, so the work is a BLAS
+    matrix product. Rows are processed in blocks whose kernel matrix fits
+    in the CPU cache (about BLOCK_ELEMENTS values), in float32 by default.
+
+    The dual coefficients of cor06 add up to ~4e4 in absolute value with
+    alternate signs, so the kernel is reduced with them, and the intercept
+    added, in float64 whatever the dtype. The float32 predictions then
+    differ from scikit-learn by ~1e-4 MJ/m2day-1, and with
+    dtype=np.float64 they match to rounding.
+    """
+    BLOCK_ELEMENTS = 1 << 18
+
+    def __init__(self, support_vectors, dual_coef, intercept, gamma, kernel='rbf', dtype=np.float32):
+        if kernel not in ('rbf', 'linear'):
+            raise ValueError('kernel %s is not supported by NumpySVR' % kernel)
+        self.dtype = np.dtype(dtype)
+        self.kernel = str(kernel)
+        self.support_vectors = np.ascontiguousarray(support_vectors, dtype=self.dtype)
+        self.dual_coef = np.ascontiguousarray(np.ravel(dual_coef), dtype=self.dtype)
+        self.dual_coef64 = np.ascontiguousarray(np.ravel(dual_coef), dtype=np.float64)
+        self.intercept = float(np.ravel(intercept)[0])
+        self.gamma = float(gamma)
+
+        # constant terms of the distances, computed once
+        self.sv_t = np.ascontiguousarray(self.support_vectors.T)
+        self.sv_norms = np.einsum('ij,ij->i', self.support_vectors, self.support_vectors)
+        self.block_size = max(1, self.BLOCK_ELEMENTS // len(self.support_vectors))
+
+    @classmethod
+    def from_sklearn(cls, model, dtype=np.float32):
+        """
+        It takes the fitted attributes of a scikit-learn SVR.
+        """
+        return cls(model.support_vectors_, model.dual_coef_, model.intercept_, model._gamma,
+                   kernel=model.kernel, dtype=dtype)
+
+    @classmethod
+    def load(cls, filename, dtype=np.float32):
+        with np.load(filename, allow_pickle=False) as data:
+            return cls(data['support_vectors'], data['dual_coef'], data['intercept'], data['gamma'],
+                       kernel=str(data['kernel']), dtype=dtype)
+
+    def save(self, filename):
+        np.savez(filename, support_vectors=self.support_vectors, dual_coef=self.dual_coef,
+                 intercept=self.intercept, gamma=self.gamma, kernel=self.kernel)
+
+    @property
+    def n_inputs(self):
+        return self.support_vectors.shape[1]
+
+    def _predict_block(self, x):
+        products = x @ self.sv_t
+        if self.kernel == 'linear':
+            return products @ self.dual_coef64
+
+        # -gamma * (|x|^2 + |sv|^2 - 2 x.sv), clipped at 0 against rounding
+        products *= 2 * self.gamma
+        products -= self.gamma * self.sv_norms
+        products -= self.gamma * np.einsum('ij,ij->i', x, x)[:, None]
+        np.minimum(products, 0, out=products)
+        np.exp(products, out=products)
+        # reduced in float64, the dual coefficients cancel each other out
+        return products @ self.dual_coef64
+
+    def predict(self, x):
+        """
+        It predicts a (rows, inputs) array, returning one value per row.
+        """
+        x = np.asarray(x, dtype=self.dtype)
+        if x.ndim == 1:
+            x = x.reshape(1, -1)
+        y_pred = np.empty(len(x), dtype=np.float64)
+        for start in range(0, len(x), self.block_size):
+            block = x[start:start + self.block_size]
+            y_pred[start:start + len(block)] = self._predict_block(block)
+        y_pred += self.intercept
+        return y_pred
+
+
+def _squared_distances(x, centers, center_norms):
+    distances = x @ centers
+    distances *= -2
+    distances += center_norms
+    distances += np.einsum('ij,ij->i', x, x)[:, None]
+    return np.maximum(distances, 0, out=distances)
+
+# hidden neuron types of hpelm: H = function(x, W, B), as in hpelm.nnets.slfn
+ELM_NEURONS = {
+    'lin': lambda x, W, B, norms: x @ W + B,
+    'sigm': lambda x, W, B, norms: 1 / (1 + np.exp(x @ W + B)),
+    'tanh': lambda x, W, B, norms: np.tanh(x @ W + B),
+    'rbf_l2': lambda x, W, B, norms: np.exp(-_squared_distances(x, W, norms) / B),
+    'rbf_l1': lambda x, W, B, norms: np.exp(-np.abs(x[:, :, None] - W).sum(axis=1) ** 2 / B),
+    'rbf_linf': lambda x, W, B, norms: np.exp(-np.abs(x[:, :, None] - W).max(axis=1) ** 2 / B),
+}
+
+
+class NumpyELM():
+    """
+    Prediction of an hpelm Extreme Learning Machine: the hidden layer
+    projection of every group of neurons, followed by the linear readout
+    (beta). For the RBF neurons the squared distances to the centers come
+    from one matrix product, with the norms of the centers computed once.
+
+    It computes in float64, as hpelm does, unless another dtype is given.
+    float32 is only usable with small output weights: those of alm04 reach
+    1e7 and cancel each other, so it must be run in float64.
+    """
+    def __init__(self, neurons, beta, dtype=np.float64):
+        for function, _, _ in neurons:
+            if function not in ELM_NEURONS:
+                raise ValueError('neuron type %r is not supported, use one of %s'
+                                 % (function, sorted(ELM_NEURONS)))
+        self.dtype = np.dtype(dtype)
+        self.neurons = [(str(function), np.ascontiguousarray(W, dtype=self.dtype),
+                         np.ascontiguousarray(B, dtype=self.dtype)) for function, W, B in neurons]
+        self.norms = [np.einsum('ij,ij->j', W, W) for _, W, _ in self.neurons]
+        self.beta = np.ascontiguousarray(beta, dtype=self.dtype)
+
+    @classmethod
+    def from_hpelm(cls, filename, dtype=np.float64):
+        """
+        It reads a model saved by hpelm.ELM.save, a pickled dict of arrays
+        (hpelm itself is not needed).
+        """
+        import pickle
+        with open(filename, 'rb') as file:
+            data = pickle.load(file)
+        neurons = [(function, W, B) for _, function, W, B in data['neurons']]
+        return cls(neurons, data['Beta'], dtype=dtype)
+
+    @classmethod
+    def load(cls, filename, dtype=np.float64):
+        with np.load(filename, allow_pickle=False) as data:
+            functions = [str(f) for f in data['functions']]
+            neurons = [(f, data['W_%d' % i], data['B_%d' % i]) for i, f in enumerate(functions)]
+            return cls(neurons, data['beta'], dtype=dtype)
+
+    def save(self, filename):
+        arrays = {'functions': np.array([function for function, _, _ in self.neurons]), 'beta': self.beta}
+        for i, (_, W, B) in enumerate(self.neurons):
+            arrays['W_%d' % i] = W
+            arrays['B_%d' % i] = B
+        np.savez(filename, **arrays)
+
+    @property
+    def n_inputs(self):
+        return self.neurons[0][1].shape[0]
+
+    def predict(self, x):
+        """
+        It predicts a (rows, inputs) array, returning (rows, outputs) as hpelm.
+        """
+        x = np.asarray(x, dtype=self.dtype)
+        if x.ndim == 1:
+            x = x.reshape(1, -1)
+        hidden = [ELM_NEURONS[function](x, W, B, norms)
+                  for (function, W, B), norms in zip(self.neurons, self.norms)]
+        h = hidden[0] if len(hidden) == 1 else np.hstack(hidden)
+        return h @ self.beta
+
+
+class XGBoostModel():
+    """
+    Fast path of an XGBRegressor: predictions straight from its booster
+    with inplace_predict, on float32 C-contiguous inputs.
+
+    It honours best_iteration as XGBRegressor.predict does.
+    """
+    def __init__(self, booster):
+        self.booster = booster
+        best_iteration = booster.attr('best_iteration')
+        self.iteration_range = (0, int(best_iteration) + 1) if best_iteration is not None else (0, 0)
+
+    def set_params(self, n_jobs=None):
+        if n_jobs is not None:
+            self.booster.set_param('nthread', n_jobs)
+        return self
+
+    def predict(self, x):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        if x.ndim == 1:
+            x = x.reshape(1, -1)
+        return self.booster.inplace_predict(x, iteration_range=self.iteration_range,
+                                            validate_features=False)
+
+    def compile(self):
+        """
+        It returns the trees of the booster as a NumpyTrees model.
+        """
+        return NumpyTrees.from_json(json.loads(bytes(self.booster.save_raw(raw_format='json'))))
+
+
+class NumpyTrees():
+    """
+    Compiled evaluation of the trees of an XGBoost regression model.
+
+    The nodes of every tree are stored in flat arrays, the leaves pointing
+    to themselves, so all the trees are walked at the same time with one
+    gather per level and no branching in Python. As XGBoost does, the
+    inputs and thresholds are float32 and a missing value (nan) follows the
+    default direction of the split.
+    """
+    # objectives whose prediction is the raw margin
+    OBJECTIVES = ['reg:squarederror', 'reg:linear', 'reg:absoluteerror', 'reg:pseudohubererror',
+                  'reg:quantileerror']
+
+    def __init__(self, roots, feature, threshold, left, right, default_left, value, base_score, depth):
+        self.roots = np.asarray(roots, dtype=np.int64)
+        self.feature = np.asarray(feature, dtype=np.int64)
+        self.threshold = np.asarray(threshold, dtype=np.float32)
+        self.left = np.asarray(left, dtype=np.int64)
+        self.right = np.asarray(right, dtype=np.int64)
+        self.default_left = np.asarray(default_left, dtype=bool)
+        self.value = np.asarray(value, dtype=np.float32)
+        self.base_score = np.float32(base_score)
+        self.depth = int(depth)
+
+    @classmethod
+    def from_json(cls, model):
+        """
+        It builds the arrays from an XGBoost model saved in json format.
+        """
+        learner = model['learner']
+        objective = learner['objective']['name']
+        booster = learner['gradient_booster']
+        if objective not in cls.OBJECTIVES:
+            raise ValueError('objective %s is not supported by NumpyTrees' % objective)
+        if booster['name'] != 'gbtree':
+            raise ValueError('booster %s is not supported by NumpyTrees' % booster['name'])
+
+        trees = booster['model']['trees']
+        best_iteration = learner.get('attributes', {}).get('best_iteration')
+        if best_iteration is not None:
+            parallel_trees = int(booster['model']['gbtree_model_param'].get('num_parallel_tree', 1))
+            trees = trees[:(int(best_iteration) + 1) * parallel_trees]
+
+        roots, feature, threshold, left, right, default_left, value = [], [], [], [], [], [], []
+        depth, offset = 0, 0
+        for tree in trees:
+            if any(tree.get('split_type', [])):
+                raise ValueError('categorical splits are not supported by NumpyTrees')
+            tree_left = np.array(tree['left_children'])
+            tree_right = np.array(tree['right_children'])
+            nodes = np.arange(len(tree_left))
+            leaf = tree_left == -1
+
+            # the leaves point to themselves and keep their value in split_conditions
+            roots.append(offset)
+            feature.append(np.where(leaf, 0, tree['split_indices']))
+            threshold.append(np.where(leaf, 0, tree['split_conditions']))
+            left.append(np.where(leaf, nodes, tree_left) + offset)
+            right.append(np.where(leaf, nodes, tree_right) + offset)
+            default_left.append(np.array(tree['default_left'], dtype=bool))
+            value.append(np.where(leaf, tree['split_conditions'], 0))
+            depth = max(depth, _tree_depth(tree_left, tree_right))
+            offset += len(nodes)
+
+        base_score = float(str(learner['learner_model_param']['base_score']).strip('[]'))
+        return cls(roots, np.concatenate(feature), np.concatenate(threshold), np.concatenate(left),
+                   np.concatenate(right), np.concatenate(default_left), np.concatenate(value),
+                   base_score, depth)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename, allow_pickle=False) as data:
+            return cls(**{name: data[name] for name in data.files})
+
+    def save(self, filename):
+        np.savez(filename, roots=self.roots, feature=self.feature, threshold=self.threshold,
+                 left=self.left, right=self.right, default_left=self.default_left, value=self.value,
+                 base_score=self.base_score, depth=self.depth)
+
+    def predict(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        if x.ndim == 1:
+            x = x.reshape(1, -1)
+        rows = np.arange(len(x))[:, None]
+
+        node = np.broadcast_to(self.roots, (len(x), len(self.roots)))
+        for _ in range(self.depth):
+            values = x[rows, self.feature[node]]
+            go_left = np.where(np.isnan(values), self.default_left[node], values < self.threshold[node])
+            node = np.where(go_left, self.left[node], self.right[node])
+        return (self.value[node].sum(axis=1, dtype=np.float64) + self.base_score).astype(np.float32)
+
+
+def _tree_depth(left, right):
+    '''
+    It returns the number of levels of splits of a tree.
+    '''
+    depth, level = 0, np.array([0])
+    while True:
+        level = level[left[level] != -1]
+        if len(level) == 0:
+            return depth
+        level = np.concatenate([left[level], right[level]])
+        depth += 1
+
+def verify_compiled(model, compiled, x, atol=1e-4):
+    '''
+    It checks that a compiled model gives the same predictions as the
+    original one over x, and returns the largest absolute difference.
+    '''
+    difference = float(np.max(np.abs(np.ravel(model.predict(x)) - np.ravel(compiled.predict(x))),
+                              initial=0))
+    if difference > atol:
+        raise ValueError('the compiled model differs from the original one by %g' % difference)
+    return difference
+
+
+def fuse_scaler(model, mean, std):
+    '''
+    It returns a model that takes the raw (not standardized) inputs.
+
+    Input:
+        * model -> the model of a station, as returned by the registry
+
+        * mean, std -> arrays with the training mean/std of each input
+
+    Output:
+        * model -> a NumpyMLP with the scaler folded in its first layer,
+        or the model wrapped in a ScaledModel otherwise
+    '''
+    if isinstance(model, NumpyMLP):
+        return model.fold_scaler(mean, std)
+    return ScaledModel(model, mean, std)
+
+
+def export_keras_mlp(h5_filename, npz_filename=None):
+    '''
+    It reads the weights and activations of a Keras Sequential model of
+    Dense layers from its .h5 file (TensorFlow is not needed, only h5py)
+    and stores them in a .npz file.
+
+    Input:
+        * h5_filename -> path of the .h5 file saved by keras
+
+        * npz_filename -> path of the output file. By default, the same
+        path with the .npz extension.
+
+    Output:
+        * model -> the NumpyMLP built from the exported weights
+    '''
+    h5py = lazy.import_backend('h5py')
+    if npz_filename is None:
+        npz_filename = h5_filename.rsplit('.', 1)[0] + '.npz'
+
+    kernels, biases, activations = [], [], []
+    with h5py.File(h5_filename, 'r') as file:
+        config = file.attrs['model_config']
+        if isinstance(config, bytes):
+            config = config.decode('utf-8')
+        config = json.loads(config)
+        weights = file['model_weights']
+
+        for layer in config['config']['layers']:
+            if layer['class_name'] in ('InputLayer', 'Dropout'):
+                continue
+            if layer['class_name'] != 'Dense':
+                raise ValueError('layer %s is not supported by NumpyMLP' % layer['class_name'])
+
+            name = layer['config']['name']
+            group = weights[name]
+            weight_names = [n.decode('utf-8') if isinstance(n, bytes) else n
+                            for n in group.attrs['weight_names']]
+            values = {n.split('/')[-1].split(':')[0]: group[n][()] for n in weight_names}
+
+            kernels.append(values['kernel'])
+            biases.append(values.get('bias', np.zeros(values['kernel'].shape[1])))
+            activations.append(layer['config']['activation'])
+
+    model = NumpyMLP(kernels, biases, activations)
+    model.save(npz_filename)
+    return model
+
+def export_sklearn_svr(sav_filename, npz_filename=None):
+    '''
+    It reads a pickled scikit-learn SVR and stores its support vectors, dual
+    coefficients, intercept and gamma in a .npz file (scikit-learn is only
+    needed for this export).
+
+    Output:
+        * model -> the NumpySVR built from the exported attributes
+    '''
+    import pickle
+    if npz_filename is None:
+        npz_filename = sav_filename.rsplit('.', 1)[0] + '.npz'
+    with open(sav_filename, 'rb') as file:
+        svr = pickle.load(file)
+
+    # stored in float64, the dtype is chosen when loading it
+    NumpySVR.from_sklearn(svr, dtype=np.float64).save(npz_filename)
+    return NumpySVR.load(npz_filename)
+
+def export_hpelm(pkl_filename, npz_filename=None):
+    '''
+    It converts a model saved by hpelm to a .npz file with the neuron
+    types, weights, biases and output weights of the ELM.
+
+    Output:
+        * model -> the NumpyELM built from the exported arrays
+    '''
+    if npz_filename is None:
+        npz_filename = pkl_filename.rsplit('.', 1)[0] + '.npz'
+    NumpyELM.from_hpelm(pkl_filename).save(npz_filename)
+    return NumpyELM.load(npz_filename)
+
+
+if __name__ == '__main__':
+    import ModelRegistry as registry
+
+    for station, entry in registry.STATIONS.items():
+        if entry['loader'] == 'mlp':
+            h5_filename = registry.get_filename(station)
+            model = export_keras_mlp(h5_filename)
+            print(station, '->', h5_filename.rsplit('.', 1)[0] + '.npz',
+                  [k.shape for k in model.kernels], model.activations)
+        elif entry['loader'] == 'svr':
+            sav_filename = registry.get_filename(station)
+            model = export_sklearn_svr(sav_filename)
+            print(station, '->', sav_filename.rsplit('.', 1)[0] + '.npz',
+                  len(model.support_vectors), 'support vectors, gamma', model.gamma)
+        elif entry['loader'] == 'elm':
+            pkl_filename = registry.get_filename(station)
+            model = export_hpelm(pkl_filename)
+            print(station, '->', pkl_filename.rsplit('.', 1)[0] + '.npz',
+                  [(function, W.shape[1]) for function, W, _ in model.neurons])
+        elif entry['loader'] == 'xgboost' and registry.is_available(station):
+            model = registry.get_model(station)
+            compiled = model.compile()
+            x = np.random.default_rng(0).normal(size=(10000, model.booster.num_features()))
+            difference = verify_compiled(model, compiled, x)
+            compiled.save(registry.get_compiled_filename(station))
+            print(station, '->', registry.get_compiled_filename(station),
+                  len(compiled.roots), 'trees, max difference %g' % difference)
@@ -0,0 +1,241 @@
+'''
+Opt-in instrumentation of the stages of the station classes.
+
+import_dataset, getStandardDataTest, predictValues and statAnalysis of
+every station class are wrapped with @instrumented(stage). While no sink
+is enabled, the wrapper only checks an empty tuple and calls the method.
+Once enabled, every call records an event:
+
+    {'station': 'cor06', 'stage': 'predictValues', 'backend': 'svr',
+     'engine': 'NumpySVR', 'seconds': 0.0123, 'rows': 20, 'bytes': 160}
+
+being backend the loader of the model in ModelRegistry (mlp, svr, elm or
+xgboost), engine the class that runs it, rows the rows the stage
+processed and bytes the size of the arrays (or Dataframe) it left in the
+instance: dfData, x_test/y_test or y_pred.
+
+The events go to pluggable sinks, any object with a record(event) method:
+
+    * LogSink: a line per call through the logging module
+
+    * MemorySink: keeps the events, summary() aggregates them per station
+    and stage
+
+    * PrometheusSink: counters in the Prometheus text format, written to a
+    file for the textfile collector of node_exporter
+
+Usage:
+    sink = Instrumentation.MemorySink()
+    with Instrumentation.instrument(sink):
+        ... the station classes as usual
+    print(sink.summary())
+'''
+import contextlib
+import functools
+import logging
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+import ModelRegistry as registry
+
+# attributes each stage leaves in the instance, the first one gives the rows
+STAGE_OUTPUTS = {
+    'import_dataset': ['dfData'],
+    'getStandardDataTest': ['x_test', 'y_test'],
+    'predictValues': ['y_pred'],
+    'statAnalysis': ['y_test'],
+}
+
+# enabled sinks, replaced as a whole so the wrappers never see it half changed
+_sinks = ()
+_lock = threading.Lock()
+
+
+def _nbytes(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=False).sum())
+    return int(getattr(value, 'nbytes', 0))
+
+def _backend(mlModel):
+    model = getattr(mlModel, 'model', None)
+    engine = type(getattr(model, 'model', model)).__name__  # through PredictionCache.CachedModel
+    try:
+        return registry.get_station(mlModel.station)['loader'], engine
+    except (AttributeError, KeyError):
+        return None, engine
+
+def _event(mlModel, stage, seconds):
+    outputs = [getattr(mlModel, name, None) for name in STAGE_OUTPUTS[stage]]
+    backend, engine = _backend(mlModel)
+    return {
+        'station': getattr(mlModel, 'station', type(mlModel).__name__),
+        'stage': stage,
+        'backend': backend,
+        'engine': engine,
+        'seconds': seconds,
+        'rows': len(outputs[0]) if outputs[0] is not None else 0,
+        # statAnalysis allocates no arrays of its own
+        'bytes': 0 if stage == 'statAnalysis' else sum(_nbytes(value) for value in outputs),
+    }
+
+def instrumented(stage):
+    '''
+    It wraps a method of a station class to record its events while a sink
+    is enabled.
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not _sinks:
+                return method(self, *args, **kwargs)
+            start = time.perf_counter()
+            result = method(self, *args, **kwargs)
+            event = _event(self, stage, time.perf_counter() - start)
+            for sink in _sinks:
+                sink.record(event)
+            return result
+        return wrapper
+    return decorator
+
+def enable(*sinks):
+    '''
+    It adds the sinks to the enabled ones.
+    '''
+    global _sinks
+    with _lock:
+        _sinks = _sinks + tuple(sink for sink in sinks if sink not in _sinks)
+
+def disable(*sinks):
+    '''
+    It removes the sinks, or every sink when none is given.
+    '''
+    global _sinks
+    with _lock:
+        _sinks = tuple(sink for sink in _sinks if sinks and sink not in sinks)
+
+def enabled_sinks():
+    return _sinks
+
+@contextlib.contextmanager
+def instrument(*sinks):
+    '''
+    It enables the sinks inside a with block.
+    '''
+    enable(*sinks)
+    try:
+        yield sinks[0] if len(sinks) == 1 else sinks
+    finally:
+        disable(*sinks)
+
+
+class LogSink():
+    """
+    It logs a line per call.
+
+    Inputs:
+        logger: logging.Logger, by default the "solar.instrumentation" one
+        level: logging level of the lines
+    """
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger('solar.instrumentation')
+        self.level = level
+
+    def record(self, event):
+        self.logger.log(self.level, '%s %s [%s/%s] %.6f s, %d rows, %d bytes', event['station'],
+                        event['stage'], event['backend'], event['engine'], event['seconds'],
+                        event['rows'], event['bytes'])
+
+
+class MemorySink():
+    """
+    It keeps the events in memory.
+    """
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+
+    def record(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def clear(self):
+        with self._lock:
+            self.events = []
+
+    def summary(self):
+        '''
+        It returns a pandas Dataframe with the calls, seconds, rows, bytes
+        and rows/s per station and stage.
+        '''
+        with self._lock:
+            dfEvents = pd.DataFrame(self.events, columns=['station', 'stage', 'backend', 'engine',
+                                                          'seconds', 'rows', 'bytes'])
+        dfSummary = dfEvents.groupby(['station', 'stage'], sort=False).agg(
+            backend=('backend', 'first'), calls=('seconds', 'size'), seconds=('seconds', 'sum'),
+            rows=('rows', 'sum'), bytes=('bytes', 'sum'))
+        dfSummary['rows_per_s'] = dfSummary['rows'] / dfSummary['seconds'].replace(0, np.nan)
+        return dfSummary
+
+
+class PrometheusSink():
+    """
+    It keeps counters per station, stage and backend and writes them in the
+    Prometheus text format. The file is replaced at once, so a scrape never
+    reads it half written.
+
+    Inputs:
+        filename: .prom file, e.g. in the textfile directory of node_exporter
+        prefix: prefix of the metric names
+        interval: minimum seconds between writes, 0 writes after every call.
+            The last counters are always written by flush().
+    """
+    METRICS = [
+        ('calls', 'calls_total', 'Calls of the stage'),
+        ('seconds', 'seconds_total', 'Wall time spent in the stage'),
+        ('rows', 'rows_total', 'Rows processed by the stage'),
+        ('bytes', 'bytes_total', 'Bytes of the arrays allocated by the stage'),
+    ]
+
+    def __init__(self, filename, prefix='solar_stage', interval=0.0):
+        self.filename = filename
+        self.prefix = prefix
+        self.interval = interval
+        self.counters = {}
+        self._written = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, event):
+        key = (event['station'], event['stage'], event['backend'] or '')
+        with self._lock:
+            counters = self.counters.setdefault(key, dict.fromkeys(['calls', 'seconds', 'rows', 'bytes'], 0))
+            counters['calls'] += 1
+            for name in ['seconds', 'rows', 'bytes']:
+                counters[name] += event[name]
+            if time.monotonic() - self._written >= self.interval:
+                self._write()
+
+    def flush(self):
+        with self._lock:
+            self._write()
+
+    def text(self):
+        '''
+        It returns the counters in the Prometheus text format.
+        '''
+        lines = []
+        for name, suffix, description in self.METRICS:
+            metric = '%s_%s' % (self.prefix, suffix)
+            lines.append('# HELP %s %s' % (metric, description))
+            lines.append('# TYPE %s counter' % metric)
+            for (station, stage, backend), counters in sorted(self.counters.items()):
+                lines.append('%s{station="%s",stage="%s",backend="%s"} %r'
+                             % (metric, station, stage, backend, counters[name]))
+        return '\n'.join(lines) + '\n'
+
+    def _write(self):
+        with open(self.filename + '.tmp', 'w') as file:
+            file.write(self.text())
+        os.replace(self.filename + '.tmp', self.filename)
+        self._written = time.monotonic()
@@ -0,0 +1,87 @@
+'''
+Lazy import of the heavy backends.
+
+TensorFlow and XGBoost take from hundreds of milliseconds to several
+seconds to import, so the station modules do not import them at module
+level. Each backend is imported the first time a
+model that needs it is used and then reused by the whole process.
+
+Other modules can register a function to be called right after a backend
+is imported (see on_import), e.g. to configure its threads before any
+model is built.
+'''
+import importlib
+import threading
+import time
+
+# backend name -> (module to import, attribute of the module or None)
+BACKENDS = {
+    'keras': ('tensorflow', 'keras'),
+    'xgboost': ('xgboost', None),
+    'h5py': ('h5py', None),
+    'pyarrow': ('pyarrow', None),
+    'pyarrow.dataset': ('pyarrow.dataset', None),
+    'pyarrow.parquet': ('pyarrow.parquet', None),
+    'threadpoolctl': ('threadpoolctl', None),
+}
+
+_modules = {}
+_hooks = {}
+_lock = threading.Lock()
+
+# seconds spent importing each backend, useful to track start-up cost
+import_times = {}
+
+
+def import_backend(name):
+    '''
+    It imports a backend the first time it is requested.
+
+    Input:
+        * name -> string with the backend name, one of BACKENDS
+
+    Output:
+        * module -> the imported module (e.g. tensorflow.keras)
+    '''
+    module = _modules.get(name)
+    if module is not None:
+        return module
+
+    if name not in BACKENDS:
+        raise KeyError('unknown backend %r, use one of %s' % (name, sorted(BACKENDS)))
+    module_name, attribute = BACKENDS[name]
+
+    with _lock:
+        if name not in _modules:
+            start = time.perf_counter()
+            try:
+                module = importlib.import_module(module_name)
+            except ImportError as error:
+                raise ImportError('the %s backend is required by this model, install %s'
+                                  % (name, module_name)) from error
+            if attribute is not None:
+                module = getattr(module, attribute)
+            import_times[name] = time.perf_counter() - start
+            for hook in _hooks.get(name, []):
+                hook(module)
+            _modules[name] = module
+        return _modules[name]
+
+def on_import(name, hook):
+    '''
+    It registers a function called with the module right after the backend
+    is imported, or right now if it has already been imported.
+    '''
+    if name not in BACKENDS:
+        raise KeyError('unknown backend %r, use one of %s' % (name, sorted(BACKENDS)))
+    with _lock:
+        _hooks.setdefault(name, []).append(hook)
+        module = _modules.get(name)
+    if module is not None:
+        hook(module)
+
+def is_loaded(name):
+    '''
+    It returns True if the backend has already been imported.
+    '''
+    return name in _modules
@@ -0,0 +1,358 @@
+'''
+Registry of the station models.
+
+Every station code is mapped to its class, the aridity index of the
+station the model comes from, the loader of its backend, the artifact
+stored in models/, the input configuration (being rs the predicted value)
+and the mean/std of the training dataset used to standardize the inputs.
+
+The MLP models are run with InferenceEngines.NumpyMLP from the .npz
+weights exported next to their .h5 file, TensorFlow is only used when the
+.npz file does not exist. In the same way, the SVR model is run with
+InferenceEngines.NumpySVR from the .npz export of its pickle and the ELM
+model with InferenceEngines.NumpyELM from the export of its hpelm file.
+The XGBoost model is run from its booster with inplace_predict
+(InferenceEngines.XGBoostModel), or from its trees compiled to NumPy
+arrays (get_compiled_model).
+
+Models are loaded on first use only and kept in a bounded, process-wide
+LRU cache, so building a station class more than once does not read the
+artifact from disk again. The models derived from them (get_raw_model,
+get_compiled_model) are kept in a second cache of the same size, so they
+never evict the models themselves. Each model is loaded once even when
+several threads ask for it at the same time. The threads of the backends are set with
+ThreadControls.configure.
+'''
+import importlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+import LazyImports as lazy
+import ThreadControls as threads
+
+# models/ is resolved from the location of this file, not from the cwd
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+STATIONS = {
+    'mag01': {
+        'module': 'mag01_mlp',
+        'class': 'mag01_mlp',
+        'aridity_index': 0.3666,
+        'loader': 'mlp',
+        'filename': 'models/mlp_mag01_Tx_Tn_Ra_deltaT_EnergyT_HorminTx_Txprev_Tnnext_Rs.h5',
+        'parameters': ['tx', 'tn', 'ra', 'deltat', 'energyt', 'hormin_tx', 'tx_prev', 'tn_next', 'rs'],
+        'mean': [23.84, 12.54, 29.19, 11.30, 418.23, 13.37, 23.84, 12.53],
+        'std': [6.40, 5.55, 9.39, 3.62, 139.44, 1.96, 6.39, 5.56],
+    },
+    'sev09': {
+        'module': 'sev09_mlp',
+        'class': 'sev09_mlp',
+        'aridity_index': 0.3615,
+        'loader': 'mlp',
+        'filename': 'models/mlp_sev09_Tx_Tn_Ra_deltaT_EnergyT_HorminTx_Txprev_Tnnext_Rs.h5',
+        'parameters': ['tx', 'tn', 'ra', 'deltat', 'energyt', 'hormin_tx', 'tx_prev', 'tn_next', 'rs'],
+        'mean': [25.03, 10.95, 29.06, 14.07, 413.04, 14.82, 25.02, 10.93],
+        'std': [8.70, 6.37, 9.55, 4.71, 179.02, 1.69, 8.71, 6.39],
+    },
+    'gra03': {
+        'module': 'gra03_mlp',
+        'class': 'gra03_mlp',
+        'aridity_index': 0.3162,
+        'loader': 'mlp',
+        'filename': 'models/mlp_gra03_Tx_Tn_Ra_deltaT_EnergyT_HorminTx_Tn_prev_Rs.h5',
+        'parameters': ['tx', 'tn', 'ra', 'deltat', 'energyt', 'hormin_tx', 'tn_prev', 'rs'],
+        'mean': [23.26, 9.33, 29.02, 13.93, 370.37, 14.21, 9.33],
+        'std': [8.52, 6.22, 9.42, 4.71, 177.41, 2.15, 6.23],
+    },
+    'hue08': {
+        'module': 'hue08_mlp',
+        'class': 'hue08_svm',
+        'aridity_index': 0.5497,
+        'loader': 'mlp',
+        'filename': 'models/mlp_hue08_Tx_Tn_Ra_EnergyT_HorminTx_Tx_prev_Tn_next_Rs.h5',
+        'parameters': ['tx', 'tn', 'ra', 'energyt', 'hormin_tx', 'tx_prev', 'tn_next', 'rs'],
+        'mean': [23.02, 12.12, 28.97, 394.57, 14.30, 23.02, 12.11],
+        'std': [8.15, 5.45, 9.59, 163.09, 2.01, 8.15, 5.46],
+    },
+    'jae07': {
+        'module': 'jae07_mlp',
+        'class': 'jae07_mlp',
+        'aridity_index': 0.2808,
+        'loader': 'mlp',
+        'filename': 'models/mlp_jae07_Tx_Tn_Ra_EnergyT_HorminTx_Tx_prev_Tn_next_Rs.h5',
+        'parameters': ['tx', 'tn', 'ra', 'energyt', 'hormin_tx', 'tx_prev', 'tn_next', 'rs'],
+        'mean': [23.60, 11.59, 28.80, 391.51, 14.78, 23.59, 11.58],
+        'std': [9.04, 6.73, 9.62, 187.84, 2.33, 9.04, 6.73],
+    },
+    'cor06': {
+        'module': 'cor06_svm',
+        'class': 'cor06_svm',
+        'aridity_index': 0.4616,
+        'loader': 'svr',
+        'filename': 'models/svm_cor06_Tx_Tn_Ra_deltaT_EnergyT_HorminTx_Tx_prev_Tn_next_Rs.sav',
+        'parameters': ['tx', 'tn', 'ra', 'deltat', 'energyt', 'hormin_tx', 'tx_prev', 'tn_next', 'rs'],
+        'mean': [24.42, 11.03, 28.78, 13.38, 402.95, 15.20, 24.42, 11.02],
+        'std': [8.54, 6.26, 9.64, 4.578, 177.87, 1.78, 8.53, 6.27],
+    },
+    'alm04': {
+        'module': 'alm04_elm',
+        'class': 'alm04_elm',
+        'aridity_index': 0.1786,
+        'loader': 'elm',
+        'filename': 'models/elm_alm04_Tx_Tn_Ra_deltaT_EnergyT_HorminTx_Tn_prev_Rs.pkl',
+        'parameters': ['tx', 'tn', 'ra', 'deltat', 'energyt', 'hormin_tx', 'tx_prev', 'rs'],
+        'mean': [23.21, 9.84, 29.28, 13.37, 364.57, 13.39, 23.21],
+        'std': [7.34, 6.17, 9.40, 3.87, 162.81, 1.89, 7.33],
+    },
+    'ash08': {
+        'module': 'ash08_xgb',
+        'class': 'ash08_xgb',
+        'aridity_index': 1.1494,
+        'loader': 'xgboost',
+        'filename': 'models/xgb_ash08_tx_tn_ra_deltaT_energyt_hormin_tx_tx_prev_rs.json',
+        'parameters': ['tx', 'tn', 'ra', 'deltat', 'energyt', 'hormin_tx', 'tx_prev', 'rs'],
+        'mean': [20.30, 6.67, 30.38, 13.62, 209.17, 14.49, 20.14],
+        'std': [7.86, 8.31, 9.04, 4.93, 1033.36, 2.25, 8.03],
+    },
+}
+
+# dtypes of the inputs the station classes can work in
+DTYPES = ['float64', 'float32']
+
+# (station, dtype) -> mean/std as read-only float arrays, ready to be
+# broadcast over a (rows, inputs) matrix of the same dtype. They are built
+# on first use, so importing the registry does not import NumPy
+SCALERS = {}
+
+# maximum number of models kept in memory at the same time, in each cache
+MAX_CACHED_MODELS = 8
+
+# station -> model, and (station, kind) -> model derived from it
+_cache = OrderedDict()
+_derived = OrderedDict()
+_lock = threading.Lock()
+# key -> lock held while the model of the key is loaded
+_loading = {}
+
+
+def _load_keras(filename):
+    keras = lazy.import_backend('keras')
+    return keras.models.load_model(filename)
+
+def _load_mlp(filename):
+    npz_filename = os.path.splitext(filename)[0] + '.npz'
+    if os.path.exists(npz_filename):
+        import InferenceEngines as engines
+        return engines.NumpyMLP.load(npz_filename)
+    return _load_keras(filename)
+
+def _load_pickle(filename):
+    with open(filename, 'rb') as file:
+        return pickle.load(file)
+
+def _load_svr(filename):
+    npz_filename = os.path.splitext(filename)[0] + '.npz'
+    if os.path.exists(npz_filename):
+        import InferenceEngines as engines
+        return engines.NumpySVR.load(npz_filename)
+    return _load_pickle(filename)
+
+def _load_elm(filename):
+    import InferenceEngines as engines
+    npz_filename = os.path.splitext(filename)[0] + '.npz'
+    if os.path.exists(npz_filename):
+        return engines.NumpyELM.load(npz_filename)
+    return engines.NumpyELM.from_hpelm(filename)
+
+def _load_xgboost(filename):
+    import InferenceEngines as engines
+    if not os.path.exists(filename):
+        return engines.NumpyTrees.load(os.path.splitext(filename)[0] + '.npz')
+    xgb = lazy.import_backend('xgboost')
+    model = xgb.XGBRegressor()
+    model.load_model(filename)
+    return threads.apply_xgboost(engines.XGBoostModel(model.get_booster()))
+
+LOADERS = {
+    'mlp': _load_mlp,
+    'keras': _load_keras,
+    'pickle': _load_pickle,
+    'svr': _load_svr,
+    'elm': _load_elm,
+    'xgboost': _load_xgboost,
+}
+
+
+def get_station(station):
+    '''
+    It returns the registry entry of a station.
+
+    Input:
+        * station -> string with the station code, e.g. 'cor06'
+
+    Output:
+        * entry -> dict with loader, filename, parameters, mean and std
+    '''
+    if station not in STATIONS:
+        raise KeyError('unknown station %r, use one of %s' % (station, sorted(STATIONS)))
+    return STATIONS[station]
+
+def get_filename(station):
+    '''
+    It returns the absolute path of the station artifact.
+    '''
+    return os.path.join(ROOT, get_station(station)['filename'])
+
+def get_class(station):
+    '''
+    It returns the class of a station, e.g. cor06_svm for 'cor06'.
+    '''
+    entry = get_station(station)
+    return getattr(importlib.import_module(entry['module']), entry['class'])
+
+def is_available(station):
+    '''
+    It returns True if the artifact of the station (or its .npz export) is
+    in models/.
+    '''
+    filename = get_filename(station)
+    return os.path.exists(filename) or os.path.exists(os.path.splitext(filename)[0] + '.npz')
+
+def available_stations():
+    '''
+    It returns the station codes whose artifact is in models/.
+    '''
+    return [station for station in STATIONS if is_available(station)]
+
+def get_parameters(station):
+    '''
+    It returns a copy of the input configuration of the station (being rs
+    the predicted value, always the last one).
+    '''
+    return list(get_station(station)['parameters'])
+
+def get_scaler(station, dtype='float64'):
+    '''
+    It returns the mean and std of the training dataset as read-only float
+    arrays, to standardize the inputs in place: x -= mean; x /= std. With
+    the dtype of the inputs no mixed-precision loop is needed.
+    '''
+    entry = get_station(station)
+    import numpy as np
+    dtype = np.dtype(dtype)
+    if dtype.name not in DTYPES:
+        raise ValueError('unsupported dtype %s, use one of %s' % (dtype, ', '.join(DTYPES)))
+    key = (station, dtype.name)
+    if key not in SCALERS:
+        mean = np.array(entry['mean'], dtype=dtype)
+        std = np.array(entry['std'], dtype=dtype)
+        mean.flags.writeable = False
+        std.flags.writeable = False
+        SCALERS[key] = (mean, std)
+    return SCALERS[key]
+
+def _evict(cache):
+    while len(cache) > MAX_CACHED_MODELS:
+        cache.popitem(last=False)
+
+def _get_cached(cache, key, load):
+    with _lock:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        key_lock = _loading.setdefault(key, threading.Lock())
+
+    # only one thread loads a key, the rest wait and take it from the cache
+    with key_lock:
+        with _lock:
+            if key in cache:
+                cache.move_to_end(key)
+                return cache[key]
+        model = load()
+        with _lock:
+            cache[key] = model
+            _evict(cache)
+        return model
+
+def get_model(station):
+    '''
+    It returns the model of a station, loading it only the first time it
+    is requested. The least recently used model is evicted when more than
+    MAX_CACHED_MODELS are in memory.
+
+    Input:
+        * station -> string with the station code, e.g. 'cor06'
+
+    Output:
+        * model -> the loaded model, shared by every instance in the process
+    '''
+    entry = get_station(station)
+    return _get_cached(_cache, station, lambda: LOADERS[entry['loader']](get_filename(station)))
+
+def get_raw_model(station):
+    '''
+    It returns a model that takes the inputs without standardizing. For
+    the MLP models the scaler is folded into the first layer, for the rest
+    the inputs are standardized right before predicting.
+    '''
+    get_station(station)
+
+    def load():
+        import InferenceEngines as engines
+        mean, std = get_scaler(station)
+        return engines.fuse_scaler(get_model(station), mean, std)
+    return _get_cached(_derived, (station, 'raw'), load)
+
+def get_compiled_filename(station):
+    '''
+    It returns the path of the .npz file with the compiled trees of an
+    XGBoost station.
+    '''
+    return os.path.splitext(get_filename(station))[0] + '.npz'
+
+def get_compiled_model(station):
+    '''
+    It returns the trees of an XGBoost station compiled to NumPy arrays
+    (InferenceEngines.NumpyTrees), read from their .npz export or compiled
+    from the booster when there is no export.
+    '''
+    if get_station(station)['loader'] != 'xgboost':
+        raise ValueError('only the XGBoost models can be compiled, %s is not one' % station)
+
+    def load():
+        import InferenceEngines as engines
+        filename = get_compiled_filename(station)
+        if os.path.exists(filename):
+            return engines.NumpyTrees.load(filename)
+        return get_model(station).compile()
+    return _get_cached(_derived, (station, 'compiled'), load)
+
+def set_cache_size(size):
+    '''
+    It changes the maximum number of models kept in memory (in each
+    cache), evicting the least recently used ones if needed.
+    '''
+    global MAX_CACHED_MODELS
+    if size < 1:
+        raise ValueError('the cache size must be at least 1')
+    with _lock:
+        MAX_CACHED_MODELS = size
+        _evict(_cache)
+        _evict(_derived)
+
+def cached_stations():
+    '''
+    It returns the station codes currently loaded, from least to most
+    recently used.
+    '''
+    with _lock:
+        return list(_cache)
+
+def clear_cache():
+    '''
+    It removes every model, and the ones derived from them, from memory.
+    '''
+    with _lock:
+        _cache.clear()
+        _derived.clear()
@@ -0,0 +1,153 @@
+'''
+Automatic choice of the model for new stations by aridity index.
+
+Each model comes from a station with a known aridity index (see
+ModelRegistry). A new site is given the model of the closest aridity
+index or, optionally, a blend of the k closest ones weighted by the
+inverse of the distance. The index of the models is precomputed once, and
+the sites of a dataset are routed in bulk: every selected model is loaded
+once and predicts all the rows dispatched to it.
+
+The aridity index of a site can be given, or estimated from its data as
+total precipitation / total reference evapotranspiration (Hargreaves),
+when the dataset has a daily precipitation column in mm.
+'''
+import numpy as np
+import pandas as pd
+import ModelRegistry as registry
+import EnsembleRunner as ensemble
+
+# Hargreaves coefficient, and MJ/m2day-1 to mm/day of evaporated water
+HARGREAVES = 0.0023
+MJ_TO_MM = 0.408
+
+
+def hargreaves_et0(tx, tn, ra):
+    '''
+    It calculates the daily reference evapotranspiration (mm) with the
+    Hargreaves-Samani equation, vectorized.
+    '''
+    tx = np.asarray(tx, dtype=np.float64)
+    tn = np.asarray(tn, dtype=np.float64)
+    tmean = (tx + tn) / 2
+    return HARGREAVES * MJ_TO_MM * np.asarray(ra) * (tmean + 17.8) * np.sqrt(np.clip(tx - tn, 0, None))
+
+def estimate_aridity_index(dfData):
+    '''
+    It estimates the aridity index of every station of a daily dataset as
+    total precipitation / total Hargreaves ET0, over the days with both.
+
+    Input:
+        * dfData -> pandas Dataframe with station, tx, tn, ra and
+        precipitation (mm) columns
+
+    Output:
+        * aridity -> pandas Series with the aridity index of each station id
+    '''
+    et0 = hargreaves_et0(dfData['tx'], dfData['tn'], dfData['ra'])
+    dfDays = pd.DataFrame({'station': dfData['station'].to_numpy(), 'et0': et0,
+                           'precipitation': dfData['precipitation'].to_numpy()}).dropna()
+    totals = dfDays.groupby('station')[['precipitation', 'et0']].sum()
+    return totals['precipitation'] / totals['et0']
+
+
+class ModelRouter():
+    """
+    It dispatches sites to the model of the closest aridity index.
+
+    Inputs:
+        stations: list of station models to choose from, by default every
+            model available in models/
+        k: number of models blended per site (1 means the closest only)
+    """
+    def __init__(self, stations=None, k=1):
+        if stations is None:
+            stations = registry.available_stations()
+        aridity = np.array([registry.get_station(s)['aridity_index'] for s in stations])
+        order = np.argsort(aridity)
+
+        # precomputed index of the models, sorted by aridity
+        self.stations = np.array(stations)[order]
+        self.aridity = aridity[order]
+        self.k = min(k, len(stations))
+
+    def neighbours(self, aridity_index):
+        """
+        It returns, for each aridity index, the position of the k closest
+        models in self.stations and their weights (summing 1).
+        """
+        aridity_index = np.atleast_1d(np.asarray(aridity_index, dtype=np.float64))
+        distance = np.abs(aridity_index[:, None] - self.aridity[None, :])
+        position = np.argsort(distance, axis=1, kind='stable')[:, :self.k]
+        distance = np.take_along_axis(distance, position, axis=1)
+
+        # inverse distance weights, an exact match takes all the weight
+        with np.errstate(divide='ignore'):
+            weights = 1 / distance
+        exact = np.isinf(weights)
+        weights[exact.any(axis=1)] = exact[exact.any(axis=1)]
+        weights /= weights.sum(axis=1, keepdims=True)
+        return position, weights
+
+    def route(self, aridity_index):
+        """
+        It returns the station code of the closest model to each aridity index.
+        """
+        position, _ = self.neighbours(aridity_index)
+        return self.stations[position[:, 0]]
+
+    def predict_dataset(self, fileLocation, fileType, aridity=None, years=None, station_ids=None):
+        """
+        It predicts rs for every row of a multi-station dataset with the
+        model(s) of its site.
+
+        Inputs:
+            fileLocation: "data/dataSet.csv"
+            fileType: string with csv, txt, excel, parquet, feather or arrow
+            aridity: dict or pandas Series with the aridity index of each
+                station id. By default it is estimated from the data, which
+                then needs a precipitation column.
+        Output:
+            dfPredictions: pandas Dataframe with the id columns, rs, the
+                aridity index, the closest model and the predicted rs_pred
+        """
+        extra_columns = ['precipitation'] if aridity is None else []
+        dfData, inputs, position = ensemble.import_inputs(
+            fileLocation, fileType, list(self.stations), years, station_ids, extra_columns)
+        if aridity is None:
+            aridity = estimate_aridity_index(dfData)
+
+        # route each site once, then broadcast to its rows
+        site, site_ids = pd.factorize(dfData['station'])
+        site_aridity = pd.Series(aridity).reindex(site_ids).to_numpy(dtype=np.float64)
+        site_position, site_weights = self.neighbours(site_aridity)
+        row_position, row_weights = site_position[site], site_weights[site]
+
+        total = np.zeros(len(dfData))
+        weight = np.zeros(len(dfData))
+        for i, station in enumerate(self.stations):
+            rows, slot = np.nonzero(row_position == i)
+            w = row_weights[rows, slot]
+            routed = ~np.isnan(w)
+            rows, w = rows[routed], w[routed]
+            if len(rows) == 0:
+                continue
+            y_pred = ensemble.predict_rows(station, inputs, position, rows)
+            valid = ~np.isnan(y_pred)
+            total[rows[valid]] += w[valid] * y_pred[valid]
+            weight[rows[valid]] += w[valid]
+
+        dfPredictions = dfData[[c for c in ensemble.ID_COLUMNS if c in dfData]].copy()
+        dfPredictions['rs'] = dfData['rs'].to_numpy() if 'rs' in dfData else np.nan
+        dfPredictions['aridity_index'] = site_aridity[site]
+        dfPredictions['model'] = np.where(np.isnan(site_aridity), None,
+                                          self.stations[site_position[:, 0]])[site]
+        with np.errstate(invalid='ignore'):
+            dfPredictions['rs_pred'] = total / weight
+        return dfPredictions
+
+
+if __name__ == '__main__':
+    router = ModelRouter(k=2)
+    print(router.route([0.2, 0.45, 0.9]))
+    print(router.predict_dataset("data/ncei-asheville-example.csv", 'csv', aridity={53877: 1.1494}))
@@ -0,0 +1,304 @@
+'''
+Persistent cache of the predictions.
+
+The same station-days are scored again and again (nightly re-runs,
+dashboards, re-validation), so the predictions are kept on disk and only
+the new or changed rows reach the model. The predictions are stored in
+blocks of rows under a content-addressed key: the hash of the model
+artifact and of the engine that runs it (class and dtype), followed by
+the hash of the standardized input rows of the block. A new model file,
+another engine or dtype, or any change in the inputs (data or
+standardization) gives a new key, so the cache never has to be
+invalidated by hand.
+
+The blocks are cut where the hash of a row ends in a given number of zero
+bits (content-defined chunking), not every n rows. Inserting, removing or
+changing a few rows then only changes the blocks around them, the rest of
+an archive keeps its keys. The hashes of the rows are computed with
+vectorized NumPy operations and only the keys of the blocks go to disk,
+so a lookup costs a small fraction of running the model.
+
+The cache is an sqlite database bounded to max_rows predictions. When it
+grows past them, the least recently used blocks are evicted. The rows
+found (hits) and not found (misses) are counted.
+
+Usage:
+    cache = PredictionCache('predictions.sqlite')
+    mlModel = cor06_svm()
+    cache.attach(mlModel)
+    ... mlModel.predictValues() as usual
+    print(cache.stats())
+'''
+import hashlib
+import os
+import sqlite3
+import threading
+from functools import lru_cache
+import numpy as np
+import ModelRegistry as registry
+
+# bytes of the hashes of the model artifact and of each block
+MODEL_DIGEST_SIZE = 8
+BLOCK_DIGEST_SIZE = 16
+
+# mean rows per block (a power of 2) and maximum, in multiples of the mean
+BLOCK_SIZE = 256
+MAX_BLOCK_FACTOR = 4
+
+# keys per sqlite statement, below the limit of variables of old sqlite versions
+QUERY_SIZE = 900
+
+# seeds of the two 64 bits hashes of each row
+SEEDS = (np.uint64(0x9E3779B97F4A7C15), np.uint64(0xD1B54A32D192ED03))
+
+
+@lru_cache(maxsize=None)
+def artifact_hash(station):
+    '''
+    It returns the hash of the files the model of a station is loaded from
+    (the artifact in models/ and its .npz export when there is one).
+    '''
+    filename = registry.get_filename(station)
+    digest = hashlib.blake2b(station.encode('utf-8'), digest_size=MODEL_DIGEST_SIZE)
+    for path in (filename, os.path.splitext(filename)[0] + '.npz'):
+        if os.path.exists(path):
+            with open(path, 'rb') as file:
+                for block in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(block)
+    return digest.digest()
+
+def model_prefix(model, station, dtype):
+    '''
+    It returns the prefix of the keys of a model: the hash of its artifact
+    followed by the hash of the engine class and the dtype it computes in
+    (dtype of the inputs when the engine has none). The pickled SVR and
+    NumpySVR in float32 load the same artifact, but their predictions
+    differ.
+    '''
+    engine = getattr(model, 'model', model)  # through ScaledModel
+    names = [type(model).__name__] + ([type(engine).__name__] if engine is not model else [])
+    engine_dtype = getattr(engine, 'dtype', getattr(model, 'dtype', dtype))
+    digest = hashlib.blake2b(('%s:%s' % ('/'.join(names), engine_dtype)).encode('utf-8'),
+                             digest_size=MODEL_DIGEST_SIZE)
+    return artifact_hash(station) + digest.digest()
+
+def _mix(h):
+    '''
+    splitmix64 finalizer, in place over an uint64 array.
+    '''
+    h ^= h >> np.uint64(30)
+    h *= np.uint64(0xBF58476D1CE4E5B9)
+    h ^= h >> np.uint64(27)
+    h *= np.uint64(0x94D049BB133111EB)
+    h ^= h >> np.uint64(31)
+    return h
+
+def row_hashes(x):
+    '''
+    It returns two 64 bits hashes of the float64 bytes of every row of x,
+    as a (rows, 2) uint64 array.
+    '''
+    x = np.asarray(x, dtype=np.float64) + 0.0  # -0.0 and 0.0 are the same input
+    words = np.ascontiguousarray(x).view(np.uint64)
+    hashes = np.empty((len(x), 2), dtype=np.uint64)
+    for i, seed in enumerate(SEEDS):
+        h = np.full(len(x), seed, dtype=np.uint64)
+        for column in range(words.shape[1]):
+            h ^= words[:, column]
+            h = _mix(h)
+        hashes[:, i] = h
+    return hashes
+
+def block_bounds(hashes, block_size=BLOCK_SIZE):
+    '''
+    It returns the (start, stop) of the blocks of rows. A block ends after a
+    row whose hash ends in log2(block_size) zero bits, or when it reaches
+    MAX_BLOCK_FACTOR * block_size rows.
+    '''
+    ends = np.flatnonzero((hashes[:, 0] & np.uint64(block_size - 1)) == 0) + 1
+    bounds, start = [], 0
+    for stop in list(ends) + [len(hashes)]:
+        while stop - start > MAX_BLOCK_FACTOR * block_size:
+            bounds.append((start, start + MAX_BLOCK_FACTOR * block_size))
+            start += MAX_BLOCK_FACTOR * block_size
+        if stop > start:
+            bounds.append((start, int(stop)))
+            start = int(stop)
+    return bounds
+
+def block_keys(prefix, hashes, bounds):
+    '''
+    It returns the key of every block: the prefix followed by the hash of
+    the hashes of its rows.
+    '''
+    return [prefix + hashlib.blake2b(hashes[start:stop].tobytes(), digest_size=BLOCK_DIGEST_SIZE).digest()
+            for start, stop in bounds]
+
+
+class PredictionCache():
+    """
+    On-disk LRU cache of the predictions, keyed by model and input rows.
+
+    Inputs:
+        filename: sqlite file of the cache, created if it does not exist
+        max_rows: maximum number of predictions kept
+        block_size: mean number of rows per block, a power of 2
+    """
+    def __init__(self, filename='predictions.sqlite', max_rows=10000000, block_size=BLOCK_SIZE):
+        if max_rows < 1:
+            raise ValueError('the cache size must be at least 1')
+        if block_size < 1 or block_size & (block_size - 1):
+            raise ValueError('the block size must be a power of 2')
+        self.filename = filename
+        self.max_rows = max_rows
+        self.block_size = block_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS predictions '
+                                    '(key BLOB PRIMARY KEY, value BLOB NOT NULL, rows INTEGER NOT NULL, '
+                                    'used INTEGER NOT NULL) WITHOUT ROWID')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS predictions_used ON predictions (used)')
+        self.entries, self.rows, self._clock = self.connection.execute(
+            'SELECT COUNT(*), COALESCE(SUM(rows), 0), COALESCE(MAX(used), 0) FROM predictions').fetchone()
+
+    def get(self, keys):
+        '''
+        It looks the keys up and marks the ones found as just used.
+
+        Output:
+            * values -> dict with the array of predictions of each key found
+        '''
+        values = {}
+        with self._lock:
+            self._clock += 1
+            with self.connection:
+                for start in range(0, len(keys), QUERY_SIZE):
+                    block = keys[start:start + QUERY_SIZE]
+                    rows = self.connection.execute(
+                        'SELECT key, value FROM predictions WHERE key IN (%s)' % ','.join('?' * len(block)),
+                        block).fetchall()
+                    if rows:
+                        values.update((key, np.frombuffer(value, dtype=np.float64)) for key, value in rows)
+                        self.connection.execute(
+                            'UPDATE predictions SET used = ? WHERE key IN (%s)' % ','.join('?' * len(rows)),
+                            [self._clock] + [key for key, _ in rows])
+        return values
+
+    def put(self, keys, values):
+        '''
+        It stores the arrays of predictions of the keys, evicting the least
+        recently used blocks when the cache is full.
+        '''
+        records = [(key, np.asarray(value, dtype=np.float64).tobytes(), len(value))
+                   for key, value in zip(keys, values)]
+        with self._lock:
+            self._clock += 1
+            with self.connection:
+                for key, value, rows in records:
+                    inserted = self.connection.execute(
+                        'INSERT OR IGNORE INTO predictions (key, value, rows, used) VALUES (?, ?, ?, ?)',
+                        (key, value, rows, self._clock)).rowcount
+                    if inserted > 0:
+                        self.entries += 1
+                        self.rows += rows
+                self._evict()
+
+    def _evict(self):
+        while self.rows > self.max_rows:
+            oldest = self.connection.execute(
+                'SELECT key, rows FROM predictions ORDER BY used LIMIT ?', (QUERY_SIZE,)).fetchall()
+            if not oldest:
+                # the table was changed by another connection, count it again
+                self.entries, self.rows = self.connection.execute(
+                    'SELECT COUNT(*), COALESCE(SUM(rows), 0) FROM predictions').fetchone()
+                return
+            evicted = []
+            for key, rows in oldest:
+                if self.rows <= self.max_rows:
+                    break
+                evicted.append(key)
+                self.entries -= 1
+                self.rows -= rows
+            self.connection.execute('DELETE FROM predictions WHERE key IN (%s)' % ','.join('?' * len(evicted)),
+                                    evicted)
+
+    def predict(self, model, station, x):
+        '''
+        It returns the predictions of the model for the rows of x, running
+        the model (once) only over the blocks not found in the cache. The
+        model gets the rows in the dtype of x.
+        '''
+        x = np.asarray(x)
+        if x.ndim == 1:
+            x = x.reshape(1, -1)
+        hashes = row_hashes(x)
+        bounds = block_bounds(hashes, self.block_size)
+        keys = block_keys(model_prefix(model, station, x.dtype), hashes, bounds)
+        found = self.get(keys)
+
+        y_pred = np.empty(len(x), dtype=np.float64)
+        missing = []
+        for key, (start, stop) in zip(keys, bounds):
+            if key in found:
+                y_pred[start:stop] = found[key]
+            else:
+                missing.append((key, start, stop))
+
+        if missing:
+            rows = np.concatenate([np.arange(start, stop) for _, start, stop in missing])
+            y_pred[rows] = np.ravel(model.predict(x[rows]))
+            self.put([key for key, _, _ in missing], [y_pred[start:stop] for _, start, stop in missing])
+
+        with self._lock:
+            n_missing = sum(stop - start for _, start, stop in missing)
+            self.hits += len(x) - n_missing
+            self.misses += n_missing
+        return y_pred
+
+    def attach(self, mlModel):
+        '''
+        It makes predictValues of a station class instance go through the
+        cache (predictValues itself is not changed).
+        '''
+        mlModel.model = CachedModel(mlModel.model, mlModel.station, self)
+        return mlModel
+
+    def stats(self):
+        '''
+        It returns the hits, misses and hit rate of the rows looked up, and
+        the blocks and rows stored.
+        '''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'entries': self.entries, 'rows': self.rows, 'max_rows': self.max_rows}
+
+    def clear(self):
+        '''
+        It removes every prediction and resets the counters.
+        '''
+        with self._lock:
+            with self.connection:
+                self.connection.execute('DELETE FROM predictions')
+            self.entries = self.rows = self.hits = self.misses = 0
+
+    def close(self):
+        self.connection.close()
+
+
+class CachedModel():
+    """
+    A station model whose predict goes through a PredictionCache.
+    """
+    def __init__(self, model, station, cache):
+        self.model = model
+        self.station = station
+        self.cache = cache
+
+    def predict(self, x):
+        return self.cache.predict(self.model, self.station, x)
@@ -0,0 +1,310 @@
+'''
+Local HTTP prediction service with dynamic micro-batching.
+
+A long-running asyncio server keeps the station models loaded and takes
+single station-day records as JSON:
+
+    POST /predict/cor06
+    {"tx": 31.2, "tn": 14.5, "ra": 38.1, "energyt": 512.0, "hormin_tx": 15,
+     "tx_prev": 30.4, "tn_next": 15.1}
+
+    -> {"station": "cor06", "rs_pred": 24.73}
+
+The inputs are the raw values (deltat is computed from tx and tn when it
+is not given), the standardization is done by the server. Concurrent
+requests for the same model are merged into one micro-batch: the first
+request of a batch waits at most max_latency seconds for others (or until
+max_batch requests), then the whole batch is predicted with a single call
+and every request gets its own response.
+
+    GET /stats  -> requests, p50/p99 latency (ms) and batch sizes per model
+    GET /health -> {"status": "ok", "stations": [...]}
+
+Only the standard library is used (no web framework), so it can be tested
+with a local client.
+
+Usage:
+    python PredictionServer.py [--port 8080] [--max-latency 0.005] [--max-batch 256]
+'''
+import argparse
+import asyncio
+import collections
+import json
+import math
+import time
+import numpy as np
+import ModelRegistry as registry
+
+# latencies and batch sizes kept for the stats of each model
+STATS_WINDOW = 10000
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           431: 'Request Header Fields Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+def record_inputs(station, record):
+    '''
+    It returns the inputs of a model, in order, from a JSON record. deltat
+    is computed from tx and tn when it is not in the record. It raises
+    ValueError when an input is missing or not finite (json.loads takes
+    NaN and Infinity).
+    '''
+    if 'deltat' not in record and 'tx' in record and 'tn' in record:
+        record = dict(record, deltat=record['tx'] - record['tn'])
+    parameters = registry.get_parameters(station)[:-1]
+    missing = [parameter for parameter in parameters if record.get(parameter) is None]
+    if missing:
+        raise ValueError('missing inputs for %s: %s' % (station, ', '.join(missing)))
+    inputs = [float(record[parameter]) for parameter in parameters]
+    invalid = [parameter for parameter, value in zip(parameters, inputs) if not math.isfinite(value)]
+    if invalid:
+        raise ValueError('non-finite inputs for %s: %s' % (station, ', '.join(invalid)))
+    return inputs
+
+
+class MicroBatcher():
+    """
+    It merges the concurrent requests of a model into batches.
+
+    Inputs:
+        station: station code of the model
+        max_latency: seconds the first request of a batch waits for others
+        max_batch: maximum number of requests per batch
+    """
+    def __init__(self, station, max_latency=0.005, max_batch=256):
+        self.station = station
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+        self.model = registry.get_raw_model(station)
+        self.queue = asyncio.Queue()
+        self.latencies = collections.deque(maxlen=STATS_WINDOW)
+        self.batch_sizes = collections.deque(maxlen=STATS_WINDOW)
+        self.requests = 0
+        self.task = None
+        self.stopped = False
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        '''
+        It stops the batcher. The requests still queued, or in the batch
+        being predicted, fail with RuntimeError instead of waiting forever.
+        '''
+        self.stopped = True
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        while not self.queue.empty():
+            self._fail([self.queue.get_nowait()])
+
+    def _fail(self, batch):
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(RuntimeError('the %s model is stopped' % self.station))
+
+    async def predict(self, inputs):
+        '''
+        It queues a record and waits for its prediction.
+        '''
+        if self.stopped:
+            raise RuntimeError('the %s model is stopped' % self.station)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((inputs, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        try:
+            while True:
+                batch = [await self.queue.get()]
+                deadline = loop.time() + self.max_latency
+                while len(batch) < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                while len(batch) < self.max_batch and not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+
+                x = np.array([inputs for inputs, _ in batch], dtype=np.float64)
+                try:
+                    # in a thread, so the server keeps taking requests meanwhile
+                    y_pred = np.ravel(await loop.run_in_executor(None, self.model.predict, x))
+                except Exception as error:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(error)
+                    continue
+                self.batch_sizes.append(len(batch))
+                for (_, future), value in zip(batch, y_pred):
+                    if not future.done():
+                        future.set_result(float(value))
+        except asyncio.CancelledError:
+            self._fail(batch)
+            raise
+
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000
+        sizes = np.array(self.batch_sizes)
+        return {
+            'requests': self.requests,
+            'latency_ms': {
+                'p50': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                'p99': float(np.percentile(latencies, 99)) if len(latencies) else None,
+            },
+            'batches': len(sizes),
+            'batch_size': {
+                'mean': float(sizes.mean()) if len(sizes) else None,
+                'p50': float(np.percentile(sizes, 50)) if len(sizes) else None,
+                'max': int(sizes.max()) if len(sizes) else None,
+            },
+        }
+
+
+class PredictionServer():
+    """
+    asyncio HTTP server with a MicroBatcher per model.
+
+    Inputs:
+        stations: models to serve, by default every model available in models/
+        host, port: address to listen on (port 0 takes a free port)
+        max_latency, max_batch: see MicroBatcher
+    """
+    def __init__(self, stations=None, host='127.0.0.1', port=8080, max_latency=0.005, max_batch=256):
+        self.stations = list(stations) if stations is not None else registry.available_stations()
+        self.host = host
+        self.port = port
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+        self.batchers = {}
+        self.server = None
+
+    async def start(self):
+        '''
+        It loads every model, starts the batchers and listens. It returns
+        the port, useful when it was 0.
+        '''
+        # the size is restored by stop
+        self.cache_size = registry.MAX_CACHED_MODELS
+        registry.set_cache_size(max(registry.MAX_CACHED_MODELS, len(self.stations)))
+        for station in self.stations:
+            self.batchers[station] = MicroBatcher(station, self.max_latency, self.max_batch)
+            self.batchers[station].start()
+        self.server = await asyncio.start_server(self.handle, self.host, self.port, backlog=1024)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self):
+        '''
+        It stops listening and the batchers, the requests not predicted yet
+        get a 503, and restores the size of the model cache.
+        '''
+        self.server.close()
+        await asyncio.gather(*[batcher.stop() for batcher in self.batchers.values()])
+        await self.server.wait_closed()
+        registry.set_cache_size(self.cache_size)
+
+    async def serve_forever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def stats(self):
+        return {station: batcher.stats() for station, batcher in self.batchers.items()}
+
+    async def handle(self, reader, writer):
+        '''
+        It serves the requests of a connection (keep-alive) until it is closed.
+        '''
+        try:
+            while True:
+                try:
+                    request_line = await reader.readline()
+                    if not request_line:
+                        break
+                    headers = {}
+                    while True:
+                        line = await reader.readline()
+                        if line in (b'\r\n', b'\n', b''):
+                            break
+                        name, _, value = line.decode('latin-1').partition(':')
+                        headers[name.strip().lower()] = value.strip()
+                except ValueError:
+                    # a line longer than the limit of the StreamReader
+                    await self.respond(writer, 431, {'error': 'request line or header too long'}, False)
+                    break
+                try:
+                    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                    length = int(headers.get('content-length', 0))
+                    if length < 0:
+                        raise ValueError('negative Content-Length')
+                except ValueError:
+                    # the rest of the connection cannot be parsed, answer and close it
+                    await self.respond(writer, 400, {'error': 'malformed request'}, False)
+                    break
+                body = await reader.readexactly(length)
+
+                status, response = await self.route(method, path, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                await self.respond(writer, status, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, response, keep_alive=True):
+        payload = json.dumps(response).encode('utf-8')
+        writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n'
+                     b'Content-Length: %d\r\nConnection: %s\r\n\r\n'
+                     % (status, REASONS[status].encode(), len(payload),
+                        b'keep-alive' if keep_alive else b'close') + payload)
+        await writer.drain()
+
+    async def route(self, method, path, body):
+        '''
+        It returns the status and the JSON response of a request.
+        '''
+        if path == '/health':
+            return 200, {'status': 'ok', 'stations': self.stations}
+        if path == '/stats':
+            return 200, self.stats()
+        if not path.startswith('/predict/'):
+            return 404, {'error': 'unknown path %s' % path}
+        station = path[len('/predict/'):]
+        if station not in self.batchers:
+            return 404, {'error': 'unknown station %s, use one of %s' % (station, self.stations)}
+        if method != 'POST':
+            return 405, {'error': 'use POST'}
+
+        start = time.perf_counter()
+        batcher = self.batchers[station]
+        try:
+            inputs = record_inputs(station, json.loads(body))
+        except (ValueError, TypeError, AttributeError) as error:
+            return 400, {'error': str(error)}
+        try:
+            rs_pred = await batcher.predict(inputs)
+        except Exception as error:
+            return 503 if batcher.stopped else 500, {'error': str(error)}
+        batcher.requests += 1
+        batcher.latencies.append(time.perf_counter() - start)
+        return 200, {'station': station, 'rs_pred': rs_pred}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--stations', nargs='+', help='station models, by default all')
+    parser.add_argument('--max-latency', type=float, default=0.005, help='seconds')
+    parser.add_argument('--max-batch', type=int, default=256)
+    args = parser.parse_args()
+
+    server = PredictionServer(args.stations, args.host, args.port, args.max_latency, args.max_batch)
+    asyncio.run(server.serve_forever())
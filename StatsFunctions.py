@@ -3,13 +3,148 @@ Import libraries and functions
 '''
 import math
 import numpy as np
-import statistics
-from sklearn.linear_model import LinearRegression
-from sklearn.metrics import r2_score
-import matplotlib.pyplot as plt
 
 sqrt = math.sqrt
-mean = statistics.mean
+
+def compute_all_metrics(x, y):
+    '''
+    It calculates every metric from a single vectorized pass over the
+    residuals, converting the inputs only once.
+
+    Input:
+        * x -> list or array of measured/actual data. For example,
+        in terms of et0, it would be FAO56-PM et0.
+
+        * y -> list or array of predicted values. For example, in
+        terms of et0, it would be the predicted et0 by a neural
+        network model, etc.
+
+    Output:
+        * metrics -> a dict of floats with rmse, rrmse, mbe, re, ratio,
+        r2 and nse. rrmse and re are given per-unit, instead of per-cent.
+    '''
+    # convert the inputs in 1d float numpy arrays (no copy if they already are)
+    x = np.ravel(np.asarray(x, dtype=np.float64))
+    y = np.ravel(np.asarray(y, dtype=np.float64))
+    # check the lengths are the same
+    assert len(x)==len(y)
+    n = len(x)
+
+    x_mean = float(x.sum()) / n
+    y_mean = float(y.sum()) / n
+    delta = y - x
+    sse = np.dot(delta, delta)
+    delta_measured = x - x_mean
+    delta_prediction = y - y_mean
+    sxx = np.dot(delta_measured, delta_measured)
+    syy = np.dot(delta_prediction, delta_prediction)
+    sxy = np.dot(delta_measured, delta_prediction)
+
+    rmse = sqrt(sse / n)
+    mbe = y_mean - x_mean
+    return {
+        'rmse': rmse,
+        'rrmse': rmse / x_mean,
+        'mbe': mbe,
+        're': mbe / x_mean,
+        'ratio': y_mean / x_mean,
+        'r2': float((sxy / sqrt(sxx * syy))**2),
+        'nse': float(1 - sse / sxx),
+    }
+
+class MetricsAccumulator():
+    """
+    Streaming version of compute_all_metrics. The measured/predicted data
+    are given in chunks through update, so the whole series never has to
+    be in memory, and accumulators filled in different processes can be
+    merged. It keeps the count, the means, the sums of squared deviations
+    and the co-moment (Chan et al. parallel algorithm) plus the sum of
+    squared residuals, and returns the same values as the batch functions
+    up to floating point rounding.
+    """
+    def __init__(self):
+        self.n = 0
+        self.x_mean = 0.0
+        self.y_mean = 0.0
+        self.sxx = 0.0
+        self.syy = 0.0
+        self.sxy = 0.0
+        self.sse = 0.0
+
+    def update(self, x, y):
+        """
+        It adds a chunk of measured (x) and predicted (y) values.
+        """
+        x = np.ravel(np.asarray(x, dtype=np.float64))
+        y = np.ravel(np.asarray(y, dtype=np.float64))
+        assert len(x)==len(y)
+        if len(x) == 0:
+            return self
+
+        chunk = MetricsAccumulator()
+        chunk.n = len(x)
+        chunk.x_mean = float(x.sum()) / chunk.n
+        chunk.y_mean = float(y.sum()) / chunk.n
+        delta = y - x
+        delta_measured = x - chunk.x_mean
+        delta_prediction = y - chunk.y_mean
+        chunk.sse = float(np.dot(delta, delta))
+        chunk.sxx = float(np.dot(delta_measured, delta_measured))
+        chunk.syy = float(np.dot(delta_prediction, delta_prediction))
+        chunk.sxy = float(np.dot(delta_measured, delta_prediction))
+        return self.merge(chunk)
+
+    def merge(self, other):
+        """
+        It adds the data of another accumulator to this one.
+        """
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.__dict__.update(other.__dict__)
+            return self
+
+        n = self.n + other.n
+        dx = other.x_mean - self.x_mean
+        dy = other.y_mean - self.y_mean
+        weight = self.n * other.n / n
+
+        self.x_mean += dx * other.n / n
+        self.y_mean += dy * other.n / n
+        self.sxx += other.sxx + dx * dx * weight
+        self.syy += other.syy + dy * dy * weight
+        self.sxy += other.sxy + dx * dy * weight
+        self.sse += other.sse
+        self.n = n
+        return self
+
+    def mbe(self):
+        return self.y_mean - self.x_mean
+
+    def rmse(self):
+        return sqrt(self.sse / self.n)
+
+    def r2(self):
+        return float((self.sxy / sqrt(self.sxx * self.syy))**2)
+
+    def nse(self):
+        return float(1 - self.sse / self.sxx)
+
+    def result(self):
+        """
+        It returns the same dict as compute_all_metrics.
+        """
+        rmse = self.rmse()
+        mbe = self.mbe()
+        return {
+            'rmse': rmse,
+            'rrmse': rmse / self.x_mean,
+            'mbe': mbe,
+            're': mbe / self.x_mean,
+            'ratio': self.y_mean / self.x_mean,
+            'r2': self.r2(),
+            'nse': self.nse(),
+        }
 
 def get_mean_bias_error(x, y):
     '''
@@ -26,15 +161,7 @@ def get_mean_bias_error(x, y):
     Output:
         * mbe -> a float with the mean bias error value
     '''
-    # check the lengths are the same 
-    assert len(x)==len(y)
-    # convert the inputs in numpy array
-    x = np.array(x)
-    y = np.array(y)
-    # mbe calculus
-    delta = y - x
-    mbe = float(sum(delta)*1.0/len(x))
-    return(mbe)
+    return compute_all_metrics(x, y)['mbe']
 
 def get_root_mean_square_error(x, y):
     '''
@@ -51,15 +178,7 @@ def get_root_mean_square_error(x, y):
     Output:
         * rmse -> a float with the root mean squared error value
     '''
-    # check the lengths are the same 
-    assert len(x)==len(y)
-    # convert the inputs in numpy array
-    x = np.array(x)
-    y = np.array(y)
-    # rmse calculus
-    delta = (y - x)**2
-    rmse = sqrt(sum(delta)*1.0/len(x))
-    return rmse
+    return compute_all_metrics(x, y)['rmse']
 
 def get_relative_error(x, y):
     '''
@@ -77,16 +196,7 @@ def get_relative_error(x, y):
         * re -> a float with the relative error value. The value given 
         is a function of per-unit, instead of per-cent.
     '''
-    # check the lengths are the same 
-    assert len(x)==len(y)
-    # convert the inputs in numpy array
-    x = np.array(x)
-    y = np.array(y)
-    # re calculus
-    mbe = get_mean_bias_error(x, y)
-    x_mean = mean(x)
-    re = mbe/x_mean
-    return re
+    return compute_all_metrics(x, y)['re']
 
 def get_ratio_error(x, y):
     '''
@@ -104,13 +214,7 @@ def get_ratio_error(x, y):
         * re -> a float with the relative error value. The value given 
         is a function of per-unit, instead of per-cent.
     '''
-    # check the lengths are the same 
-    assert len(x)==len(y)
-    # convert the inputs in numpy array
-    x = np.array(x)
-    y = np.array(y)
-    # ratio error calculus
-    return mean(y)/mean(x)
+    return compute_all_metrics(x, y)['ratio']
 
 def get_coefficient_of_determination(x, y):
     '''
@@ -127,25 +231,11 @@ def get_coefficient_of_determination(x, y):
         * R2 -> a float with the coefficient of determination in 
         per unit, instead of percentage.
     '''
-    # check the lengths are the same 
-    assert len(x)==len(y)
-    # convert the inputs in numpy array
-    x = np.array(x)
-    y = np.array(y)
-
-    # determines the means of the values
-    x_mean = mean(x)
-    y_mean = mean(y)
-    delta_measured = x - x_mean
-    delta_measured_2 = (x - x_mean)**2
-    delta_prediction = y - y_mean
-    delta_prediction_2 = (y - y_mean)**2
-    R2 = (sum(delta_measured*delta_prediction)/sqrt(sum(delta_measured_2)*sum(delta_prediction_2)))**2
-    return R2
+    return compute_all_metrics(x, y)['r2']
 
 def get_nash_suteliffe_efficiency(x, y):
     '''
-    It calculates NSE. It is calculated by sklearn.metrics.r2_score
+    It calculates NSE. It gives the same value as sklearn.metrics.r2_score
 
     Input:
         * x -> list or array of measured/actual data. For example,
@@ -158,12 +248,4 @@ def get_nash_suteliffe_efficiency(x, y):
         * nse -> a float with the coefficient of determination in 
         per unit, instead of percentage.
     '''
-    # check the lengths are the same 
-    assert len(x)==len(y)
-    # convert the inputs in numpy array
-    x = np.array(x)
-    y = np.array(y)
-
-    return r2_score(x, y)
-
-
+    return compute_all_metrics(x, y)['nse']
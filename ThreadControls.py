@@ -0,0 +1,124 @@
+'''
+Thread settings of the model backends.
+
+TensorFlow, XGBoost and the BLAS library used by NumPy and scikit-learn
+(the SVM, ELM and NumPy MLP models) each start a thread pool as large as
+the number of cores. Running several models or worker processes at the
+same time then oversubscribes the CPU. configure sets the threads of all
+of them from one place:
+
+    * blas -> threads of the BLAS/OpenMP libraries (through threadpoolctl
+    when it is installed, and the environment variables read by the
+    processes started afterwards)
+
+    * intra_op, inter_op -> TensorFlow intra-/inter-op parallelism threads
+
+    * xgboost -> nthread (n_jobs) of the XGBoost models
+
+The settings are applied to the backends already imported and to the ones
+imported later, right after their import (see LazyImports.on_import).
+TensorFlow does not accept changes once it has run an operation, so it
+has to be configured before the first MLP model is loaded with keras.
+
+For pool workers, one_thread_per_core gives the "one process per core,
+one thread per process" setting.
+'''
+import os
+import warnings
+import LazyImports as lazy
+
+# current settings, None leaves the backend default
+THREADS = {
+    'blas': None,
+    'intra_op': None,
+    'inter_op': None,
+    'xgboost': None,
+}
+
+# environment variables read by the BLAS/OpenMP libraries when they start
+BLAS_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                  'BLIS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def _apply_blas():
+    threads = THREADS['blas']
+    if threads is None:
+        return
+    for variable in BLAS_VARIABLES:
+        os.environ[variable] = str(threads)
+    try:
+        threadpoolctl = lazy.import_backend('threadpoolctl')
+    except ImportError:
+        return
+    threadpoolctl.threadpool_limits(limits=threads)
+
+def _apply_tensorflow(keras=None):
+    if THREADS['intra_op'] is None and THREADS['inter_op'] is None:
+        return
+    import tensorflow as tf
+    try:
+        if THREADS['intra_op'] is not None:
+            tf.config.threading.set_intra_op_parallelism_threads(THREADS['intra_op'])
+        if THREADS['inter_op'] is not None:
+            tf.config.threading.set_inter_op_parallelism_threads(THREADS['inter_op'])
+    except RuntimeError as error:
+        warnings.warn('TensorFlow threads cannot be changed after it is initialized: %s' % error)
+
+def apply_xgboost(model):
+    '''
+    It sets the threads of an XGBoost model (called by the registry loader).
+    '''
+    if THREADS['xgboost'] is not None and hasattr(model, 'set_params'):
+        model.set_params(n_jobs=THREADS['xgboost'])
+    return model
+
+def _apply_xgboost():
+    import ModelRegistry as registry
+    for station in registry.cached_stations():
+        if station in registry.STATIONS and registry.STATIONS[station]['loader'] == 'xgboost':
+            apply_xgboost(registry.get_model(station))
+
+
+def configure(threads=None, blas=None, intra_op=None, inter_op=None, xgboost=None):
+    '''
+    It sets the threads of the backends.
+
+    Input:
+        * threads -> default for every setting not given
+
+        * blas, intra_op, inter_op, xgboost -> threads of each backend
+        (see the module docstring). None keeps the current setting.
+
+    Output:
+        * settings -> dict with the settings in place
+    '''
+    settings = {'blas': blas, 'intra_op': intra_op, 'inter_op': inter_op, 'xgboost': xgboost}
+    settings = {name: threads if value is None else value for name, value in settings.items()}
+    if any(value is not None and value < 1 for value in settings.values()):
+        raise ValueError('the number of threads must be at least 1')
+    THREADS.update({name: int(value) for name, value in settings.items() if value is not None})
+
+    _apply_blas()
+    if lazy.is_loaded('keras'):
+        _apply_tensorflow()
+    if lazy.is_loaded('xgboost'):
+        _apply_xgboost()
+    return dict(THREADS)
+
+def one_thread_per_core():
+    '''
+    It sets every backend to a single thread and returns the number of
+    cores, the number of worker processes to start.
+    '''
+    configure(threads=1)
+    return os.cpu_count()
+
+def threads_per_worker(workers):
+    '''
+    It returns the threads each of the worker processes can use without
+    oversubscribing the CPU.
+    '''
+    return max(1, os.cpu_count() // max(1, workers))
+
+
+lazy.on_import('keras', _apply_tensorflow)
@@ -0,0 +1,85 @@
+'''
+Scaling benchmark of the parallel batch runner.
+
+It builds a synthetic network backfill, the example dataset repeated over
+several stations and files, and runs BatchRunner.run_batch on it with
+1, 2, 4, ... workers up to the number of cores, reporting the rows
+predicted per second and the speed-up over a single worker.
+
+Usage:
+    python benchmarks/bench_batch.py [--files 8] [--stations 200] [--output batch.json]
+'''
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import BatchRunner as batch  # noqa: E402
+
+EXAMPLE = os.path.join(ROOT, 'data', 'ncei-asheville-example.csv')
+MODELS = ['mag01', 'sev09', 'gra03', 'hue08', 'jae07', 'cor06']
+
+
+def make_files(directory, n_files, n_stations):
+    '''
+    It writes n_files csv files with the example rows of n_stations stations.
+    '''
+    dfExample = pd.read_csv(EXAMPLE)
+    fileLocations = []
+    for i in range(n_files):
+        dfFile = pd.concat([dfExample.assign(station=station)
+                            for station in range(i * n_stations, (i + 1) * n_stations)])
+        fileLocation = os.path.join(directory, 'backfill_%03d.csv' % i)
+        dfFile.to_csv(fileLocation, index=False)
+        fileLocations.append(fileLocation)
+    return fileLocations
+
+def worker_counts(cores):
+    counts = [1]
+    while counts[-1] * 2 <= cores:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != cores:
+        counts.append(cores)
+    return counts
+
+def run(n_files, n_stations, stations):
+    results = {'cores': os.cpu_count(), 'files': n_files, 'stations': stations, 'runs': []}
+    with tempfile.TemporaryDirectory() as directory:
+        fileLocations = make_files(directory, n_files, n_stations)
+        for workers in worker_counts(os.cpu_count()):
+            start = time.perf_counter()
+            dfReport = batch.run_batch(fileLocations, 'csv', stations, workers)
+            elapsed = time.perf_counter() - start
+            rows = int(dfReport['rows'].sum())
+            results['runs'].append({'workers': workers, 'seconds': elapsed, 'rows': rows,
+                                    'rows_per_s': rows / elapsed})
+
+    single = results['runs'][0]['rows_per_s']
+    for result in results['runs']:
+        result['speedup'] = result['rows_per_s'] / single
+        result['efficiency'] = result['speedup'] / result['workers']
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--files', type=int, default=8)
+    parser.add_argument('--stations', type=int, default=200, help='stations per file')
+    parser.add_argument('--models', nargs='+', default=MODELS)
+    parser.add_argument('--output', help='json file to store the results')
+    args = parser.parse_args()
+
+    results = run(args.files, args.stations, args.models)
+    for result in results['runs']:
+        print('%3d workers %8.2f s %12.0f rows/s  speed-up %.2f (%.0f%%)' % (
+            result['workers'], result['seconds'], result['rows_per_s'],
+            result['speedup'], 100 * result['efficiency']))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
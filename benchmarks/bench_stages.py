@@ -0,0 +1,242 @@
+'''
+Stage benchmark of the station classes.
+
+It writes synthetic station-day tables, with the columns of
+data/ncei-asheville-example.csv, of 1e3 to 1e7 rows and times each stage
+of every station class:
+
+    import_dataset -> getStandardDataTest -> predictValues -> statAnalysis
+
+Each class and size runs in a new interpreter, so the numbers are not
+mixed with the other runs:
+
+    * cold: the first pass, after importing the module and building the
+    class (model loaded from disk), both timed too
+
+    * warm: the best of --repeat passes more in the same process
+
+It reports the seconds and rows/s of every stage and the peak RSS of the
+process. The results are stored as JSON with the commit they come from,
+and --compare prints the change of every stage against a previous file,
+exiting with status 1 when one is slower than --threshold.
+
+--dtype float32 runs the classes in the float32 mode, and --precision
+prints the accuracy impact of that mode instead: the max abs. difference
+of the predictions and the RMSE of every class in float64 and float32,
+over a synthetic table of each size (the table in README.md).
+
+Usage:
+    python benchmarks/bench_stages.py [--sizes 1000 10000 100000] [--type parquet] [--output stages.json]
+    python benchmarks/bench_stages.py --compare stages_before.json stages_after.json
+    python benchmarks/bench_stages.py --precision --sizes 200000
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import ModelRegistry as registry  # noqa: E402
+import DatasetFunctions as dataset  # noqa: E402
+
+EXAMPLE = os.path.join(ROOT, 'data', 'ncei-asheville-example.csv')
+MODELS = ['mag01', 'sev09', 'gra03', 'hue08', 'jae07', 'cor06', 'alm04', 'ash08']
+SIZES = [1000, 10000, 100000, 1000000, 10000000]
+STAGES = ['import_dataset', 'getStandardDataTest', 'predictValues', 'statAnalysis']
+
+# run in a new interpreter: import, build, a cold pass and the warm passes
+STAGE_RUN = '''
+import json, resource, sys, time
+sys.path.insert(0, %(root)r)
+start = time.perf_counter()
+import ModelRegistry as registry
+mlClass = registry.get_class(%(station)r)
+import_s = time.perf_counter() - start
+start = time.perf_counter()
+mlModel = mlClass(dtype=%(dtype)r)
+init_s = time.perf_counter() - start
+
+def run_stages():
+    seconds = {}
+    for stage, arguments in [('import_dataset', (%(file)r, %(type)r)), ('getStandardDataTest', ()),
+                             ('predictValues', ()), ('statAnalysis', ())]:
+        start = time.perf_counter()
+        getattr(mlModel, stage)(*arguments)
+        seconds[stage] = time.perf_counter() - start
+    return seconds
+
+cold = run_stages()
+warm = [run_stages() for _ in range(%(repeat)d)]
+warm = {stage: min(run[stage] for run in warm) for stage in cold}
+print(json.dumps({'import_s': import_s, 'init_s': init_s, 'rows': len(mlModel.y_test), 'cold': cold,
+                  'warm': warm, 'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+'''
+
+
+def make_dataset(fileLocation, fileType, rows, seed=0):
+    '''
+    It writes a synthetic table of rows station-days with the columns of the
+    example dataset: stations of 365 consecutive days, temperatures with a
+    seasonal cycle, and ra from latitude and doy.
+    '''
+    rng = np.random.default_rng(seed)
+    columns = pd.read_csv(EXAMPLE, nrows=0).columns
+    doy = np.arange(rows) % 365 + 1
+    station = np.arange(rows) // 365
+    latitude = np.round(rng.uniform(25, 48, station[-1] + 1), 2)[station]
+    date = pd.Timestamp('2018-01-01') + pd.to_timedelta(doy - 1, unit='D')
+
+    season = -np.cos(2 * np.pi * (doy + 10) / 365)
+    tx = np.round(18 + 10 * season + rng.normal(0, 3, rows), 1)
+    tn = np.round(tx - rng.uniform(4, 18, rows), 1)
+    dfData = pd.DataFrame({
+        columns[0]: np.arange(rows),
+        'station': station,
+        'latitude': latitude,
+        'longitude': np.round(-82.61 + station % 100 * 0.1, 2),
+        'year': 2018,
+        'month': date.month,
+        'day': date.day,
+        'doy': doy,
+        'tx': tx,
+        'tn': tn,
+        'rs': np.round(np.clip(180 + 120 * season + rng.normal(0, 60, rows), 5, None), 3),
+        'energyt': np.round((tx + tn) * 12 + rng.normal(0, 40, rows), 1),
+        'hormin_tx': rng.integers(12, 18, rows).astype(np.float64),
+        'hormin_tn': rng.integers(0, 8, rows).astype(np.float64),
+    })
+    dataset.add_ra(dfData)
+    for column in ['tx', 'tn', 'hormin_tx', 'hormin_tn', 'energyt']:
+        dfData[column + '_prev'] = dfData.groupby('station')[column].shift(1)
+    dataset.write_file(dfData[columns], fileLocation, fileType)
+    return fileLocation
+
+def run_stages(station, fileLocation, fileType, repeat, dtype='float64'):
+    statement = STAGE_RUN % {'root': ROOT, 'station': station, 'file': fileLocation, 'type': fileType,
+                             'repeat': repeat, 'dtype': dtype}
+    output = subprocess.run([sys.executable, '-c', statement], cwd=ROOT, check=True,
+                            capture_output=True, text=True).stdout
+    result = json.loads(output.splitlines()[-1])
+    for run in ['cold', 'warm']:
+        result[run + '_rows_per_s'] = {stage: result['rows'] / seconds if seconds else None
+                                       for stage, seconds in result[run].items()}
+    return result
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(sizes, stations, fileType='parquet', repeat=3, dtype='float64'):
+    stations = [station for station in stations if registry.is_available(station)]
+    results = {'commit': commit(), 'python': sys.version.split()[0], 'numpy': np.__version__,
+               'cores': os.cpu_count(), 'fileType': fileType, 'dtype': dtype, 'runs': []}
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in sizes:
+            fileLocation = make_dataset(os.path.join(directory, 'synthetic_%d.%s' % (rows, fileType)),
+                                        fileType, rows)
+            for station in stations:
+                result = run_stages(station, fileLocation, fileType, repeat, dtype)
+                results['runs'].append(dict(result, model=station, size=rows))
+    return results
+
+def precision_impact(sizes, stations, fileType='parquet'):
+    '''
+    It returns a pandas Dataframe with the max abs. difference of the
+    predictions of every class in float32 against float64, and the RMSE
+    in both modes, per model and size.
+    '''
+    stations = [station for station in stations if registry.is_available(station)]
+    records = []
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in sizes:
+            fileLocation = make_dataset(os.path.join(directory, 'synthetic_%d.%s' % (rows, fileType)),
+                                        fileType, rows)
+            for station in stations:
+                predictions, rmse = {}, {}
+                for dtype in ['float64', 'float32']:
+                    mlModel = registry.get_class(station)(dtype=dtype)
+                    mlModel.import_dataset(fileLocation, fileType)
+                    mlModel.getStandardDataTest()
+                    predictions[dtype] = mlModel.predictValues().astype(np.float64)
+                    rmse[dtype] = mlModel.statAnalysis()[0]
+                records.append({'model': station, 'size': rows,
+                                'max_abs_diff': float(np.abs(predictions['float32'] - predictions['float64']).max()),
+                                'rmse_float64': rmse['float64'], 'rmse_float32': rmse['float32']})
+    return pd.DataFrame(records).set_index(['model', 'size'])
+
+def stage_table(results, run='warm'):
+    '''
+    It returns a pandas Dataframe with the seconds of each stage per model
+    and size, plus the start-up (cold only) and the peak RSS.
+    '''
+    records = []
+    for result in results['runs']:
+        record = {'model': result['model'], 'size': result['size']}
+        if run == 'cold':
+            record.update(import_s=result['import_s'], init_s=result['init_s'])
+        record.update(result[run])
+        record['peak_rss_mb'] = result['peak_rss_mb']
+        records.append(record)
+    return pd.DataFrame(records).set_index(['model', 'size'])
+
+def compare(before, after, threshold=0.2):
+    '''
+    It returns the ratio after/before of the warm seconds of every stage
+    for the models and sizes in both results, and the ones slower than
+    1 + threshold.
+    '''
+    dfBefore, dfAfter = stage_table(before), stage_table(after)
+    common = dfBefore.index.intersection(dfAfter.index)
+    dfRatio = dfAfter.loc[common, STAGES] / dfBefore.loc[common, STAGES]
+    regressions = dfRatio[(dfRatio > 1 + threshold).any(axis=1)]
+    return dfRatio, regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', nargs='+', type=int, default=SIZES)
+    parser.add_argument('--models', nargs='+', default=MODELS)
+    parser.add_argument('--type', default='parquet', help='format of the synthetic files')
+    parser.add_argument('--repeat', type=int, default=3, help='warm passes')
+    parser.add_argument('--dtype', default='float64', choices=['float64', 'float32'])
+    parser.add_argument('--precision', action='store_true', help='accuracy of float32 against float64')
+    parser.add_argument('--output', help='json file to store the results')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='json files to compare')
+    parser.add_argument('--threshold', type=float, default=0.2, help='slow-down reported as regression')
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as before, open(args.compare[1]) as after:
+            dfRatio, regressions = compare(json.load(before), json.load(after), args.threshold)
+        print('after / before, warm seconds')
+        print(dfRatio.round(2).to_string())
+        if len(regressions):
+            print('\nregressions over %d%%' % (args.threshold * 100))
+            print(regressions.round(2).to_string())
+        sys.exit(1 if len(regressions) else 0)
+
+    if args.precision:
+        print(precision_impact(args.sizes, args.models, args.type).to_string(
+            formatters={'max_abs_diff': '{:.1e}'.format, 'rmse_float64': '{:.6f}'.format,
+                        'rmse_float32': '{:.6f}'.format}))
+        sys.exit(0)
+
+    results = run(args.sizes, args.models, args.type, args.repeat, args.dtype)
+    pd.set_option('display.width', 200)
+    print('cold start, seconds')
+    print(stage_table(results, 'cold').round(4).to_string())
+    print('\nwarm, seconds')
+    print(stage_table(results, 'warm').round(4).to_string())
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
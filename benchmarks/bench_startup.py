@@ -0,0 +1,94 @@
+'''
+Cold-start benchmark.
+
+It measures the time needed by a fresh interpreter to import each module,
+e.g. python -c "import cor06_svm", and checks it against a budget. The
+interpreter start-up itself (python -c "pass") is measured too and
+subtracted, so the numbers only show the cost of our imports.
+
+Usage:
+    python benchmarks/bench_startup.py [--repeat 5] [--output startup.json]
+
+It exits with status 1 when a module goes over its budget.
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# seconds allowed to import each module (interpreter start-up excluded).
+# None of them should import TensorFlow, XGBoost, hpelm or scikit-learn.
+BUDGETS = {
+    'StatsFunctions': 0.5,
+    'ModelRegistry': 0.1,
+    'cor06_svm': 1.0,
+    'alm04_elm': 1.0,
+    'ash08_xgb': 1.0,
+    'mag01_mlp': 1.0,
+    'sev09_mlp': 1.0,
+    'gra03_mlp': 1.0,
+    'hue08_mlp': 1.0,
+    'jae07_mlp': 1.0,
+}
+
+# backends that must not be imported by a plain "import <module>"
+HEAVY_MODULES = ['tensorflow', 'xgboost', 'hpelm', 'sklearn', 'matplotlib']
+
+
+def time_import(statement, repeat):
+    '''
+    It returns the median wall time of running the statement in a new
+    interpreter, started from the repository root.
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', statement], cwd=ROOT, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def heavy_imports(module):
+    '''
+    It returns the heavy backends loaded as a side effect of importing the module.
+    '''
+    statement = ('import sys, %s; print(",".join(m for m in %r if m in sys.modules))'
+                 % (module, HEAVY_MODULES))
+    output = subprocess.run([sys.executable, '-c', statement], cwd=ROOT, check=True,
+                            capture_output=True, text=True).stdout.strip()
+    return [name for name in output.split(',') if name]
+
+def run(repeat):
+    baseline = time_import('pass', repeat)
+    results = {'python': sys.version.split()[0], 'baseline_s': baseline, 'modules': {}}
+    for module, budget in BUDGETS.items():
+        elapsed = time_import('import %s' % module, repeat) - baseline
+        results['modules'][module] = {
+            'import_s': elapsed,
+            'budget_s': budget,
+            'heavy_imports': heavy_imports(module),
+            'ok': elapsed <= budget,
+        }
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='json file to store the results')
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+    for module, result in results['modules'].items():
+        print('%-16s %7.3f s  (budget %.1f s) %s %s' % (
+            module, result['import_s'], result['budget_s'],
+            'ok' if result['ok'] else 'OVER BUDGET', ','.join(result['heavy_imports'])))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    sys.exit(0 if all(r['ok'] and not r['heavy_imports'] for r in results['modules'].values()) else 1)
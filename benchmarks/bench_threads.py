@@ -0,0 +1,105 @@
+'''
+Thread settings benchmark.
+
+It measures the throughput (rows/s) of the station models for each thread
+setting of ThreadControls:
+
+    * in a single process, with 1, 2, 4, ... threads per backend
+
+    * with the batch runner, for the splits of the cores between worker
+    processes and threads, from one process with every core to one
+    process per core with one thread each
+
+Usage:
+    python benchmarks/bench_threads.py [--rows 200000] [--output threads.json]
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import ModelRegistry as registry  # noqa: E402
+import BatchRunner as batch  # noqa: E402
+from bench_batch import make_files, worker_counts  # noqa: E402
+
+MODELS = ['mag01', 'sev09', 'gra03', 'hue08', 'jae07', 'cor06']
+
+# run in a new interpreter, so the BLAS threads are set before it starts
+SINGLE_PROCESS = '''
+import sys, time, numpy as np
+sys.path.insert(0, %(root)r)
+import ThreadControls as threads
+threads.configure(%(threads)d)
+import EnsembleRunner as ensemble
+parameters = ensemble.union_parameters(%(stations)r)[:-1]
+position = {p: i for i, p in enumerate(parameters)}
+inputs = np.random.default_rng(0).normal(10, 3, (%(rows)d, len(parameters)))
+for station in %(stations)r:
+    ensemble.predict_rows(station, inputs[:10], position)
+    start = time.perf_counter()
+    ensemble.predict_rows(station, inputs, position)
+    print(station, %(rows)d / (time.perf_counter() - start))
+'''
+
+
+def single_process(rows, stations, n_threads):
+    '''
+    It returns the rows/s of each model in a process with n_threads per backend.
+    '''
+    statement = SINGLE_PROCESS % {'root': ROOT, 'threads': n_threads, 'stations': stations, 'rows': rows}
+    output = subprocess.run([sys.executable, '-c', statement], cwd=ROOT, check=True,
+                            capture_output=True, text=True).stdout
+    return {station: float(value) for station, value in (line.split() for line in output.splitlines())}
+
+def pool_splits(n_files, n_stations, stations):
+    '''
+    It returns the rows/s of the batch runner for each workers x threads
+    split of the cores.
+    '''
+    cores = os.cpu_count()
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        fileLocations = make_files(directory, n_files, n_stations)
+        for workers in worker_counts(cores):
+            n_threads = max(1, cores // workers)
+            start = time.perf_counter()
+            dfReport = batch.run_batch(fileLocations, 'csv', stations, workers, n_threads=n_threads)
+            elapsed = time.perf_counter() - start
+            results.append({'workers': workers, 'threads': n_threads, 'seconds': elapsed,
+                            'rows_per_s': float(dfReport['rows'].sum()) / elapsed})
+    return results
+
+def run(rows, n_files, n_stations, stations):
+    stations = [station for station in stations if registry.is_available(station)]
+    results = {'cores': os.cpu_count(), 'rows': rows, 'single_process': {}, 'pool': []}
+    for n_threads in worker_counts(os.cpu_count()):
+        results['single_process'][n_threads] = single_process(rows, stations, n_threads)
+    results['pool'] = pool_splits(n_files, n_stations, stations)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--files', type=int, default=8)
+    parser.add_argument('--stations', type=int, default=200, help='stations per file')
+    parser.add_argument('--models', nargs='+', default=MODELS)
+    parser.add_argument('--output', help='json file to store the results')
+    args = parser.parse_args()
+
+    results = run(args.rows, args.files, args.stations, args.models)
+    dfSingle = pd.DataFrame(results['single_process']).rename(columns=lambda n: '%d threads' % n)
+    print('single process, rows/s')
+    print(dfSingle.round(0).to_string())
+    print('\nbatch runner, workers x threads')
+    print(pd.DataFrame(results['pool']).round(2).to_string(index=False))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
@@ -1,9 +1,8 @@
-import pickle
-import pandas as pd
 import numpy as np
 import StatsFunctions as stats
-from tensorflow import keras
-from sklearn.preprocessing import StandardScaler
+import ModelRegistry as registry
+import DatasetFunctions as dataset
+import Instrumentation as instrumentation
 
 class gra03_mlp():
     """
@@ -12,77 +11,87 @@ class gra03_mlp():
     It uses a SVM model and the following input configuration (being rs the predicted value):
         ['tx', 'tn', 'ra', 'delta_t', 'energyt', 'hormin_tx', 'tn_prev', 'rs']
 
+    With dtype=np.float32 the inputs, the standardized inputs and the
+    predictions are kept in float32, the metrics are still computed in
+    float64 (see the float32 mode in README.md).
     """
-    def __init__(self):
-        # import model
-        filename = "models/mlp_gra03_Tx_Tn_Ra_deltaT_EnergyT_HorminTx_Tn_prev_Rs.h5"
-        self.model = keras.models.load_model(filename)
+    def __init__(self, dtype=np.float64):
+        # import model (loaded once per process, see ModelRegistry)
+        self.dtype = np.dtype(dtype)
+        self.station = 'gra03'
+        self.model = registry.get_model(self.station)
 
         # define required inputs
-        self.parameters = ['tx', 'tn', 'ra', 'delta_t', 'energyt', 'hormin_tx', 'tn_prev', 'rs']
+        self.parameters = registry.get_parameters(self.station)
 
-    def import_dataset(self, fileLocation, fileType):
+    @instrumentation.instrumented('import_dataset')
+    def import_dataset(self, fileLocation, fileType, stations=None, years=None):
         """
         This function import a dataset and convert it into a pandas Dataframe
         Inputs:
             fileLocation: "data/dataSet.csv"
-            fileType: string with csv, excel or txt
+            fileType: string with csv, excel, txt, parquet, feather or arrow
+            stations, years: optional lists of station ids/years to keep. For
+                parquet/feather/arrow only the required columns are read and
+                this filter is applied by the reader.
         """
-        if fileType == 'csv' or fileType == 'txt':
-            self.dfData = pd.read_csv(fileLocation)
-        elif fileType == 'excel':
-            self.dfData = pd.read_excel(fileLocation)
-        else:
-            AssertionError('this fileType does not exit, use excel, csv and txt instead')
+        self.dfData = dataset.import_dataset(fileLocation, fileType, self.parameters, stations, years,
+                                             self.dtype)
 
-        # define deltat
-        self.dfData["deltat"] = self.dfData['tx'] - self.dfData['tn']
-        # convert rs from W/m2 to MJ/m2day-1
-        self.dfData["rs"] = self.dfData['rs'] * 0.0864
-        # filter nan values
-        self.dfData.dropna(inplace=True)
-        self.dfData.reset_index(drop=True, inplace=True)
-        # filter the parameters
-        self.dfData = self.dfData.filter(self.parameters)
+    def import_dataset_chunks(self, fileLocation, fileType='csv', chunksize=100000):
+        """
+        This function import a csv/txt dataset in chunks of rows, reading only
+        the required columns. Each chunk is left in self.dfData, so the rest of
+        the methods work on it:
+            for _ in mlModel.import_dataset_chunks("data/dataSet.csv"):
+                mlModel.getStandardDataTest()
+                mlModel.predictValues()
+        """
+        for self.dfData in dataset.import_dataset_chunks(fileLocation, fileType, self.parameters, chunksize,
+                                                         self.dtype):
+            yield self.dfData
 
+    @instrumentation.instrumented('getStandardDataTest')
     def getStandardDataTest(self):
         """
         Split data to train and test
         """
         # from training original dataset
-        mean_list = [23.26, 9.33, 29.02, 13.93, 370.37, 14.21, 9.33]
-        std_list = [8.52, 6.22, 9.42, 4.71, 177.41, 2.15, 6.23]
+        mean, std = registry.get_scaler(self.station, self.dtype)
 
         # we have the input data as x, and the output as y
-        self.x_test = np.array(self.dfData.iloc[:, :-1])
-        self.y_test = np.array(self.dfData.iloc[:, -1])
+        self.x_test = self.dfData.iloc[:, :-1].to_numpy(dtype=self.dtype, copy=True)
+        self.y_test = self.dfData.iloc[:, -1].to_numpy(dtype=self.dtype)
 
-        # standarization
-        scaler = StandardScaler()
-        scaler.mean_ = mean_list
-        scaler.scale_ = std_list
-
-        # x_train and x_test
-        self.x_test = np.array(scaler.transform(self.x_test))
+        # standarization, in place over the only copy of the inputs
+        self.x_test -= mean
+        self.x_test /= std
 
         return self.x_test, self.y_test
 
+    @instrumentation.instrumented('predictValues')
     def predictValues(self):
-        self.y_pred = np.ravel(np.array(self.model.predict(self.x_test)))
+        self.y_pred = np.ravel(np.array(self.model.predict(self.x_test), dtype=self.dtype))
         return self.y_pred
 
+    def export_predictions(self, fileLocation, fileType='parquet'):
+        """
+        This function writes the inputs and the predicted values (rs_pred)
+        Inputs:
+            fileLocation: "data/predictions.parquet"
+            fileType: string with parquet, feather, arrow, csv, txt or excel
+        """
+        dataset.export_predictions(self.dfData, self.y_pred, fileLocation, fileType)
+
+    @instrumentation.instrumented('statAnalysis')
     def statAnalysis(self):
-        rmse = stats.get_root_mean_square_error(self.y_test, self.y_pred)
-        rrmse = stats.get_root_mean_square_error(self.y_test, self.y_pred) / np.mean(self.y_test)
-        mbe = stats.get_mean_bias_error(self.y_test, self.y_pred)
-        r2 = stats.get_coefficient_of_determination(self.y_test, self.y_pred)
-        nse = stats.get_nash_suteliffe_efficiency(self.y_test, self.y_pred)
+        metrics = stats.compute_all_metrics(self.y_test, self.y_pred)
 
-        return rmse, rrmse, mbe, r2, nse
+        return metrics['rmse'], metrics['rrmse'], metrics['mbe'], metrics['r2'], metrics['nse']
 
 if __name__ == '__main__':
     mlModel = gra03_mlp()
-    mlModel.import_dataset("data/data-daily-asheville-example.csv", 'csv')
+    mlModel.import_dataset("data/ncei-asheville-example.csv", 'csv')
     mlModel.getStandardDataTest()
     mlModel.predictValues()
     rmse, rrmse, mbe, r2, nse = mlModel.statAnalysis()
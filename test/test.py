@@ -1,6 +1,29 @@
 import unittest
+import asyncio
+import json
 import os
+import importlib.util
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
 from cor06_svm import cor06_svm
+import ModelRegistry as registry
+import StatsFunctions as stats
+import DatasetFunctions as dataset
+import FeatureEngineering as features
+import InferenceEngines as engines
+import EnsembleRunner as ensemble
+import ModelRouter as router
+import BatchRunner as batch
+import ThreadControls as threads
+import LazyImports as lazy
+import PredictionCache as predcache
+import IncrementalRunner as incremental
+import PredictionServer as service
+import BatchScorer as scorer
+import Instrumentation as instrumentation
 
 # go to root location
 os.chdir("..")
@@ -16,7 +39,7 @@ class TestCor06(unittest.TestCase):
         Check we correctly import data
         """
         mlModel = cor06_svm()
-        mlModel.import_dataset("data/data-daily-asheville-example.csv", 'csv')
+        mlModel.import_dataset("data/ncei-asheville-example.csv", 'csv')
 
         self.assertNotEqual(
             first=mlModel.dfData.shape[0], second=0,
@@ -27,7 +50,7 @@ class TestCor06(unittest.TestCase):
         Check the dataset contains all parameters
         """
         mlModel = cor06_svm()
-        mlModel.import_dataset("data/data-daily-asheville-example.csv", 'csv')
+        mlModel.import_dataset("data/ncei-asheville-example.csv", 'csv')
         len_parameters = len(mlModel.parameters)
 
         self.assertEqual(
@@ -36,18 +59,1044 @@ class TestCor06(unittest.TestCase):
 
     def test_splitDataset(self):
         mlModel = cor06_svm()
-        mlModel.import_dataset("data/data-daily-asheville-example.csv", 'csv')
+        mlModel.import_dataset("data/ncei-asheville-example.csv", 'csv')
         x_test, y_test = mlModel.getStandardDataTest()
 
         self.assertEqual(first=x_test.shape[0], second=y_test.shape[0])
 
     def test_predictionValues(self):
         mlModel = cor06_svm()
-        mlModel.import_dataset("data/data-daily-asheville-example.csv", 'csv')
+        mlModel.import_dataset("data/ncei-asheville-example.csv", 'csv')
         mlModel.getStandardDataTest()
         mlModel.predictValues()
 
         self.assertEqual( mlModel.y_pred.shape[0], mlModel.x_test.shape[0])
 
+class TestModelRegistry(unittest.TestCase):
+    def test_modelIsLoadedOnce(self):
+        """
+        Check every instance shares the cached model
+        """
+        first = cor06_svm()
+        second = cor06_svm()
+
+        self.assertIs(first.model, second.model)
+        self.assertIn('cor06', registry.cached_stations())
+
+    def test_cacheIsBounded(self):
+        """
+        Check the least recently used models are evicted and the derived ones do not count
+        """
+        size = registry.MAX_CACHED_MODELS
+        try:
+            registry.get_model('cor06')
+            registry.get_model('gra03')
+            registry.set_cache_size(1)
+            self.assertEqual(registry.cached_stations(), ['gra03'])
+
+            registry.get_raw_model('gra03')
+            self.assertEqual(registry.cached_stations(), ['gra03'])
+        finally:
+            registry.clear_cache()
+            registry.set_cache_size(size)
+
+    def test_loadedOnceByThreads(self):
+        """
+        Check threads asking for the same model at the same time share one load
+        """
+        loader, loads = registry.LOADERS['svr'], []
+
+        def slow_loader(filename):
+            loads.append(filename)
+            time.sleep(0.05)
+            return loader(filename)
+
+        registry.clear_cache()
+        registry.LOADERS['svr'] = slow_loader
+        try:
+            with ThreadPoolExecutor(8) as pool:
+                models = list(pool.map(lambda _: registry.get_raw_model('cor06'), range(16)))
+        finally:
+            registry.LOADERS['svr'] = loader
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(len({id(model) for model in models}), 1)
+
+    def test_scalerStats(self):
+        """
+        Check there is a mean/std value per input of each station
+        """
+        for station in registry.STATIONS:
+            mean, std = registry.get_scaler(station)
+            n_inputs = len(registry.get_parameters(station)) - 1
+
+            self.assertEqual(mean.shape, (n_inputs,), msg=station)
+            self.assertEqual(std.shape, (n_inputs,), msg=station)
+
+class TestNumpyMLP(unittest.TestCase):
+    stations = [s for s, entry in registry.STATIONS.items() if entry['loader'] == 'mlp']
+
+    def sample(self, station):
+        n_inputs = len(registry.get_parameters(station)) - 1
+        return np.random.RandomState(0).normal(size=(50, n_inputs))
+
+    @unittest.skipUnless(importlib.util.find_spec('h5py'), 'h5py is not installed')
+    def test_exportedWeights(self):
+        """
+        Check the .npz files in models/ are in sync with the .h5 files
+        """
+        for station in self.stations:
+            with tempfile.TemporaryDirectory() as folder:
+                exported = engines.export_keras_mlp(
+                    registry.get_filename(station), os.path.join(folder, 'model.npz'))
+            model = registry.get_model(station)
+
+            self.assertIsInstance(model, engines.NumpyMLP)
+            np.testing.assert_array_equal(
+                exported.predict(self.sample(station)), model.predict(self.sample(station)))
+
+    def test_foldedScaler(self):
+        """
+        Check the model with the scaler in its first layer takes raw inputs
+        """
+        for station in self.stations:
+            mean, std = registry.get_scaler(station)
+            raw = mean + std * self.sample(station)
+
+            np.testing.assert_allclose(
+                registry.get_raw_model(station).predict(raw),
+                registry.get_model(station).predict((raw - mean) / std),
+                rtol=1e-4, atol=1e-4, err_msg=station)
+
+    @unittest.skipUnless(importlib.util.find_spec('tensorflow'), 'tensorflow is not installed')
+    def test_sameAsKeras(self):
+        for station in self.stations:
+            keras_model = registry._load_keras(registry.get_filename(station))
+            x = self.sample(station)
+
+            np.testing.assert_allclose(
+                registry.get_model(station).predict(x), keras_model.predict(x),
+                rtol=1e-5, atol=1e-5, err_msg=station)
+
+class TestNumpySVR(unittest.TestCase):
+    def sample(self):
+        return np.random.RandomState(0).normal(size=(300, 8))
+
+    @unittest.skipUnless(importlib.util.find_spec('sklearn'), 'scikit-learn is not installed')
+    def test_sameAsSklearn(self):
+        """
+        Check the .npz export of cor06 against the pickled SVR
+        """
+        svr = registry._load_pickle(registry.get_filename('cor06'))
+        model = registry.get_model('cor06')
+        self.assertIsInstance(model, engines.NumpySVR)
+
+        x = self.sample()
+        exact = engines.NumpySVR.load(registry.get_filename('cor06')[:-4] + '.npz', dtype=np.float64)
+        np.testing.assert_allclose(exact.predict(x), svr.predict(x), rtol=1e-9)
+        np.testing.assert_allclose(model.predict(x), svr.predict(x), atol=1e-4)
+
+    def test_blocks(self):
+        """
+        Check the predictions do not depend on the size of the blocks
+        """
+        model = engines.NumpySVR.load(registry.get_filename('cor06')[:-4] + '.npz', dtype=np.float64)
+        x = self.sample()
+        y_pred = model.predict(x)
+        model.block_size = 7
+        np.testing.assert_allclose(model.predict(x), y_pred, rtol=1e-12)
+        np.testing.assert_allclose(model.predict(x[0]), y_pred[:1], rtol=1e-12)
+
+class TestNumpyELM(unittest.TestCase):
+    filename = registry.get_filename('alm04')
+
+    def sample(self):
+        return np.random.RandomState(0).normal(size=(300, 7))
+
+    def test_export(self):
+        """
+        Check the .npz export of alm04 against the hpelm file and the RBF
+        neurons against a brute-force evaluation
+        """
+        model = registry.get_model('alm04')
+        self.assertIsInstance(model, engines.NumpyELM)
+        x = self.sample()
+        np.testing.assert_array_equal(model.predict(x), engines.NumpyELM.from_hpelm(self.filename).predict(x))
+
+        function, W, B = model.neurons[0]
+        self.assertEqual(function, 'rbf_l2')
+        hidden = np.exp(-((x[:, :, None] - W) ** 2).sum(axis=1) / B)
+        np.testing.assert_allclose(model.predict(x), hidden @ model.beta, rtol=1e-7)
+
+    @unittest.skipUnless(importlib.util.find_spec('hpelm'), 'hpelm is not installed')
+    def test_sameAsHpelm(self):
+        import hpelm
+        elm = hpelm.ELM(inputs=7, outputs=1)
+        elm.load(self.filename)
+        np.testing.assert_allclose(registry.get_model('alm04').predict(self.sample()),
+                                   elm.predict(self.sample()), rtol=1e-7, atol=1e-7)
+
+class TestNumpyTrees(unittest.TestCase):
+    # a single tree: x0 < 0.5 (missing goes right) ? 1.0 : (x1 < 2 (missing goes left) ? 2.0 : 3.0)
+    model = {'learner': {
+        'objective': {'name': 'reg:squarederror'},
+        'learner_model_param': {'base_score': '[5E-1]'},
+        'gradient_booster': {'name': 'gbtree', 'model': {'gbtree_model_param': {}, 'trees': [{
+            'left_children': [1, -1, 3, -1, -1],
+            'right_children': [2, -1, 4, -1, -1],
+            'split_indices': [0, 0, 1, 0, 0],
+            'split_conditions': [0.5, 1.0, 2.0, 2.0, 3.0],
+            'default_left': [0, 0, 1, 0, 0],
+        }]}},
+    }}
+
+    def test_predict(self):
+        """
+        Check the walk of the compiled trees, missing values included
+        """
+        trees = engines.NumpyTrees.from_json(self.model)
+        x = np.array([[0.0, 0.0], [1.0, 1.0], [1.0, 5.0], [np.nan, 5.0], [1.0, np.nan]])
+        np.testing.assert_array_equal(trees.predict(x), [1.5, 2.5, 3.5, 3.5, 2.5])
+        self.assertEqual(trees.depth, 2)
+
+        with tempfile.TemporaryDirectory() as folder:
+            trees.save(os.path.join(folder, 'trees.npz'))
+            loaded = engines.NumpyTrees.load(os.path.join(folder, 'trees.npz'))
+        np.testing.assert_array_equal(loaded.predict(x), trees.predict(x))
+
+    @unittest.skipUnless(importlib.util.find_spec('xgboost'), 'xgboost is not installed')
+    def test_sameAsXGBoost(self):
+        """
+        Check the inplace and compiled paths against XGBRegressor.predict
+        """
+        import xgboost as xgb
+        rng = np.random.RandomState(0)
+        x = rng.normal(size=(500, 7))
+        y = 3 * x[:, 0] + np.sin(x[:, 1]) + rng.normal(scale=0.1, size=500)
+        x[rng.uniform(size=x.shape) < 0.05] = np.nan
+        xgbModel = xgb.XGBRegressor(n_estimators=50, max_depth=4).fit(x, y)
+
+        model = engines.XGBoostModel(xgbModel.get_booster())
+        np.testing.assert_array_equal(model.predict(x), xgbModel.predict(x))
+        engines.verify_compiled(model, model.compile(), x)
+
+class TestStatsFunctions(unittest.TestCase):
+    def setUp(self):
+        random = np.random.RandomState(0)
+        self.x = random.uniform(5, 30, size=1000)
+        self.y = self.x + random.normal(0.5, 2, size=1000)
+
+    def test_allMetrics(self):
+        """
+        Check every metric against its textbook definition
+        """
+        x, y = self.x, self.y
+        metrics = stats.compute_all_metrics(list(x), list(y))
+        rmse = np.sqrt(np.mean((y - x)**2))
+
+        self.assertAlmostEqual(metrics['rmse'], rmse)
+        self.assertAlmostEqual(metrics['rrmse'], rmse / np.mean(x))
+        self.assertAlmostEqual(metrics['mbe'], np.mean(y - x))
+        self.assertAlmostEqual(metrics['re'], np.mean(y - x) / np.mean(x))
+        self.assertAlmostEqual(metrics['ratio'], np.mean(y) / np.mean(x))
+        self.assertAlmostEqual(metrics['r2'], np.corrcoef(x, y)[0, 1]**2)
+        self.assertAlmostEqual(metrics['nse'], 1 - np.sum((y - x)**2) / np.sum((x - np.mean(x))**2))
+
+    def test_wrappers(self):
+        metrics = stats.compute_all_metrics(self.x, self.y)
+
+        self.assertEqual(stats.get_root_mean_square_error(self.x, self.y), metrics['rmse'])
+        self.assertEqual(stats.get_mean_bias_error(self.x, self.y), metrics['mbe'])
+        self.assertEqual(stats.get_relative_error(self.x, self.y), metrics['re'])
+        self.assertEqual(stats.get_ratio_error(self.x, self.y), metrics['ratio'])
+        self.assertEqual(stats.get_coefficient_of_determination(self.x, self.y), metrics['r2'])
+        self.assertEqual(stats.get_nash_suteliffe_efficiency(self.x, self.y), metrics['nse'])
+
+    def test_accumulator(self):
+        """
+        Check chunks merged from several accumulators give the batch values
+        """
+        batch = stats.compute_all_metrics(self.x, self.y)
+        first, second = stats.MetricsAccumulator(), stats.MetricsAccumulator()
+        for start in range(0, 600, 75):
+            first.update(self.x[start:start + 75], self.y[start:start + 75])
+        second.update(self.x[600:], self.y[600:])
+        streamed = first.merge(second).result()
+
+        for key, value in batch.items():
+            self.assertAlmostEqual(streamed[key], value, places=10, msg=key)
+
+class TestDatasetFunctions(unittest.TestCase):
+    fileLocation = "data/ncei-asheville-example.csv"
+
+    def test_importChunks(self):
+        """
+        Check the chunks are bounded and have the same values as a full import
+        """
+        parameters = registry.get_parameters('gra03')
+        chunks = list(dataset.import_dataset_chunks(
+            self.fileLocation, 'csv', parameters, chunksize=5, dtype=np.float64))
+        dfData = dataset.read_file(self.fileLocation, 'csv')
+        dataset.add_derived_columns(dfData)
+        dfData = dfData.filter(parameters).dropna().reset_index(drop=True)
+
+        self.assertTrue(all(len(chunk) <= 5 for chunk in chunks))
+        for chunk in chunks:
+            self.assertEqual(list(chunk.columns), parameters)
+        np.testing.assert_array_equal(
+            np.concatenate([chunk.to_numpy() for chunk in chunks]), dfData.to_numpy())
+
+    def test_lagParameters(self):
+        """
+        Check tn_next is built per station, also at the chunk boundaries
+        """
+        parameters = registry.get_parameters('cor06')
+        dfData = dataset.read_file(self.fileLocation, 'csv').drop(index=10)
+        dfOther = dfData.assign(station=1)
+        with tempfile.TemporaryDirectory() as folder:
+            fileLocation = os.path.join(folder, 'data.csv')
+            pd.concat([dfData, dfOther]).to_csv(fileLocation, index=False)
+
+            dfModel = dataset.import_dataset(fileLocation, 'csv', parameters)
+            for chunksize in [1, 4, 7]:
+                chunks = dataset.import_dataset_chunks(
+                    fileLocation, 'csv', parameters, chunksize=chunksize, dtype=np.float64)
+                np.testing.assert_allclose(
+                    pd.concat(chunks).to_numpy(), dfModel.to_numpy(), err_msg=str(chunksize))
+
+        # the last day of each station and the day before the gap have no tn_next
+        self.assertEqual(list(dfModel.columns), parameters)
+        self.assertEqual(dfModel.shape[0], 2 * (len(dfData) - 3))
+
+    def test_missingCalendar(self):
+        """
+        Check a file with a missing day is read the same whole and in chunks
+        """
+        dfData = dataset.read_file(self.fileLocation, 'csv')
+        dfData.loc[3, 'day'] = np.nan
+        fileTypes = ['csv'] + (['parquet'] if importlib.util.find_spec('pyarrow') else [])
+        with tempfile.TemporaryDirectory() as folder:
+            for fileType in fileTypes:
+                fileLocation = os.path.join(folder, 'data.' + fileType)
+                dataset.write_file(dfData, fileLocation, fileType)
+                for station in ['cor06', 'gra03']:
+                    parameters = registry.get_parameters(station)
+                    dfModel = dataset.import_dataset(fileLocation, fileType, parameters, dtype=np.float32)
+                    chunks = dataset.import_dataset_chunks(fileLocation, fileType, parameters, chunksize=4,
+                                                           dtype=np.float32)
+                    np.testing.assert_array_equal(pd.concat(chunks).to_numpy(), dfModel.to_numpy(),
+                                                  err_msg=fileType + station)
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow is not installed')
+    def test_columnarFiles(self):
+        """
+        Check parquet/feather files are projected, filtered and written back
+        """
+        parameters = registry.get_parameters('gra03')
+        dfData = dataset.read_file(self.fileLocation, 'csv')
+        n_rows = dataset.add_derived_columns(dfData.copy()).filter(parameters).dropna().shape[0]
+        with tempfile.TemporaryDirectory() as folder:
+            for fileType in ['parquet', 'feather']:
+                fileLocation = os.path.join(folder, 'data.' + fileType)
+                dataset.write_file(dfData, fileLocation, fileType)
+
+                dfModel = dataset.import_dataset(fileLocation, fileType, parameters, years=[2018])
+                self.assertEqual(list(dfModel.columns), parameters)
+                self.assertEqual(dfModel.shape[0], n_rows)
+                self.assertEqual(dataset.import_dataset(fileLocation, fileType, parameters, years=[2017]).shape[0], 0)
+
+                outputLocation = os.path.join(folder, 'output.' + fileType)
+                dataset.export_predictions(dfModel, np.zeros(len(dfModel)), outputLocation, fileType)
+                self.assertEqual(list(dataset.read_file(outputLocation, fileType).columns), parameters + ['rs_pred'])
+
+class TestFeatureEngineering(unittest.TestCase):
+    def test_extraterrestrialRadiation(self):
+        """
+        Check Ra matches the one in the example dataset
+        """
+        dfData = dataset.read_file("data/ncei-asheville-example.csv", 'csv')
+        ra = features.extraterrestrial_radiation(dfData['latitude'], dfData['doy'])
+
+        np.testing.assert_allclose(ra, dfData['ra'], rtol=1e-9)
+        np.testing.assert_allclose(
+            features.lookup_extraterrestrial_radiation(dfData['latitude'], dfData['doy']), ra)
+
+    def test_raMissingInputs(self):
+        """
+        Check a nan latitude or doy, or a doy out of range, gives a nan Ra
+        """
+        ra = features.lookup_extraterrestrial_radiation([35.49, np.nan, 10.0, 35.49, 35.49],
+                                                        [30, 30, 30, np.nan, 400])
+        expected = features.extraterrestrial_radiation([35.49, 10.0], [30, 30])
+        np.testing.assert_allclose(ra, [expected[0], np.nan, expected[1], np.nan, np.nan])
+        self.assertTrue(np.isnan(features.lookup_extraterrestrial_radiation([np.nan, np.nan], 30)).all())
+
+        dfData = pd.DataFrame({'latitude': [35.49, np.nan], 'doy': [30, 30]})
+        self.assertTrue(np.isnan(dataset.add_ra(dfData)['ra'][1]))
+
+    def test_missingRa(self):
+        """
+        Check import_dataset computes ra when the file does not have it
+        """
+        parameters = registry.get_parameters('gra03')
+        with tempfile.TemporaryDirectory() as folder:
+            fileLocation = os.path.join(folder, 'data.csv')
+            dataset.read_file("data/ncei-asheville-example.csv", 'csv').drop(columns='ra').to_csv(fileLocation)
+
+            np.testing.assert_allclose(
+                dataset.import_dataset(fileLocation, 'csv', parameters)['ra'],
+                dataset.import_dataset("data/ncei-asheville-example.csv", 'csv', parameters)['ra'])
+
+    def test_lagFeatures(self):
+        """
+        Check previous/next day values respect stations and calendar gaps
+        """
+        dfData = pd.DataFrame({
+            'station': [2, 1, 1, 1, 2],
+            'year': [2018] * 5, 'month': [1] * 5, 'day': [1, 3, 1, 2, 2],
+            'tn': [20.0, 3.0, 1.0, 2.0, 21.0]})
+        dfData = features.add_lag_features(dfData, prev_columns=['tn'], next_columns=['tn'])
+
+        np.testing.assert_array_equal(dfData['tn'], [20, 3, 1, 2, 21])
+        np.testing.assert_array_equal(dfData['tn_prev'], [np.nan, 2, np.nan, 1, 20])
+        np.testing.assert_array_equal(dfData['tn_next'], [21, np.nan, 2, 3, np.nan])
+
+class TestUSCRN(unittest.TestCase):
+    # hourly records of 4 days: hour 5 of the first one missing (-9999),
+    # the third one with 10 hours only and no records of 2018-01-04. The
+    # hourly temperature is base + h until 14h and base + 28 - h after it,
+    # T_MAX/T_MIN are 0.5 above/below it and SOLARAD is 10 * h
+    fileLocation = "test/uscrn-hourly-sample.txt"
+
+    @staticmethod
+    def temperatures(base, hours):
+        return np.array([base + (h if h <= 14 else 28 - h) for h in hours])
+
+    def test_readUscrn(self):
+        """
+        Check the columns read and the missing values replaced by nan
+        """
+        dfRaw = features.read_uscrn(self.fileLocation)
+        self.assertEqual(len(dfRaw), 82)
+        self.assertEqual(set(dfRaw.columns), set(features.PRODUCTS['hourly'][1].values()))
+        missing = dfRaw[(dfRaw['date'] == 20180101) & (dfRaw['time'] == 500)]
+        self.assertTrue(missing[['temp', 'temp_max', 'temp_min', 'rs']].isna().all(axis=None))
+        self.assertEqual(dfRaw['temp'].isna().sum(), 1)
+
+    def test_dailyFeatures(self):
+        """
+        Check the daily extremes, their hours, energyt, rs and precipitation
+        """
+        dfDaily = features.build_daily_dataset(self.fileLocation)
+        self.assertEqual(list(dfDaily.columns), features.DAILY_COLUMNS)
+        dfDaily = dfDaily.set_index('day')
+        self.assertEqual(list(dfDaily.index), [1, 2, 3, 5])
+
+        hours = [h for h in range(24) if h != 5]
+        day = dfDaily.loc[1]
+        self.assertEqual((day['tx'], day['tn']), (16.5, 1.5))
+        self.assertEqual((day['hormin_tx'], day['hormin_tn']), (14, 0))
+        np.testing.assert_allclose(day['energyt'], self.temperatures(2.0, hours).mean() * 24)
+        np.testing.assert_allclose(day['rs'], np.mean([10.0 * h for h in hours]))
+        np.testing.assert_allclose(dfDaily.loc[2, 'energyt'], self.temperatures(5.0, range(24)).mean() * 24)
+        np.testing.assert_allclose(dfDaily['precipitation'].loc[[1, 2]], [0.0, 1.2])
+        self.assertEqual(dfDaily.loc[1, 'doy'], 1)
+        np.testing.assert_allclose(dfDaily['ra'], features.extraterrestrial_radiation(35.49, dfDaily['doy']))
+
+    def test_coverage(self):
+        """
+        Check the days below the hourly coverage are dropped from the dataset
+        """
+        dfDaily = features.build_daily_dataset(self.fileLocation)
+        incomplete = dfDaily[dfDaily['day'] == 3]
+        self.assertTrue(incomplete[['tx', 'tn', 'energyt', 'hormin_tx', 'rs']].isna().all(axis=None))
+        self.assertEqual(list(dataset.filter_parameters(dfDaily, ['day', 'tx', 'tn', 'rs'])['day']), [1, 2, 5])
+
+        # with a lower threshold the day is kept
+        dfDaily = features.build_daily_dataset(self.fileLocation, min_coverage=0.4)
+        self.assertEqual(dfDaily.loc[dfDaily['day'] == 3, 'tx'].item(), 16.5)
+
+    def test_missingPrecipitation(self):
+        """
+        Check a day with every precipitation record missing gets nan, not a dry day
+        """
+        dfRaw = features.read_uscrn(self.fileLocation)
+        dfRaw.loc[dfRaw['date'] == 20180105, 'precipitation'] = np.nan
+        dfDaily = features.daily_features(dfRaw).set_index('day')
+        self.assertEqual(dfDaily.loc[1, 'precipitation'], 0.0)
+        self.assertTrue(np.isnan(dfDaily.loc[5, 'precipitation']))
+
+    def test_lagFeaturesAcrossGap(self):
+        """
+        Check the previous/next day values, nan across the missing day
+        """
+        dfDaily = features.build_daily_dataset(self.fileLocation).set_index('day')
+        self.assertTrue(np.isnan(dfDaily.loc[1, 'tx_prev']))
+        self.assertEqual(dfDaily.loc[2, 'tx_prev'], 16.5)
+        self.assertEqual(dfDaily.loc[1, 'tn_next'], 4.5)
+        np.testing.assert_allclose(dfDaily.loc[2, 'energyt_prev'], dfDaily.loc[1, 'energyt'])
+        # 2018-01-04 has no records
+        self.assertTrue(np.isnan(dfDaily.loc[3, 'tn_next']))
+        self.assertTrue(dfDaily.loc[5, ['tx_prev', 'tn_prev', 'hormin_tx_prev', 'energyt_prev']].isna().all())
+        self.assertTrue(np.isnan(dfDaily.loc[5, 'tn_next']))
+
+class TestEnsembleRunner(unittest.TestCase):
+    def test_sameAsStationClasses(self):
+        """
+        Check the single-pass predictions match each station class
+        """
+        stations = ['gra03', 'mag01', 'hue08']
+        dfPredictions = ensemble.run_ensemble("data/ncei-asheville-example.csv", 'csv', stations)
+
+        for station in stations:
+            mlModel = registry.get_class(station)()
+            mlModel.import_dataset("data/ncei-asheville-example.csv", 'csv')
+            mlModel.getStandardDataTest()
+
+            np.testing.assert_allclose(
+                dfPredictions['rs_' + station].dropna(), mlModel.predictValues(), rtol=1e-6, err_msg=station)
+        self.assertEqual(list(ensemble.ensemble_metrics(dfPredictions).index), stations)
+
+class TestModelRouter(unittest.TestCase):
+    def test_nearest(self):
+        """
+        Check the routing to the closest aridity index and the blend weights
+        """
+        modelRouter = router.ModelRouter(['gra03', 'mag01', 'sev09'], k=2)
+        self.assertEqual(list(modelRouter.route([0.1, 0.362, 0.9])), ['gra03', 'sev09', 'mag01'])
+
+        position, weights = modelRouter.neighbours([0.3162, 0.34])
+        np.testing.assert_allclose(weights[0], [1, 0])
+        np.testing.assert_allclose(weights.sum(axis=1), 1)
+        self.assertGreater(weights[1, 0], weights[1, 1])
+
+    def test_predictDataset(self):
+        """
+        Check a site routed to a model gets the predictions of its station class
+        """
+        modelRouter = router.ModelRouter(['gra03', 'mag01', 'sev09'])
+        dfPredictions = modelRouter.predict_dataset("data/ncei-asheville-example.csv", 'csv',
+                                                    aridity={53877: 0.30})
+        self.assertTrue((dfPredictions['model'] == 'gra03').all())
+
+        dfEnsemble = ensemble.run_ensemble("data/ncei-asheville-example.csv", 'csv', ['gra03'])
+        np.testing.assert_allclose(dfPredictions['rs_pred'], dfEnsemble['rs_gra03'], rtol=1e-6)
+
+    def test_aridityIndex(self):
+        """
+        Check the aridity index estimated as precipitation / Hargreaves ET0
+        """
+        dfData = pd.DataFrame({'station': [1, 1, 2], 'tx': [30.0, 30.0, 20.0], 'tn': [14.0, 14.0, 11.0],
+                               'ra': [40.0, 40.0, 20.0], 'precipitation': [0.0, 2.0, 4.0]})
+        et0 = router.hargreaves_et0(dfData['tx'], dfData['tn'], dfData['ra'])
+        np.testing.assert_allclose(et0[0], 0.0023 * 0.408 * 40 * (22 + 17.8) * 4)
+
+        aridity = router.estimate_aridity_index(dfData)
+        np.testing.assert_allclose(aridity[1], 2 / (2 * et0[0]))
+        np.testing.assert_allclose(aridity[2], 4 / et0[2])
+
+class TestBatchRunner(unittest.TestCase):
+    def test_sameAsEnsemble(self):
+        """
+        Check the worker pool gives the single-process predictions and metrics
+        """
+        stations = ['gra03', 'mag01']
+        fileLocations = ["data/ncei-asheville-example.csv"] * 2
+        dfReport, predictions = batch.run_batch(fileLocations, 'csv', stations, workers=2,
+                                                keep_predictions=True)
+        self.assertEqual(len(dfReport), 2 * len(stations))
+
+        dfEnsemble = ensemble.run_ensemble("data/ncei-asheville-example.csv", 'csv', stations)
+        dfMetrics = ensemble.ensemble_metrics(dfEnsemble)
+        pd.testing.assert_frame_equal(predictions[fileLocations[0]], dfEnsemble)
+        for station in stations:
+            rmse = dfReport.loc[dfReport['station'] == station, 'rmse']
+            np.testing.assert_allclose(rmse, dfMetrics.loc[station, 'rmse'])
+
+class TestThreadControls(unittest.TestCase):
+    def setUp(self):
+        self.settings = dict(threads.THREADS)
+        self.environment = {v: os.environ.get(v) for v in threads.BLAS_VARIABLES}
+        # limits=None changes nothing, it only keeps the limits to restore
+        try:
+            self.limits = lazy.import_backend('threadpoolctl').threadpool_limits(limits=None)
+        except ImportError:
+            self.limits = None
+
+    def tearDown(self):
+        threads.THREADS.update(self.settings)
+        if self.limits is not None:
+            self.limits.restore_original_limits()
+        for variable, value in self.environment.items():
+            if value is None:
+                os.environ.pop(variable, None)
+            else:
+                os.environ[variable] = value
+
+    def test_configure(self):
+        """
+        Check the default and per-backend settings and the BLAS limits
+        """
+        settings = threads.configure(2, xgboost=1)
+        self.assertEqual(settings, {'blas': 2, 'intra_op': 2, 'inter_op': 2, 'xgboost': 1})
+        self.assertEqual(os.environ['OMP_NUM_THREADS'], '2')
+
+        with self.assertRaises(ValueError):
+            threads.configure(blas=0)
+        self.assertEqual(threads.THREADS['blas'], 2)
+
+        self.assertEqual(threads.one_thread_per_core(), os.cpu_count())
+        self.assertEqual(set(threads.THREADS.values()), {1})
+        if lazy.is_loaded('threadpoolctl'):
+            info = lazy.import_backend('threadpoolctl').threadpool_info()
+            self.assertTrue(all(pool['num_threads'] == 1 for pool in info))
+
+    def test_onImport(self):
+        """
+        Check the hooks run for a backend already imported
+        """
+        lazy.import_backend('h5py')
+        modules = []
+        lazy.on_import('h5py', modules.append)
+        self.assertEqual(len(modules), 1)
+
+class TestPredictionCache(unittest.TestCase):
+    def sample(self, rows=3000):
+        return np.random.RandomState(0).normal(size=(rows, 7))
+
+    def test_hitsAndMisses(self):
+        """
+        Check only the changed blocks are predicted again, also after reopening
+        """
+        model = registry.get_model('gra03')
+        x = self.sample()
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, 'cache.sqlite')
+            cache = predcache.PredictionCache(filename, block_size=64)
+            y_pred = cache.predict(model, 'gra03', x)
+            np.testing.assert_array_equal(y_pred, np.ravel(model.predict(x)))
+            self.assertEqual(cache.stats()['misses'], len(x))
+            cache.close()
+
+            cache = predcache.PredictionCache(filename, block_size=64)
+            np.testing.assert_array_equal(cache.predict(model, 'gra03', x), y_pred)
+            self.assertEqual(cache.stats()['hits'], len(x))
+
+            x[1000] += 1
+            x = np.insert(x, 2000, x[5], axis=0)
+            np.testing.assert_array_equal(cache.predict(model, 'gra03', x), np.ravel(model.predict(x)))
+            self.assertLess(cache.stats()['misses'], 64 * predcache.MAX_BLOCK_FACTOR * 4)
+
+            # the same rows for another model are not hits
+            misses = cache.stats()['misses']
+            cache.predict(registry.get_model('gra03'), 'sev09', x)
+            self.assertEqual(cache.stats()['misses'], misses + len(x))
+            cache.close()
+
+    def test_attachAndEvict(self):
+        """
+        Check a station class predicts through the cache and the cache stays bounded
+        """
+        mlModel = registry.get_class('gra03')()
+        mlModel.import_dataset("data/ncei-asheville-example.csv", 'csv')
+        mlModel.getStandardDataTest()
+        y_pred = mlModel.predictValues()
+
+        with tempfile.TemporaryDirectory() as folder:
+            cache = predcache.PredictionCache(os.path.join(folder, 'cache.sqlite'), max_rows=1000,
+                                              block_size=16)
+            cache.attach(mlModel)
+            np.testing.assert_allclose(mlModel.predictValues(), y_pred, rtol=1e-6)
+            np.testing.assert_allclose(mlModel.predictValues(), y_pred, rtol=1e-6)
+            self.assertEqual(cache.stats()['hits'], len(y_pred))
+
+            cache.predict(mlModel.model.model, 'gra03', self.sample())
+            self.assertLessEqual(cache.stats()['rows'], 1000)
+            cache.close()
+
+    def test_engineInKey(self):
+        """
+        Check the engine and dtype of a model are part of the keys of its predictions
+        """
+        filename = registry.get_filename('cor06')[:-4] + '.npz'
+        x = np.random.RandomState(0).normal(size=(200, len(registry.get_parameters('cor06')) - 1))
+        with tempfile.TemporaryDirectory() as folder:
+            cache = predcache.PredictionCache(os.path.join(folder, 'cache.sqlite'), block_size=16)
+            for model in [engines.NumpySVR.load(filename, dtype=np.float32),
+                          engines.NumpySVR.load(filename, dtype=np.float64)]:
+                np.testing.assert_array_equal(cache.predict(model, 'cor06', x), model.predict(x))
+            cache.predict(model, 'cor06', x)
+            self.assertEqual(cache.stats()['misses'], 2 * len(x))
+            self.assertEqual(cache.stats()['hits'], len(x))
+            cache.close()
+
+    def test_evictRecounts(self):
+        """
+        Check eviction recounts the rows when another connection emptied the table
+        """
+        model = registry.get_model('gra03')
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, 'cache.sqlite')
+            cache = predcache.PredictionCache(filename, block_size=16)
+            cache.predict(model, 'gra03', self.sample(500))
+            other = predcache.PredictionCache(filename)
+            other.clear()
+            other.close()
+
+            cache.max_rows = 100
+            cache.predict(model, 'gra03', self.sample(50) + 1)
+            self.assertEqual(cache.stats()['rows'], 0)
+            self.assertEqual(cache.stats()['entries'], 0)
+            cache.close()
+
+class TestIncrementalRunner(unittest.TestCase):
+    def run_days(self, fileType):
+        """
+        Score the first days, then the rest from a file with the latest days only
+        """
+        stations = ['gra03', 'mag01']
+        dfData = pd.read_csv("data/ncei-asheville-example.csv")
+        with tempfile.TemporaryDirectory() as folder:
+            first, latest = os.path.join(folder, 'first.' + fileType), os.path.join(folder, 'latest.' + fileType)
+            dataset.write_file(dfData.iloc[:12], first, fileType)
+            dataset.write_file(dfData.iloc[9:], latest, fileType)
+
+            store = incremental.ResultsStore(os.path.join(folder, 'store'))
+            dfFirst = incremental.run_incremental(first, fileType, store, stations)
+            dfLatest = incremental.run_incremental(latest, fileType, store, stations)
+            self.assertEqual(len(incremental.run_incremental(latest, fileType, store, stations)), 0)
+            dfResults = store.read_results()
+            # mag01 needs tn_next, so the last day is not scored yet
+            self.assertEqual(store.watermarks()['gra03'][53877], (2018, 2, 8))
+            self.assertEqual(store.watermarks()['mag01'][53877], (2018, 2, 7))
+
+        # the second run only scores the days after the first one
+        self.assertEqual(len(dfResults), len(dfFirst) + len(dfLatest))
+        for station in stations:
+            scored = dfFirst[dfFirst['model'] == station]
+            later = dfLatest[dfLatest['model'] == station]
+            self.assertGreater(dataset.date_keys(later).min(), dataset.date_keys(scored).max())
+
+        dfEnsemble = ensemble.run_ensemble("data/ncei-asheville-example.csv", 'csv', stations)
+        for station in stations:
+            y_pred = dfResults[dfResults['model'] == station].set_index(['year', 'month', 'day'])['rs_pred']
+            expected = dfEnsemble.set_index(['year', 'month', 'day'])['rs_' + station].dropna()
+            pd.testing.assert_series_equal(y_pred.sort_index(), expected.sort_index(), check_names=False)
+
+    def test_csv(self):
+        self.run_days('csv')
+
+    def test_parquet(self):
+        self.run_days('parquet')
+
+    def test_sinceDates(self):
+        """
+        Check a station id is read whole when a model has no watermark for it
+        """
+        watermarks = {'gra03': {1: (2020, 3, 1), 2: (2020, 5, 1)}, 'mag01': {2: (2020, 4, 1)}}
+        self.assertEqual(incremental.since_dates(watermarks, ['gra03', 'mag01']), {2: (2020, 4, 1)})
+        self.assertEqual(incremental.since_dates(watermarks, ['gra03']), watermarks['gra03'])
+        self.assertEqual(incremental.since_dates(watermarks, ['gra03', 'sev09']), {})
+
+    def test_newStationForModel(self):
+        """
+        Check a model scores the whole history of a station id it has no watermark for
+        """
+        dfData = pd.read_csv("data/ncei-asheville-example.csv")
+        with tempfile.TemporaryDirectory() as folder:
+            fileLocation = os.path.join(folder, 'feed.parquet')
+            dataset.write_file(pd.concat([dfData, dfData.assign(station=1)]), fileLocation, 'parquet')
+            store = incremental.ResultsStore(os.path.join(folder, 'store'))
+            incremental.run_incremental(fileLocation, 'parquet', store, ['gra03'])
+            # mag01 has only scored station 1
+            store.set_watermarks(dict(store.watermarks(), mag01={1: (2018, 2, 7)}))
+
+            dfResults = incremental.run_incremental(fileLocation, 'parquet', store, ['gra03', 'mag01'])
+        dfEnsemble = ensemble.run_ensemble("data/ncei-asheville-example.csv", 'csv', ['mag01'])
+        self.assertEqual(len(dfResults[(dfResults['model'] == 'mag01') & (dfResults['station'] == 53877)]),
+                         dfEnsemble['rs_mag01'].notna().sum())
+
+    def test_since(self):
+        """
+        Check the rows kept from the since date of each station
+        """
+        dfData = pd.DataFrame({'station': [1, 1, 1, 2, 2], 'year': [2020, 2020, 2021, 2020, 2020],
+                               'month': [1, 2, 1, 1, 3], 'day': [31, 1, 1, 1, 1]})
+        dfSelected = dataset.select_rows(dfData, since={1: (2020, 2, 1)})
+        self.assertEqual(list(dfSelected.index), [1, 2, 3, 4])
+
+class TestBatchScorer(unittest.TestCase):
+    def test_chunkWriter(self):
+        """
+        Check the chunks written one by one read back as the whole dataset
+        """
+        dfData = dataset.read_file("data/ncei-asheville-example.csv", 'csv')
+        with tempfile.TemporaryDirectory() as folder:
+            for fileType in ['csv', 'parquet', 'feather']:
+                filename = os.path.join(folder, 'chunks.' + fileType)
+                with dataset.ChunkWriter(filename, fileType) as writer:
+                    for start in range(0, len(dfData), 10):
+                        writer.write(dfData.iloc[start:start + 10])
+                self.assertEqual(writer.rows, len(dfData))
+                pd.testing.assert_frame_equal(dataset.read_file(filename, fileType), dfData,
+                                              check_dtype=False, obj=fileType)
+        with self.assertRaises(ValueError):
+            dataset.ChunkWriter('chunks.xlsx', 'excel')
+
+    def test_sameAsEnsemble(self):
+        """
+        Check the streamed predictions and metrics match the whole file at once
+        """
+        stations = ['gra03', 'mag01']
+        with tempfile.TemporaryDirectory() as folder:
+            dfReport = scorer.score_files(scorer.expand_inputs(["data/ncei-*.csv"]), stations,
+                                          output=folder, chunksize=7, workers=2)
+            self.assertEqual(list(dfReport['model']), stations)
+
+            dfEnsemble = ensemble.run_ensemble("data/ncei-asheville-example.csv", 'csv', stations)
+            dfMetrics = ensemble.ensemble_metrics(dfEnsemble)
+            for station in stations:
+                dfOutput = dataset.read_file(os.path.join(folder, 'ncei-asheville-example_%s.parquet' % station),
+                                             'parquet')
+                np.testing.assert_allclose(dfOutput['rs_pred'], dfEnsemble['rs_' + station].dropna(),
+                                           rtol=1e-6, err_msg=station)
+                report = dfReport.set_index('model').loc[station]
+                self.assertEqual(report['rows'], len(dfOutput))
+                np.testing.assert_allclose(report[['rmse', 'mbe', 'r2']].astype(float),
+                                           dfMetrics.loc[station, ['rmse', 'mbe', 'r2']].astype(float), rtol=1e-6)
+
+        self.assertEqual(scorer.file_type('a/b.PQ'), 'parquet')
+        with self.assertRaises(FileNotFoundError):
+            scorer.expand_inputs(["data/missing-*.csv"])
+
+    def test_sameNameInputs(self):
+        """
+        Check inputs with the same name in different folders get their own output
+        """
+        with tempfile.TemporaryDirectory() as folder:
+            dfData = dataset.read_file("data/ncei-asheville-example.csv", 'csv')
+            for site, rows in [('north', 20), ('south', 12)]:
+                os.makedirs(os.path.join(folder, site))
+                dataset.write_file(dfData.iloc[:rows], os.path.join(folder, site, 'asheville.csv'), 'csv')
+
+            output = os.path.join(folder, 'predictions')
+            dfReport = scorer.score_files(scorer.expand_inputs([os.path.join(folder, '*', 'asheville.csv')]),
+                                          ['gra03'], output=output, workers=2)
+            for site in ['north', 'south']:
+                dfOutput = dataset.read_file(os.path.join(output, site, 'asheville_gra03.parquet'), 'parquet')
+                rows = dfReport.loc[dfReport['file'].str.contains(site), 'rows'].item()
+                self.assertEqual(len(dfOutput), rows)
+            self.assertNotEqual(*dfReport['rows'])
+
+class TestInstrumentation(unittest.TestCase):
+    def tearDown(self):
+        instrumentation.disable()
+
+    def test_disabledByDefault(self):
+        """
+        Check nothing is recorded while no sink is enabled
+        """
+        sink = instrumentation.MemorySink()
+        mlModel = cor06_svm()
+        mlModel.import_dataset("data/ncei-asheville-example.csv", 'csv')
+        self.assertEqual(instrumentation.enabled_sinks(), ())
+        self.assertEqual(sink.events, [])
+        self.assertEqual(cor06_svm.predictValues.__name__, 'predictValues')
+
+    def test_events(self):
+        """
+        Check every stage records its rows, bytes and backend in every sink
+        """
+        stages = ['import_dataset', 'getStandardDataTest', 'predictValues', 'statAnalysis']
+        sink = instrumentation.MemorySink()
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, 'stages.prom')
+            prometheus = instrumentation.PrometheusSink(filename)
+            with instrumentation.instrument(sink, prometheus):
+                mlModel = cor06_svm()
+                mlModel.import_dataset("data/ncei-asheville-example.csv", 'csv')
+                mlModel.getStandardDataTest()
+                mlModel.predictValues()
+                mlModel.statAnalysis()
+            mlModel.predictValues()
+            with open(filename) as file:
+                text = file.read()
+
+        self.assertEqual([event['stage'] for event in sink.events], stages)
+        rows = len(mlModel.y_test)
+        self.assertEqual({event['rows'] for event in sink.events}, {rows})
+        self.assertEqual({event['backend'] for event in sink.events}, {'svr'})
+        self.assertEqual(sink.events[2]['engine'], 'NumpySVR')
+        self.assertEqual(sink.events[1]['bytes'], mlModel.x_test.nbytes + mlModel.y_test.nbytes)
+        self.assertEqual(sink.events[3]['bytes'], 0)
+
+        dfSummary = sink.summary()
+        self.assertEqual(list(dfSummary.loc['cor06', 'calls']), [1] * 4)
+        self.assertIn('solar_stage_rows_total{station="cor06",stage="predictValues",backend="svr"} %d'
+                      % rows, text)
+        self.assertIn('# TYPE solar_stage_seconds_total counter', text)
+
+class TestFloat32(unittest.TestCase):
+    # max abs. difference of the predictions against float64 (MJ/m2day-1),
+    # see the float32 mode in README.md
+    FLOAT32_TOLERANCE = {'mag01': 1e-4, 'sev09': 1e-4, 'gra03': 1e-4, 'hue08': 1e-4, 'jae07': 1e-4,
+                         'cor06': 5e-4, 'alm04': 1e-3, 'ash08': 1e-6}
+
+    def test_accuracy(self):
+        """
+        Check every stage keeps float32 and the predictions and metrics stay close to float64
+        """
+        for station in registry.available_stations():
+            results = {}
+            for dtype in [np.float64, np.float32]:
+                mlModel = registry.get_class(station)(dtype=dtype)
+                mlModel.import_dataset("data/ncei-asheville-example.csv", 'csv')
+                mlModel.getStandardDataTest()
+                mlModel.predictValues()
+                results[dtype] = mlModel, mlModel.statAnalysis()
+
+            mlModel, metrics = results[np.float32]
+            self.assertEqual(set(mlModel.dfData.dtypes), {np.dtype(np.float32)}, station)
+            for array in [mlModel.x_test, mlModel.y_test, mlModel.y_pred]:
+                self.assertEqual(array.dtype, np.float32, station)
+
+            mlModel64, metrics64 = results[np.float64]
+            self.assertEqual(mlModel.dfData.memory_usage(index=False).sum() * 2,
+                             mlModel64.dfData.memory_usage(index=False).sum())
+            np.testing.assert_allclose(mlModel.y_pred, mlModel64.y_pred, rtol=0,
+                                       atol=self.FLOAT32_TOLERANCE[station], err_msg=station)
+            # the metrics are computed in float64 from the float32 predictions
+            metrics_float64 = stats.compute_all_metrics(mlModel.y_test.astype(np.float64),
+                                                        mlModel.y_pred.astype(np.float64))
+            self.assertEqual(list(metrics), [metrics_float64[m] for m in ['rmse', 'rrmse', 'mbe', 'r2', 'nse']])
+            np.testing.assert_allclose(metrics, metrics64, rtol=1e-4, atol=1e-4, err_msg=station)
+
+    def test_chunks(self):
+        """
+        Check the chunks are read in the dtype of the class and match import_dataset
+        """
+        for dtype in [np.float64, np.float32]:
+            mlModel = cor06_svm(dtype=dtype)
+            mlModel.import_dataset("data/ncei-asheville-example.csv", 'csv')
+            mlModel.getStandardDataTest()
+            y_pred = mlModel.predictValues()
+
+            predictions = []
+            for dfChunk in mlModel.import_dataset_chunks("data/ncei-asheville-example.csv", 'csv', chunksize=7):
+                self.assertEqual(set(dfChunk.dtypes), {np.dtype(dtype)})
+                mlModel.getStandardDataTest()
+                predictions.append(mlModel.predictValues())
+                self.assertEqual(mlModel.y_pred.dtype, dtype)
+            # with float32 inputs the SVR kernel rounds a little differently per batch size
+            np.testing.assert_allclose(np.concatenate(predictions), y_pred, rtol=1e-5)
+
+    def test_scaler(self):
+        """
+        Check the scaler is given in the dtype of the inputs
+        """
+        mean, std = registry.get_scaler('cor06', np.float32)
+        self.assertEqual((mean.dtype, std.dtype), (np.float32, np.float32))
+        np.testing.assert_allclose(mean, registry.get_scaler('cor06')[0], rtol=1e-6)
+        with self.assertRaises(ValueError):
+            registry.get_scaler('cor06', np.float16)
+
+class TestPredictionServer(unittest.TestCase):
+    async def request(self, port, method, path, record=None):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        body = json.dumps(record).encode() if record is not None else b''
+        writer.write(b'%s %s HTTP/1.1\r\nContent-Length: %d\r\nConnection: close\r\n\r\n'
+                     % (method.encode(), path.encode(), len(body)) + body)
+        response = await reader.read()
+        writer.close()
+        head, _, payload = response.partition(b'\r\n\r\n')
+        return int(head.split()[1]), json.loads(payload)
+
+    def test_microBatches(self):
+        """
+        Check concurrent requests are batched and each one gets its prediction
+        """
+        parameters = registry.get_parameters('gra03')[:-1]
+        x = np.random.RandomState(0).normal(15, 5, size=(50, len(parameters)))
+        records = [dict(zip(parameters, row)) for row in x.tolist()]
+
+        async def run():
+            server = service.PredictionServer(['gra03'], port=0, max_latency=0.05)
+            port = await server.start()
+            try:
+                responses = await asyncio.gather(*[self.request(port, 'POST', '/predict/gra03', record)
+                                                   for record in records])
+                errors = [await self.request(port, 'POST', '/predict/gra03', {'tx': 1.0}),
+                          await self.request(port, 'POST', '/predict/sev09', records[0]),
+                          await self.request(port, 'GET', '/predict/gra03')]
+                return responses, errors, (await self.request(port, 'GET', '/stats'))[1]
+            finally:
+                await server.stop()
+
+        responses, errors, stats = asyncio.run(run())
+        self.assertEqual({status for status, _ in responses}, {200})
+        np.testing.assert_allclose([response['rs_pred'] for _, response in responses],
+                                   np.ravel(registry.get_raw_model('gra03').predict(x)), rtol=1e-6)
+        self.assertEqual([status for status, _ in errors], [400, 404, 405])
+
+        self.assertEqual(stats['gra03']['requests'], len(records))
+        self.assertLess(stats['gra03']['batches'], len(records))
+        self.assertGreater(stats['gra03']['batch_size']['max'], 1)
+        self.assertIsNotNone(stats['gra03']['latency_ms']['p99'])
+
+    def test_invalidRequests(self):
+        """
+        Check non-finite inputs and malformed requests get a 400 and stop ends the batchers
+        """
+        record = dict.fromkeys(registry.get_parameters('gra03')[:-1], 15.0)
+
+        async def raw(port, data):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(data)
+            response = await reader.read()
+            writer.close()
+            return int(response.split()[1])
+
+        async def run():
+            server = service.PredictionServer(['gra03'], port=0)
+            port = await server.start()
+            try:
+                statuses = [(await self.request(port, 'POST', '/predict/gra03', dict(record, tx=value)))[0]
+                            for value in [float('nan'), float('inf'), 15.0]]
+                statuses += [await raw(port, b'GARBAGE\r\n\r\n'),
+                             await raw(port, b'POST /predict/gra03 HTTP/1.1\r\nContent-Length: x\r\n\r\n')]
+            finally:
+                await server.stop()
+            return statuses, server.batchers['gra03'].task.done()
+
+        statuses, stopped = asyncio.run(run())
+        self.assertEqual(statuses, [400, 400, 200, 400, 400])
+        self.assertTrue(stopped)
+
+    def test_longLinesAndStop(self):
+        """
+        Check a too long header gets a 431 and stop answers the queued requests and restores the cache size
+        """
+        record = dict.fromkeys(registry.get_parameters('gra03')[:-1], 15.0)
+        size = registry.MAX_CACHED_MODELS
+
+        async def run():
+            server = service.PredictionServer(['gra03'], port=0, max_latency=10)
+            port = await server.start()
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(b'GET /health HTTP/1.1\r\nX-Long: %s\r\n\r\n' % (b'x' * 100000))
+                long_header = int((await reader.read()).split()[1])
+                writer.close()
+                queued = asyncio.ensure_future(self.request(port, 'POST', '/predict/gra03', record))
+                await asyncio.sleep(0.2)
+            finally:
+                await server.stop()
+            return long_header, await queued
+
+        long_header, (status, response) = asyncio.run(asyncio.wait_for(run(), 5))
+        self.assertEqual(long_header, 431)
+        self.assertEqual(status, 503)
+        self.assertIn('stopped', response['error'])
+        self.assertEqual(registry.MAX_CACHED_MODELS, size)
+
 if __name__ == '__main__':
     unittest.main()